@@ -1,15 +1,48 @@
 import logging
+import collections
 import collections.abc
+import concurrent.futures as cf
+import contextlib
+import dataclasses
+import hashlib
+import itertools
+import time
+import pathlib
+import json
+import multiprocessing
+import queue
 import bz2
+import shutil
 
 import lmdb
+import numcodecs
 import tqdm
+import humanize
 import numpy as np
+import zarr
 
 from . import core
+from . import compression
 
 logger = logging.getLogger(__name__)
 
+# Version 1 stores hold bz2 compressed character arrays in the main LMDB
+# database and have no metadata. Version 2 stores keep their alignments
+# in a named database, with a description of the encoding in "metadata".
+FORMAT_VERSION = 2
+
+MAX_DBS = 8
+
+ALIGNMENT_MATRIX_FORMAT_VERSION = 1
+
+SHARDED_FORMAT_VERSION = 1
+
+MISSING = -1
+
+_ENCODE_TABLE = np.full(256, MISSING, dtype=np.int8)
+for _code, _char in enumerate(core.ALLELES):
+    _ENCODE_TABLE[ord(_char)] = _code
+
 
 def encode_alignment(h):
     # Map anything that's not ACGT- to N
@@ -36,15 +69,502 @@ def decompress_alignment(b):
     return x.astype(str)
 
 
+__cached_reference_alleles = None
+
+
+def get_reference_alleles():
+    """
+    Return the encoded alleles of the reference sequence.
+    """
+    global __cached_reference_alleles
+    if __cached_reference_alleles is None:
+        h = core.get_reference_sequence(as_array=True)
+        __cached_reference_alleles = _ENCODE_TABLE[h.astype("S1").view(np.uint8)]
+    return __cached_reference_alleles
+
+
+class AlignmentRecord:
+    """
+    Base class for the encoded representations of alignments. Ambiguous
+    bases (i.e., not ACGT-N) are encoded as missing data, with their
+    positions and original characters recorded separately.
+    """
+
+    def _ambiguous_bases_at(self, sites):
+        if sites is None:
+            return self.ambiguous_position, self.ambiguous_base
+        sites = np.asarray(sites)
+        index = np.searchsorted(self.ambiguous_position, sites)
+        index[index == len(self.ambiguous_position)] = 0
+        found = np.zeros(len(sites), dtype=bool)
+        if len(self.ambiguous_position) > 0:
+            found = self.ambiguous_position[index] == sites
+        return np.where(found)[0], self.ambiguous_base[index[found]]
+
+    def haplotype(self, sites=None, out=None):
+        """
+        Return the encoded alleles at the specified sites (all sites by default)
+        as a new int8 array, or write them to the specified output array.
+        """
+        raise NotImplementedError()
+
+    def composition(self, sites=None, haplotype=None):
+        """
+        Return a Counter of the original characters at the specified sites.
+        If the haplotype at these sites has already been computed it can be
+        provided to avoid decoding again.
+        """
+        if haplotype is None:
+            haplotype = self.haplotype(sites)
+        counts = np.bincount(haplotype + 1, minlength=len(core.ALLELES) + 1)
+        composition = collections.Counter()
+        for char, count in zip("N" + core.ALLELES, counts):
+            if count > 0:
+                composition[char] = int(count)
+        _, bases = self._ambiguous_bases_at(sites)
+        for base in bases:
+            composition["N"] -= 1
+            composition[base] += 1
+        if composition["N"] == 0:
+            del composition["N"]
+        return composition
+
+    def decode(self, sites=None):
+        """
+        Return the original uppercase character array at the specified sites.
+        """
+        h = decode_alignment(self.haplotype(sites))
+        index, bases = self._ambiguous_bases_at(sites)
+        h[index] = bases
+        return h
+
+
+def _ambiguous_bases(h, alleles):
+    position = np.where((alleles == MISSING) & (h != b"N"))[0]
+    return position.astype(np.uint32), h[position].astype(str)
+
+
+@dataclasses.dataclass
+class EncodedAlignment(AlignmentRecord):
+    """
+    An alignment represented as int8 allele codes (see encode_alignment).
+    """
+
+    alleles: np.ndarray
+    ambiguous_position: np.ndarray
+    ambiguous_base: np.ndarray
+
+    @staticmethod
+    def from_characters(h):
+        """
+        Return the EncodedAlignment for the specified uppercase character array.
+        """
+        h = np.asarray(h).astype("S1")
+        alleles = _ENCODE_TABLE[h.view(np.uint8)]
+        return EncodedAlignment(alleles, *_ambiguous_bases(h, alleles))
+
+    @staticmethod
+    def frombytes(buff):
+        header = np.frombuffer(buff, dtype=np.uint32, count=2)
+        length, num_ambiguous = int(header[0]), int(header[1])
+        offset = header.nbytes
+        alleles = np.frombuffer(buff, dtype=np.int8, count=length, offset=offset)
+        offset += length
+        position = np.frombuffer(
+            buff, dtype=np.uint32, count=num_ambiguous, offset=offset
+        )
+        offset += position.nbytes
+        base = np.frombuffer(buff, dtype="S1", count=num_ambiguous, offset=offset)
+        return EncodedAlignment(alleles, position, base.astype(str))
+
+    def tobytes(self):
+        header = np.array([len(self.alleles), len(self.ambiguous_position)])
+        return b"".join(
+            [
+                header.astype(np.uint32).tobytes(),
+                self.alleles.astype(np.int8).tobytes(),
+                self.ambiguous_position.astype(np.uint32).tobytes(),
+                self.ambiguous_base.astype("S1").tobytes(),
+            ]
+        )
+
+    def __len__(self):
+        return len(self.alleles)
+
+    def haplotype(self, sites=None, out=None):
+        if sites is None:
+            sites = np.arange(len(self.alleles))
+        return np.take(self.alleles, sites, out=out)
+
+
+@dataclasses.dataclass
+class DeltaAlignment(AlignmentRecord):
+    """
+    An alignment represented as the sorted positions and alleles at which
+    it differs from the reference (see get_reference_alleles), along with
+    the runs of missing data.
+    """
+
+    length: int
+    diff_position: np.ndarray
+    diff_allele: np.ndarray
+    missing_start: np.ndarray
+    missing_length: np.ndarray
+    ambiguous_position: np.ndarray
+    ambiguous_base: np.ndarray
+
+    @staticmethod
+    def from_characters(h):
+        """
+        Return the DeltaAlignment for the specified uppercase character array.
+        """
+        h = np.asarray(h).astype("S1")
+        alleles = _ENCODE_TABLE[h.view(np.uint8)]
+        reference = get_reference_alleles()
+        if len(alleles) != len(reference):
+            raise ValueError(
+                f"Alignment length {len(alleles)} != reference length {len(reference)}"
+            )
+        missing = alleles == MISSING
+        diff_position = np.where((alleles != reference) & ~missing)[0]
+        boundaries = np.diff(np.concatenate([[0], missing.view(np.int8), [0]]))
+        missing_start = np.where(boundaries == 1)[0]
+        missing_end = np.where(boundaries == -1)[0]
+        return DeltaAlignment(
+            len(alleles),
+            diff_position.astype(np.uint32),
+            alleles[diff_position],
+            missing_start.astype(np.uint32),
+            (missing_end - missing_start).astype(np.uint32),
+            *_ambiguous_bases(h, alleles),
+        )
+
+    @staticmethod
+    def frombytes(buff):
+        header = np.frombuffer(buff, dtype=np.uint32, count=4)
+        length, num_diffs, num_runs, num_ambiguous = map(int, header)
+        offset = header.nbytes
+        arrays = []
+        for dtype, count in [
+            (np.uint32, num_diffs),
+            (np.uint32, num_runs),
+            (np.uint32, num_runs),
+            (np.uint32, num_ambiguous),
+            (np.int8, num_diffs),
+            ("S1", num_ambiguous),
+        ]:
+            a = np.frombuffer(buff, dtype=dtype, count=count, offset=offset)
+            offset += a.nbytes
+            arrays.append(a)
+        position, start, run_length, ambiguous_position, allele, base = arrays
+        return DeltaAlignment(
+            length,
+            position,
+            allele,
+            start,
+            run_length,
+            ambiguous_position,
+            base.astype(str),
+        )
+
+    def tobytes(self):
+        header = np.array(
+            [
+                self.length,
+                len(self.diff_position),
+                len(self.missing_start),
+                len(self.ambiguous_position),
+            ]
+        )
+        return b"".join(
+            [
+                header.astype(np.uint32).tobytes(),
+                self.diff_position.astype(np.uint32).tobytes(),
+                self.missing_start.astype(np.uint32).tobytes(),
+                self.missing_length.astype(np.uint32).tobytes(),
+                self.ambiguous_position.astype(np.uint32).tobytes(),
+                self.diff_allele.astype(np.int8).tobytes(),
+                self.ambiguous_base.astype("S1").tobytes(),
+            ]
+        )
+
+    def __len__(self):
+        return self.length
+
+    def haplotype(self, sites=None, out=None):
+        """
+        Return the encoded alleles at the specified sites (all sites by default)
+        as a new int8 array, or write them to the specified output array.
+        Only the reference alleles at the requested sites are copied; the
+        differences and missing runs are then located by binary search, so
+        the full alignment is never constructed.
+        """
+        reference = get_reference_alleles()
+        if sites is None:
+            if out is None:
+                out = np.empty(self.length, dtype=np.int8)
+            h = out
+            h[:] = reference[: self.length]
+            for start, length in zip(self.missing_start, self.missing_length):
+                h[start : start + length] = MISSING
+            h[self.diff_position] = self.diff_allele
+            return h
+        sites = np.asarray(sites)
+        h = np.take(reference, sites, out=out)
+        if len(self.missing_start) > 0:
+            run = np.searchsorted(self.missing_start, sites, side="right") - 1
+            in_run = run >= 0
+            run_end = self.missing_start[run] + self.missing_length[run]
+            in_run &= sites < run_end
+            h[in_run] = MISSING
+        if len(self.diff_position) > 0:
+            index = np.searchsorted(self.diff_position, sites)
+            index[index == len(self.diff_position)] = 0
+            found = self.diff_position[index] == sites
+            h[found] = self.diff_allele[index[found]]
+        return h
+
+
+ENCODINGS = {
+    "int8": EncodedAlignment,
+    "delta": DeltaAlignment,
+}
+
+
+SUMMARY_DTYPE = np.dtype(
+    [
+        ("num_A", np.uint32),
+        ("num_C", np.uint32),
+        ("num_G", np.uint32),
+        ("num_T", np.uint32),
+        ("num_deletions", np.uint32),
+        ("num_N", np.uint32),
+        ("num_ambiguous", np.uint32),
+        ("first_called", np.int32),
+        ("last_called", np.int32),
+    ]
+)
+
+
+def summarise_alignment(h):
+    """
+    Return the summary of the specified uppercase character array (including
+    the "X" prefix) as a SUMMARY_DTYPE record. Ambiguous bases are all
+    characters other than ACGTN-, and the first and last called positions
+    are those of the first and last sites that are not missing data (-1
+    if there are none).
+    """
+    h = np.asarray(h, dtype="S1")[1:]
+    alleles = _ENCODE_TABLE[h.view(np.uint8)]
+    counts = np.bincount(alleles + 1, minlength=len(core.ALLELES) + 1)
+    summary = np.zeros((), dtype=SUMMARY_DTYPE)
+    # The first five fields are the counts of the alleles, in order
+    for field, count in zip(SUMMARY_DTYPE.names, counts[1:]):
+        summary[field] = count
+    num_N = int(np.sum(h == b"N"))
+    summary["num_N"] = num_N
+    summary["num_ambiguous"] = counts[0] - num_N
+    called = np.flatnonzero(alleles != MISSING)
+    summary["first_called"] = -1 if len(called) == 0 else called[0] + 1
+    summary["last_called"] = -1 if len(called) == 0 else called[-1] + 1
+    return summary
+
+
+def num_missing_sites(summaries):
+    """
+    Return the number of sites with missing data (N or ambiguous) for the
+    specified array of summaries.
+    """
+    return summaries["num_N"].astype(np.int64) + summaries["num_ambiguous"]
+
+
+def compress_record(h, metadata, codec):
+    """
+    Return the stored value for the specified uppercase character array in
+    a store with the specified metadata and codec.
+    """
+    if metadata["format_version"] == 1:
+        return compress_alignment(h)
+    encoding = metadata.get("encoding", "int8")
+    record = ENCODINGS[encoding].from_characters(h)
+    return codec.compress(record.tobytes())
+
+
+def compress_records(records, metadata, codec):
+    """
+    Return the (key, value, summary) tuples to store for the specified list
+    of (name, alignment) pairs, where each alignment is an uppercase bytes
+    object including the "X" prefix used to make coordinates 1-based.
+    """
+    ret = []
+    for name, h in records:
+        h = np.frombuffer(h, dtype="S1")
+        value = compress_record(h, metadata, codec)
+        summary = summarise_alignment(h).tobytes()
+        ret.append((name.encode(), value, summary))
+    return ret
+
+
+def alignment_digest(h):
+    """
+    Return the digest of the specified uppercase alignment bytes, used to
+    detect alignments that have changed since they were last imported.
+    """
+    return hashlib.md5(h).digest()
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def train_alignment_dictionary(training_data, encoding):
+    """
+    Return a zstd compression dictionary trained on the specified list of
+    example alignments in the specified encoding.
+    """
+    samples = [
+        ENCODINGS[encoding].from_characters(np.char.upper(h)).tobytes()
+        for h in training_data
+    ]
+    return compression.train_dictionary(samples)
+
+
+def _export_zarr_worker(store_path, zarr_path, strains, sites, offset):
+    with open_alignment_store(store_path) as store:
+        H, missing = store.get_many(strains, sites)
+    genotypes = zarr.open_group(str(zarr_path), mode="r+")["genotypes"]
+    genotypes[:, offset : offset + len(strains)] = H.T
+    return [strain for strain, m in zip(strains, missing) if m]
+
+
 class AlignmentStore(collections.abc.Mapping):
     def __init__(self, path, mode="r"):
         map_size = 1024**4
         self.path = path
         readonly = mode == "r"
         self.env = lmdb.Environment(
-            str(path), subdir=False, readonly=readonly, map_size=map_size, lock=not readonly
+            str(path),
+            subdir=False,
+            readonly=readonly,
+            map_size=map_size,
+            lock=not readonly,
+            max_dbs=MAX_DBS,
+        )
+        self._open_databases(readonly)
+        logger.debug(
+            f"Opened AlignmentStore at {path} mode={mode} "
+            f"format_version={self.format_version}"
         )
-        logger.debug(f"Opened AlignmentStore at {path} mode={mode}")
+
+    def _open_databases(self, readonly):
+        try:
+            self.metadata_db = self.env.open_db(b"metadata", create=False)
+        except lmdb.NotFoundError:
+            self.metadata_db = None
+        if self.metadata_db is None and not readonly:
+            with self.env.begin() as txn:
+                is_empty = txn.stat()["entries"] == 0
+            if is_empty:
+                self._write_metadata(
+                    {
+                        "format_version": FORMAT_VERSION,
+                        "encoding": "int8",
+                        "codec": compression.Bz2Codec().asdict(),
+                    }
+                )
+        dictionary = None
+        if self.metadata_db is None:
+            self.metadata = {"format_version": 1}
+            self.alignments_db = self.env.open_db()
+        else:
+            with self.env.begin(db=self.metadata_db) as txn:
+                self.metadata = json.loads(txn.get(b"metadata"))
+                dictionary = txn.get(b"codec_dictionary")
+            self.alignments_db = self.env.open_db(b"alignments", create=not readonly)
+        # Content digests and per-file import manifests for incremental
+        # imports, and per-alignment summaries computed at import. These are
+        # not available for legacy stores, and may not exist in stores that
+        # have not been opened for writing since they were added.
+        self.hashes_db = None
+        self.manifest_db = None
+        self.summaries_db = None
+        if self.format_version > 1:
+            self.hashes_db = self._open_optional_db(b"hashes", readonly)
+            self.manifest_db = self._open_optional_db(b"manifest", readonly)
+            self.summaries_db = self._open_optional_db(b"summaries", readonly)
+        if self.format_version > FORMAT_VERSION:
+            raise ValueError(
+                f"AlignmentStore format version {self.format_version} not supported"
+            )
+        self.codec = compression.get_codec(self.metadata.get("codec"), dictionary)
+
+    def _open_optional_db(self, name, readonly):
+        try:
+            return self.env.open_db(name, create=not readonly)
+        except lmdb.NotFoundError:
+            return None
+
+    def _write_metadata(self, metadata, dictionary=None):
+        self.metadata_db = self.env.open_db(b"metadata")
+        with self.env.begin(write=True, db=self.metadata_db) as txn:
+            txn.put(b"metadata", json.dumps(metadata).encode())
+            if dictionary is not None:
+                txn.put(b"codec_dictionary", dictionary)
+
+    @property
+    def format_version(self):
+        return self.metadata["format_version"]
+
+    @property
+    def encoding(self):
+        if self.format_version == 1:
+            return None
+        return self.metadata.get("encoding", "int8")
+
+    @staticmethod
+    def initialise(
+        path, encoding="int8", codec="bz2", training_data=None, dictionary=None
+    ):
+        """
+        Create a new, empty AlignmentStore in the latest format at the specified
+        path, removing any existing file. Alignments are stored using the
+        specified encoding: either "int8" (the allele codes at every position)
+        or "delta" (the differences from the reference sequence), and
+        compressed with the specified codec ("bz2", "zstd" or "lz4").
+
+        For zstd, a list of example alignments can be provided as
+        training_data, which is used to train a compression dictionary.
+        Alternatively, a previously trained dictionary can be provided.
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown alignment encoding {encoding}")
+        if training_data is not None or dictionary is not None:
+            if codec != "zstd":
+                raise ValueError("Compression dictionaries require the zstd codec")
+        if training_data is not None:
+            dictionary = train_alignment_dictionary(training_data, encoding)
+        codec_config = {"name": codec, "has_dictionary": dictionary is not None}
+        codec = compression.get_codec(codec_config, dictionary)
+
+        path = pathlib.Path(path)
+        if path.exists():
+            path.unlink()
+        with AlignmentStore(path, "a") as store:
+            metadata = {
+                "format_version": FORMAT_VERSION,
+                "encoding": encoding,
+                "codec": codec.asdict(),
+            }
+            store._write_metadata(metadata, dictionary)
+        logger.info(f"Created new AlignmentStore at {path} {metadata}")
+        return AlignmentStore(path, "a")
 
     def __enter__(self):
         return self
@@ -61,10 +581,22 @@ class AlignmentStore(collections.abc.Mapping):
     def _flush(self, chunk):
         logger.debug(f"Flushing {len(chunk)} sequences")
         with self.env.begin(write=True) as txn:
-            for k, v in chunk:
-                txn.put(k.encode(), v)
+            for k, v, digest, summary in chunk:
+                txn.put(k.encode(), v, db=self.alignments_db)
+                if self.hashes_db is not None:
+                    txn.put(k.encode(), digest, db=self.hashes_db)
+                if self.summaries_db is not None:
+                    txn.put(k.encode(), summary, db=self.summaries_db)
         logger.debug("Done")
 
+    def _compress(self, h):
+        return compress_record(h, self.metadata, self.codec)
+
+    def _decompress(self, b):
+        if self.format_version == 1:
+            return EncodedAlignment.from_characters(decompress_alignment(b))
+        return ENCODINGS[self.encoding].frombytes(self.codec.decompress(b))
+
     def append(self, alignments, show_progress=False):
         n = len(alignments)
         chunk_size = 100
@@ -74,7 +606,9 @@ class AlignmentStore(collections.abc.Mapping):
         chunk = []
         for k, v in alignments.items():
             v = np.char.upper(v)
-            chunk.append((k, compress_alignment(v)))
+            digest = alignment_digest(v.astype("S1").tobytes())
+            summary = summarise_alignment(v).tobytes()
+            chunk.append((k, self._compress(v), digest, summary))
             if len(chunk) == chunk_size:
                 self._flush(chunk)
                 chunk = []
@@ -82,20 +616,846 @@ class AlignmentStore(collections.abc.Mapping):
         self._flush(chunk)
         bar.close()
 
-    def __getitem__(self, key):
+    def import_fasta(
+        self,
+        path,
+        *,
+        num_workers=0,
+        chunk_size=100,
+        transaction_size=10_000,
+        incremental=False,
+        records=None,
+        executor=None,
+        show_progress=False,
+    ):
+        """
+        Import all the alignments in the specified (optionally gzip compressed)
+        FASTA file. Records are streamed from the file in chunks, which are
+        encoded and compressed by a pool of num_workers processes (or
+        in this process if num_workers is 0). Results are written in the
+        order of the file, committing the LMDB transaction every
+        transaction_size alignments. Returns a Counter of the numbers of
+        "new", "changed" and "unchanged" alignments in the file, as
+        determined by the stored content digests (legacy stores do not
+        have digests, and so all alignments are counted as new).
+
+        If incremental is True, unchanged alignments are not rewritten, and
+        an interrupted import of the same file resumes after the last
+        committed transaction, as recorded in the file's import manifest
+        (see get_import_manifest). Files that have already been fully
+        imported are skipped, and all their alignments counted as unchanged.
+
+        If records is specified, these (name, sequence) pairs are imported
+        in place of the records read from the file, which still identifies
+        the import in the manifest (see ShardedAlignmentStore.import_fasta).
+        If executor is specified, records are compressed by it rather than
+        by a new pool of num_workers processes.
+        """
+        if incremental and self.manifest_db is None:
+            raise ValueError("Incremental import not supported by legacy stores")
+        path = pathlib.Path(path)
+        stat = path.stat()
+        manifest = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "num_records": 0,
+            "counts": {},
+            "complete": False,
+        }
+        if incremental:
+            previous = self.get_import_manifest(path)
+            if (
+                previous is not None
+                and previous["size"] == manifest["size"]
+                and previous["mtime_ns"] == manifest["mtime_ns"]
+            ):
+                if previous["complete"]:
+                    logger.info(f"Skipping {path}: already imported")
+                    num_imported = sum(previous["counts"].values())
+                    return collections.Counter(unchanged=num_imported)
+                manifest = previous
+                logger.info(
+                    f"Resuming import of {path} after {manifest['num_records']} records"
+                )
+        manifest_key = str(path.resolve()).encode()
+        counts = collections.Counter(manifest["counts"])
+        if records is None:
+            records = core.read_fasta(path)
+        records = itertools.islice(records, manifest["num_records"], None)
+        chunks = (
+            self._classify_records(chunk, incremental)
+            for chunk in _chunks(records, chunk_size)
+        )
+        bar = tqdm.tqdm(
+            desc="Import",
+            unit="seq",
+            unit_scale=True,
+            initial=manifest["num_records"],
+            disable=not show_progress,
+        )
+        before = time.perf_counter()
+        num_records = 0
+        num_bytes = 0
+        with contextlib.ExitStack() as stack:
+            if executor is None and num_workers > 0:
+                executor = stack.enter_context(cf.ProcessPoolExecutor(num_workers))
+            if executor is None:
+                results = (
+                    (n, compress_records(todo, self.metadata, self.codec), *rest)
+                    for n, todo, *rest in chunks
+                )
+            else:
+                max_pending = 2 * max(1, num_workers)
+                results = self._ordered_results(executor, chunks, max_pending)
+            chunks_per_transaction = max(1, transaction_size // chunk_size)
+            num_written = -1
+            while num_written != 0:
+                num_written = 0
+                with self.env.begin(write=True) as txn:
+                    batch = itertools.islice(results, chunks_per_transaction)
+                    for n, pairs, digests, chunk_counts in batch:
+                        for (key, value, summary), digest in zip(pairs, digests):
+                            txn.put(key, value, db=self.alignments_db)
+                            if self.hashes_db is not None:
+                                txn.put(key, digest, db=self.hashes_db)
+                            if self.summaries_db is not None:
+                                txn.put(key, summary, db=self.summaries_db)
+                            num_bytes += len(value)
+                        counts.update(chunk_counts)
+                        num_written += n
+                        bar.update(n)
+                    manifest["num_records"] += num_written
+                    manifest["counts"] = dict(counts)
+                    manifest["complete"] = num_written == 0
+                    if self.manifest_db is not None:
+                        value = json.dumps(manifest).encode()
+                        txn.put(manifest_key, value, db=self.manifest_db)
+                num_records += num_written
+                logger.debug(f"Committed at {manifest['num_records']} alignments")
+        bar.close()
+        duration = time.perf_counter() - before
+        rate = num_records / max(duration, 1e-9)
+        logger.info(
+            f"Imported {num_records} alignments from {path} in {duration:.1f}s "
+            f"({rate:.1f} alignments/s; "
+            f"stored={humanize.naturalsize(num_bytes, binary=True)}); "
+            f"new={counts['new']} changed={counts['changed']} "
+            f"unchanged={counts['unchanged']}"
+        )
+        return counts
+
+    def _classify_records(self, records, incremental):
+        # Returns the records that need to be written, along with their
+        # digests and the counts of new, changed and unchanged records.
+        counts = collections.Counter()
+        todo = []
+        digests = []
         with self.env.begin() as txn:
+            for name, sequence in records:
+                h = b"X" + sequence.upper()
+                digest = alignment_digest(h)
+                previous = None
+                if self.hashes_db is not None:
+                    previous = txn.get(name.encode(), db=self.hashes_db)
+                if previous is None:
+                    counts["new"] += 1
+                elif previous != digest:
+                    counts["changed"] += 1
+                else:
+                    counts["unchanged"] += 1
+                    if incremental:
+                        continue
+                todo.append((name, h))
+                digests.append(digest)
+        return len(records), todo, digests, counts
+
+    def _ordered_results(self, executor, chunks, max_pending):
+        pending = collections.deque()
+        for n, todo, *rest in chunks:
+            future = executor.submit(compress_records, todo, self.metadata, self.codec)
+            pending.append((n, future, *rest))
+            if len(pending) >= max_pending:
+                n, future, *rest = pending.popleft()
+                yield (n, future.result(), *rest)
+        while len(pending) > 0:
+            n, future, *rest = pending.popleft()
+            yield (n, future.result(), *rest)
+
+    def get_import_manifest(self, path):
+        """
+        Return the import manifest recorded for the specified FASTA file, or
+        None if it has not been imported.
+        """
+        if self.manifest_db is None:
+            return None
+        key = str(pathlib.Path(path).resolve()).encode()
+        with self.env.begin(db=self.manifest_db) as txn:
+            value = txn.get(key)
+        return None if value is None else json.loads(value)
+
+    def get_encoded(self, key):
+        """
+        Return the AlignmentRecord for the specified strain.
+        """
+        with self.env.begin(db=self.alignments_db) as txn:
             val = txn.get(key.encode())
             if val is None:
                 raise KeyError(f"{key} not found")
-            return decompress_alignment(val)
+            return self._decompress(val)
+
+    def get_many(self, strains, keep_sites=None, encoded=True, composition=False):
+        """
+        Return the alignments for the specified strains at the specified sites
+        (all sites by default) as a (num_strains, num_sites) matrix, along with
+        a boolean array marking the strains that are not in the store. The
+        matrix contains int8 allele codes if encoded is True, and the original
+        characters otherwise; rows for missing strains are entirely missing
+        data. All alignments are read within a single transaction, in key
+        order.
+
+        If composition is True, also return a list of the composition
+        Counters at the specified sites for each strain (None for missing
+        strains).
+        """
+        if keep_sites is None:
+            num_sites = core.REFERENCE_SEQUENCE_LENGTH
+        else:
+            keep_sites = np.asarray(keep_sites)
+            num_sites = len(keep_sites)
+        n = len(strains)
+        H = np.full((n, num_sites), MISSING, dtype=np.int8)
+        missing = np.ones(n, dtype=bool)
+        compositions = [None] * n
+        decoded = None if encoded else np.full((n, num_sites), "N", dtype="U1")
+        keys = [strain.encode() for strain in strains]
+        order = sorted(range(n), key=lambda j: keys[j])
+        with self.env.begin(db=self.alignments_db) as txn:
+            with txn.cursor() as cursor:
+                for j in order:
+                    if not cursor.set_key(keys[j]):
+                        continue
+                    record = self._decompress(cursor.value())
+                    if keep_sites is None and len(record) != num_sites:
+                        raise ValueError(
+                            f"Alignment for {strains[j]} has length {len(record)}"
+                        )
+                    record.haplotype(keep_sites, out=H[j])
+                    missing[j] = False
+                    if composition:
+                        compositions[j] = record.composition(keep_sites, H[j])
+                    if not encoded:
+                        decoded[j] = record.decode(keep_sites)
+        ret = (H if encoded else decoded, missing)
+        if composition:
+            ret += (compositions,)
+        return ret
+
+    def get_summaries(self, strains=None):
+        """
+        Return the summaries computed at import (see summarise_alignment)
+        for the specified strains as a SUMMARY_DTYPE array, along with a
+        boolean array marking the strains that have no summary, either
+        because they are not in the store or because they were imported
+        before summaries were computed (see update_summaries). If strains
+        is None, return the summaries for all strains in key order.
+        """
+        if strains is None:
+            values = []
+            if self.summaries_db is not None:
+                with self.env.begin(db=self.summaries_db) as txn:
+                    with txn.cursor() as cursor:
+                        values = list(cursor.iternext(keys=False, values=True))
+            summaries = np.frombuffer(b"".join(values), dtype=SUMMARY_DTYPE)
+            return summaries.copy(), np.zeros(len(summaries), dtype=bool)
+        n = len(strains)
+        summaries = np.zeros(n, dtype=SUMMARY_DTYPE)
+        summaries["first_called"] = -1
+        summaries["last_called"] = -1
+        missing = np.ones(n, dtype=bool)
+        if self.summaries_db is None:
+            return summaries, missing
+        keys = [strain.encode() for strain in strains]
+        order = sorted(range(n), key=lambda j: keys[j])
+        with self.env.begin(db=self.summaries_db) as txn:
+            with txn.cursor() as cursor:
+                for j in order:
+                    if cursor.set_key(keys[j]):
+                        summaries[j] = np.frombuffer(cursor.value(), SUMMARY_DTYPE)[0]
+                        missing[j] = False
+        return summaries, missing
+
+    def update_summaries(self, show_progress=False):
+        """
+        Compute the summaries for any alignments that do not have one,
+        returning the number of summaries computed.
+        """
+        if self.summaries_db is None:
+            raise ValueError("Summaries not supported by legacy stores")
+        num_updated = 0
+        with self.env.begin(write=True) as txn:
+            with txn.cursor(db=self.alignments_db) as cursor:
+                for key, value in tqdm.tqdm(cursor, disable=not show_progress):
+                    if txn.get(key, db=self.summaries_db) is None:
+                        h = self._decompress(value).decode()
+                        summary = summarise_alignment(h).tobytes()
+                        txn.put(key, summary, db=self.summaries_db)
+                        num_updated += 1
+        logger.info(f"Computed {num_updated} alignment summaries")
+        return num_updated
+
+    def export_zarr(
+        self,
+        path,
+        *,
+        strains=None,
+        sites=None,
+        samples_chunk_size=1000,
+        sites_chunk_size=10_000,
+        num_workers=0,
+        show_progress=False,
+    ):
+        """
+        Write the encoded alignments for the specified strains (all strains
+        by default) at the specified sites (all sites by default) to a zarr
+        group at the specified path, and return the corresponding
+        AlignmentMatrix. Chunks of samples_chunk_size strains are read from
+        the store and written by a pool of num_workers processes (or in this
+        process if num_workers is 0). Ambiguous bases are stored as missing
+        data.
+        """
+        if strains is None:
+            strains = list(self)
+        if sites is None:
+            sites = np.arange(1, core.REFERENCE_SEQUENCE_LENGTH)
+        sites = np.asarray(sites, dtype=np.int32)
+        if np.any(np.diff(sites) <= 0):
+            raise ValueError("Sites must be sorted and unique")
+        root = zarr.open_group(str(path), mode="w")
+        root.attrs["format_version"] = ALIGNMENT_MATRIX_FORMAT_VERSION
+        root.array("strain", np.array(strains, dtype=object), dtype=str)
+        root.array("site_position", sites)
+        root.zeros(
+            "genotypes",
+            shape=(len(sites), len(strains)),
+            chunks=(sites_chunk_size, samples_chunk_size),
+            dtype=np.int8,
+            compressor=numcodecs.Blosc(
+                cname="zstd", clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE
+            ),
+        )
+        offsets = range(0, len(strains), samples_chunk_size)
+        work = [
+            (self.path, path, strains[j : j + samples_chunk_size], sites, j)
+            for j in offsets
+        ]
+        bar = tqdm.tqdm(
+            total=len(strains), desc="Export", unit="seq", disable=not show_progress
+        )
+        with contextlib.ExitStack() as stack:
+            if num_workers == 0:
+                results = (_export_zarr_worker(*args) for args in work)
+            else:
+                executor = stack.enter_context(cf.ProcessPoolExecutor(num_workers))
+                results = executor.map(_export_zarr_worker, *zip(*work))
+            for args, missing in zip(work, results):
+                if len(missing) > 0:
+                    raise KeyError(f"{missing[0]} not found")
+                bar.update(len(args[2]))
+        bar.close()
+        logger.info(f"Exported {len(strains)} alignments at {len(sites)} sites")
+        return AlignmentMatrix(path)
+
+    def __getitem__(self, key):
+        return self.get_encoded(key).decode()
 
     def __iter__(self):
-        with self.env.begin() as txn:
-            cursor = txn.cursor()
+        with self.env.begin(db=self.alignments_db) as txn:
             with txn.cursor() as cursor:
                 for key in cursor.iternext(keys=True, values=False):
                     yield key.decode()
 
     def __len__(self):
         with self.env.begin() as txn:
-            return txn.stat()["entries"]
+            return txn.stat(self.alignments_db)["entries"]
+
+
+class AlignmentMatrix(collections.abc.Mapping):
+    """
+    Read-only columnar view of encoded alignments exported to a zarr group
+    by AlignmentStore.export_zarr. The genotypes array is a (num_sites,
+    num_samples) int8 matrix of allele codes, chunked in both dimensions,
+    so that bulk analyses can read contiguous slabs of sites and samples.
+    The mapping interface maps strains to their haplotypes at the exported
+    sites.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = zarr.open_group(str(path), mode="r")
+        format_version = self.root.attrs.get("format_version")
+        if format_version != ALIGNMENT_MATRIX_FORMAT_VERSION:
+            raise ValueError(f"AlignmentMatrix format version {format_version}")
+        self.genotypes = self.root["genotypes"]
+        self.strains = self.root["strain"][:]
+        self.sites_position = self.root["site_position"][:]
+        self._strain_index = {strain: j for j, strain in enumerate(self.strains)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return (
+            f"AlignmentMatrix at {self.path} contains {self.num_samples} alignments "
+            f"at {self.num_sites} sites"
+        )
+
+    @property
+    def num_samples(self):
+        return self.genotypes.shape[1]
+
+    @property
+    def num_sites(self):
+        return self.genotypes.shape[0]
+
+    def site_index(self, sites):
+        """
+        Return the indexes of the specified site positions, raising a
+        KeyError if any were not exported.
+        """
+        sites = np.asarray(sites)
+        index = np.searchsorted(self.sites_position, sites)
+        index[index == self.num_sites] = 0
+        found = self.sites_position[index] == sites
+        if not np.all(found):
+            raise KeyError(f"Site {sites[~found][0]} not exported")
+        return index
+
+    def get_genotypes(self, strains=None, sites=None, num_workers=0):
+        """
+        Return the (num_sites, num_strains) matrix of allele codes for the
+        specified strains and site positions (all by default). Strains not
+        in the matrix raise a KeyError. Sample chunks are read by
+        num_workers threads (or in this thread if num_workers is 0).
+        """
+        if strains is None:
+            columns = np.arange(self.num_samples)
+        else:
+            columns = np.array(
+                [self._strain_index[strain] for strain in strains], dtype=int
+            )
+        rows = slice(None) if sites is None else self.site_index(sites)
+        if num_workers == 0:
+            return self.genotypes.get_orthogonal_selection((rows, columns))
+        num_sites = self.num_sites if sites is None else len(rows)
+        G = np.empty((num_sites, len(columns)), dtype=np.int8)
+        # Read the requested columns grouped by sample chunk, so that each
+        # thread decompresses a disjoint set of chunks.
+        chunk_index = columns // self.genotypes.chunks[1]
+        groups = [np.where(chunk_index == j)[0] for j in np.unique(chunk_index)]
+
+        def read(group):
+            G[:, group] = self.genotypes.get_orthogonal_selection(
+                (rows, columns[group])
+            )
+
+        with cf.ThreadPoolExecutor(num_workers) as executor:
+            list(executor.map(read, groups))
+        return G
+
+    def get_many(self, strains, keep_sites=None):
+        """
+        Return the haplotypes for the specified strains at the specified
+        sites (all exported sites by default) as a (num_strains, num_sites)
+        matrix, along with a boolean array marking the strains that are not
+        in the matrix, as for AlignmentStore.get_many.
+        """
+        missing = np.array([strain not in self._strain_index for strain in strains])
+        present = [strain for strain, m in zip(strains, missing) if not m]
+        G = self.get_genotypes(present, keep_sites)
+        H = np.full((len(strains), G.shape[0]), MISSING, dtype=np.int8)
+        H[~missing] = G.T
+        return H, missing
+
+    def __getitem__(self, strain):
+        return self.genotypes[:, self._strain_index[strain]]
+
+    def __contains__(self, strain):
+        return strain in self._strain_index
+
+    def __iter__(self):
+        return iter(self.strains)
+
+    def __len__(self):
+        return self.num_samples
+
+
+def strain_shard(strain, num_shards):
+    """
+    Return the index of the shard that the specified strain is stored in,
+    using a hash that is stable across processes and Python versions.
+    """
+    digest = hashlib.md5(strain.encode()).digest()
+    return int.from_bytes(digest[:8], "little") % num_shards
+
+
+# Maximum number of records waiting to be imported into each shard
+SHARD_QUEUE_SIZE = 100
+
+
+def _import_shard(store, fasta_path, records_queue, **kwargs):
+    # Import the records from the queue, up to the None sentinel, into the
+    # specified shard. The queue is always drained, so that the reader is
+    # not blocked if the import stops early (because the file has already
+    # been imported, or on error).
+    records = iter(records_queue.get, None)
+    try:
+        return store.import_fasta(fasta_path, records=records, **kwargs)
+    finally:
+        for _ in records:
+            pass
+
+
+def open_alignment_store(path, mode="r"):
+    """
+    Open the AlignmentStore or ShardedAlignmentStore at the specified path.
+    """
+    if pathlib.Path(path).is_dir():
+        return ShardedAlignmentStore(path, mode)
+    return AlignmentStore(path, mode)
+
+
+class ShardedAlignmentStore(collections.abc.Mapping):
+    """
+    An alignment store split across a directory of AlignmentStore shards,
+    with strains assigned to shards by hashing (see strain_shard). Shards
+    are opened lazily, so that processes only open the shards they read,
+    and can be kept on different disks (via symlinks) or distributed
+    separately.
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(pathlib.Path(path) / "shards.json") as f:
+            self.metadata = json.load(f)
+        if self.metadata["format_version"] > SHARDED_FORMAT_VERSION:
+            raise ValueError(
+                "ShardedAlignmentStore format version "
+                f"{self.metadata['format_version']} not supported"
+            )
+        self.num_shards = self.metadata["num_shards"]
+        self.shard_paths = [
+            pathlib.Path(path) / f"shard_{j:04d}.db" for j in range(self.num_shards)
+        ]
+        self._shards = [None] * self.num_shards
+
+    @staticmethod
+    def initialise(
+        path,
+        num_shards,
+        encoding="int8",
+        codec="bz2",
+        training_data=None,
+        dictionary=None,
+    ):
+        """
+        Create a new, empty ShardedAlignmentStore with the specified number
+        of shards in the directory at the specified path, removing any
+        existing sharded store. The remaining arguments are passed to
+        AlignmentStore.initialise for each shard, with any compression
+        dictionary trained once and shared by all shards.
+        """
+        if num_shards < 1:
+            raise ValueError("Must have at least one shard")
+        path = pathlib.Path(path)
+        if (path / "shards.json").exists():
+            shutil.rmtree(path)
+        elif path.exists() and any(path.iterdir()):
+            raise ValueError(f"{path} exists and is not a sharded alignment store")
+        if training_data is not None and codec == "zstd":
+            dictionary = train_alignment_dictionary(training_data, encoding)
+            training_data = None
+        path.mkdir(parents=True, exist_ok=True)
+        for j in range(num_shards):
+            store = AlignmentStore.initialise(
+                path / f"shard_{j:04d}.db",
+                encoding=encoding,
+                codec=codec,
+                training_data=training_data,
+                dictionary=dictionary,
+            )
+            store.close()
+        metadata = {
+            "format_version": SHARDED_FORMAT_VERSION,
+            "num_shards": num_shards,
+            "encoding": encoding,
+        }
+        with open(path / "shards.json", "w") as f:
+            json.dump(metadata, f)
+        logger.info(f"Created new ShardedAlignmentStore at {path} {metadata}")
+        return ShardedAlignmentStore(path, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        for j, store in enumerate(self._shards):
+            if store is not None:
+                store.close()
+                self._shards[j] = None
+
+    def __str__(self):
+        return (
+            f"ShardedAlignmentStore at {self.path} contains {len(self)} "
+            f"alignments in {self.num_shards} shards"
+        )
+
+    @property
+    def encoding(self):
+        return self.metadata["encoding"]
+
+    def shard(self, j):
+        """
+        Return the AlignmentStore for the specified shard, opening it if
+        necessary.
+        """
+        if self._shards[j] is None:
+            self._shards[j] = AlignmentStore(self.shard_paths[j], self.mode)
+        return self._shards[j]
+
+    def _group_by_shard(self, strains):
+        groups = collections.defaultdict(list)
+        for j, strain in enumerate(strains):
+            groups[strain_shard(strain, self.num_shards)].append(j)
+        return groups
+
+    def append(self, alignments, show_progress=False):
+        groups = collections.defaultdict(dict)
+        for k, v in alignments.items():
+            groups[strain_shard(k, self.num_shards)][k] = v
+        for j, shard_alignments in groups.items():
+            self.shard(j).append(shard_alignments, show_progress=show_progress)
+
+    def import_fasta(self, path, *, num_workers=0, show_progress=False, **kwargs):
+        """
+        Import all the alignments in the specified FASTA file, returning the
+        total counts of new, changed and unchanged alignments. The file is
+        read once, with each record passed to a writer thread for its shard,
+        so that the shards are written in parallel. Records are compressed
+        by a pool of num_workers processes shared by all shards (or by the
+        writer threads if num_workers is 0). Other arguments are passed to
+        AlignmentStore.import_fasta.
+        """
+        if self.mode == "r":
+            raise ValueError("Store not opened for writing")
+        stores = [self.shard(j) for j in range(self.num_shards)]
+        queues = [queue.Queue(SHARD_QUEUE_SIZE) for _ in range(self.num_shards)]
+        bar = tqdm.tqdm(
+            desc="Import", unit="seq", unit_scale=True, disable=not show_progress
+        )
+        counts = collections.Counter()
+        with contextlib.ExitStack() as stack:
+            executor = None
+            if num_workers > 0:
+                # The pool is first used from the writer threads, and forking
+                # a multithreaded process isn't safe.
+                executor = stack.enter_context(
+                    cf.ProcessPoolExecutor(
+                        num_workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                )
+            writers = stack.enter_context(cf.ThreadPoolExecutor(self.num_shards))
+            futures = [
+                writers.submit(
+                    _import_shard,
+                    store,
+                    path,
+                    records_queue,
+                    num_workers=num_workers,
+                    executor=executor,
+                    **kwargs,
+                )
+                for store, records_queue in zip(stores, queues)
+            ]
+            try:
+                for name, sequence in core.read_fasta(path):
+                    queues[strain_shard(name, self.num_shards)].put((name, sequence))
+                    bar.update()
+            finally:
+                for records_queue in queues:
+                    records_queue.put(None)
+            for future in futures:
+                counts.update(future.result())
+        bar.close()
+        logger.info(f"Imported {path} into {self.num_shards} shards: {dict(counts)}")
+        return counts
+
+    def get_encoded(self, key):
+        return self.shard(strain_shard(key, self.num_shards)).get_encoded(key)
+
+    def get_many(self, strains, keep_sites=None, encoded=True, composition=False):
+        """
+        Return the alignments for the specified strains, reading each shard
+        in turn. See AlignmentStore.get_many for details.
+        """
+        num_sites = core.REFERENCE_SEQUENCE_LENGTH
+        if keep_sites is not None:
+            num_sites = len(keep_sites)
+        n = len(strains)
+        if encoded:
+            H = np.full((n, num_sites), MISSING, dtype=np.int8)
+        else:
+            H = np.full((n, num_sites), "N", dtype="U1")
+        missing = np.ones(n, dtype=bool)
+        compositions = [None] * n
+        for j, rows in self._group_by_shard(strains).items():
+            ret = self.shard(j).get_many(
+                [strains[k] for k in rows], keep_sites, encoded, composition
+            )
+            H[rows] = ret[0]
+            missing[rows] = ret[1]
+            if composition:
+                for k, c in zip(rows, ret[2]):
+                    compositions[k] = c
+        ret = (H, missing)
+        if composition:
+            ret += (compositions,)
+        return ret
+
+    def get_summaries(self, strains=None):
+        """
+        Return the summaries for the specified strains (all strains, in
+        iteration order, by default). See AlignmentStore.get_summaries.
+        """
+        if strains is None:
+            summaries = [
+                self.shard(j).get_summaries()[0] for j in range(self.num_shards)
+            ]
+            summaries = np.concatenate(summaries)
+            return summaries, np.zeros(len(summaries), dtype=bool)
+        summaries = np.zeros(len(strains), dtype=SUMMARY_DTYPE)
+        summaries["first_called"] = -1
+        summaries["last_called"] = -1
+        missing = np.ones(len(strains), dtype=bool)
+        for j, rows in self._group_by_shard(strains).items():
+            shard_summaries, shard_missing = self.shard(j).get_summaries(
+                [strains[k] for k in rows]
+            )
+            summaries[rows] = shard_summaries
+            missing[rows] = shard_missing
+        return summaries, missing
+
+    def update_summaries(self, show_progress=False):
+        return sum(
+            self.shard(j).update_summaries(show_progress)
+            for j in range(self.num_shards)
+        )
+
+    def export_zarr(self, path, **kwargs):
+        return AlignmentStore.export_zarr(self, path, **kwargs)
+
+    def __getitem__(self, key):
+        return self.get_encoded(key).decode()
+
+    def __contains__(self, key):
+        return key in self.shard(strain_shard(key, self.num_shards))
+
+    def __iter__(self):
+        for j in range(self.num_shards):
+            yield from self.shard(j)
+
+    def __len__(self):
+        return sum(len(self.shard(j)) for j in range(self.num_shards))
+
+
+def reshard(source_path, dest_path, num_shards, show_progress=False):
+    """
+    Copy the alignment store (sharded or not) at source_path to a new
+    ShardedAlignmentStore with the specified number of shards at
+    dest_path. Stored values are copied without recompression, except for
+    legacy stores and shards whose encoding or codec (including any zstd
+    dictionary) differs from the first, which are decoded and re-encoded.
+    """
+    with open_alignment_store(source_path) as source:
+        if isinstance(source, ShardedAlignmentStore):
+            stores = [source.shard(j) for j in range(source.num_shards)]
+        else:
+            stores = [source]
+        first = stores[0]
+        dictionary = None
+        codec = "bz2"
+        if first.format_version > 1:
+            codec = first.codec.name
+            dictionary = getattr(first.codec, "dictionary", None)
+        dest = ShardedAlignmentStore.initialise(
+            dest_path,
+            num_shards,
+            encoding=first.encoding or "int8",
+            codec=codec,
+            dictionary=dictionary,
+        )
+        with dest:
+            bar = tqdm.tqdm(
+                total=len(source), desc="Reshard", disable=not show_progress
+            )
+            for store in stores:
+                if not _same_codec(store, dest.shard(0)):
+                    for chunk in _chunks(store, 100):
+                        dest.append({k: store[k] for k in chunk})
+                        bar.update(len(chunk))
+                else:
+                    _copy_shard_values(store, dest, bar)
+            bar.close()
+            num_alignments = len(dest)
+    logger.info(f"Resharded {num_alignments} alignments into {num_shards} shards")
+    return ShardedAlignmentStore(dest_path)
+
+
+def _same_codec(store, other):
+    # Stored values can only be copied verbatim if they were encoded and
+    # compressed identically, which for zstd includes the dictionary bytes.
+    if store.format_version == 1:
+        return False
+    return (
+        store.encoding,
+        store.codec.asdict(),
+        getattr(store.codec, "dictionary", None),
+    ) == (
+        other.encoding,
+        other.codec.asdict(),
+        getattr(other.codec, "dictionary", None),
+    )
+
+
+def _copy_shard_values(store, dest, bar):
+    dbs = {"alignments": store.alignments_db}
+    for name in ["hashes", "summaries"]:
+        db = getattr(store, f"{name}_db")
+        if db is not None:
+            dbs[name] = db
+    with store.env.begin() as txn:
+        for name, db in dbs.items():
+            with txn.cursor(db=db) as cursor:
+                for chunk in _chunks(cursor, 1000):
+                    groups = collections.defaultdict(list)
+                    for key, value in chunk:
+                        groups[strain_shard(key.decode(), dest.num_shards)].append(
+                            (key, value)
+                        )
+                    for j, items in groups.items():
+                        shard = dest.shard(j)
+                        dest_db = getattr(shard, f"{name}_db")
+                        with shard.env.begin(write=True, db=dest_db) as dest_txn:
+                            for key, value in items:
+                                dest_txn.put(key, value)
+                    if name == "alignments":
+                        bar.update(len(chunk))
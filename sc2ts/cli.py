@@ -52,6 +52,31 @@ deletions_as_missing = click.option(
     show_default=True,
 )
 
+hmm_cache = click.option(
+    "--hmm-cache",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Reuse HMM matches stored in this cache file, creating it if needed",
+)
+hmm_cache_size = click.option(
+    "--hmm-cache-size",
+    default=sc2ts.DEFAULT_HMM_CACHE_SIZE,
+    show_default=True,
+    type=int,
+    help="Maximum total size in bytes of the matches kept in the HMM cache",
+)
+
+
+def open_hmm_cache(path, max_size):
+    """
+    Return a context manager for the HmmCache at the specified path, which
+    is None if path is None.
+    """
+    if path is None:
+        return contextlib.nullcontext()
+    return sc2ts.HmmCache(path, max_size)
+
+
 __before = time.time()
 
 
@@ -161,55 +186,298 @@ def setup_logging(verbosity, log_file=None):
 
 # TODO add options to list keys, dump specific alignments etc
 @click.command()
-@click.argument("store", type=click.Path(exists=True, dir_okay=False))
+@click.argument("store", type=click.Path(exists=True))
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
 def info_alignments(store, verbose, log_file):
     """
-    Information about an alignment store
+    Information about an alignment store, including the distributions of
+    the alignment summaries computed at import.
     """
     setup_logging(verbose, log_file)
-    with sc2ts.AlignmentStore(store) as alignment_store:
+    with sc2ts.open_alignment_store(store) as alignment_store:
         print(alignment_store)
+        summaries, _ = alignment_store.get_summaries()
+    if len(summaries) > 0:
+        df = pd.DataFrame(summaries)
+        df["num_missing"] = sc2ts.alignments.num_missing_sites(summaries)
+        print(df.describe().to_string())
 
 
 @click.command()
-@click.argument("store", type=click.Path(dir_okay=False, file_okay=True))
+@click.argument("store", type=click.Path())
 @click.argument("fastas", type=click.Path(exists=True, dir_okay=False), nargs=-1)
 @click.option("-i", "--initialise", default=False, type=bool, help="Initialise store")
+@click.option(
+    "--encoding",
+    type=click.Choice(["int8", "delta"]),
+    default="int8",
+    show_default=True,
+    help=(
+        "Encoding used for alignments when initialising the store: "
+        "int8 allele codes, or differences from the reference"
+    ),
+)
+@click.option(
+    "--codec",
+    type=click.Choice(["bz2", "zstd", "lz4"]),
+    default="bz2",
+    show_default=True,
+    help="Compression codec used for alignments when initialising the store",
+)
+@click.option(
+    "--dictionary-samples",
+    default=0,
+    type=int,
+    help=(
+        "Number of alignments from the first FASTA used to train a zstd "
+        "compression dictionary when initialising the store"
+    ),
+)
+@click.option(
+    "--num-shards",
+    default=0,
+    type=int,
+    help=(
+        "Number of shards when initialising the store, which is then a "
+        "directory of shards (default to a single unsharded file)"
+    ),
+)
+@click.option(
+    "--num-workers",
+    default=0,
+    type=int,
+    help="Number of worker processes used to encode alignments (default to none)",
+)
+@click.option(
+    "--transaction-size",
+    default=10_000,
+    show_default=True,
+    type=int,
+    help="Number of alignments written in each database transaction",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help=(
+        "Skip unchanged alignments and already imported files, resuming "
+        "interrupted imports"
+    ),
+)
 @click.option("--no-progress", default=False, type=bool, help="Don't show progress")
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
-def import_alignments(store, fastas, initialise, no_progress, verbose, log_file):
+def import_alignments(
+    store,
+    fastas,
+    initialise,
+    encoding,
+    codec,
+    dictionary_samples,
+    num_shards,
+    num_workers,
+    transaction_size,
+    incremental,
+    no_progress,
+    verbose,
+    log_file,
+):
     """
-    Import the alignments from all FASTAS into STORE.
+    Import the alignments from all FASTAS (which may be gzip compressed)
+    into STORE, printing the numbers of new, changed and unchanged
+    alignments in each file.
     """
     setup_logging(verbose, log_file)
     if initialise:
-        a = sc2ts.AlignmentStore.initialise(store)
+        training_data = None
+        if dictionary_samples > 0:
+            records = core.read_fasta(fastas[0])
+            training_data = [
+                np.frombuffer(b"X" + sequence, dtype="S1").astype(str)
+                for _, sequence in itertools.islice(records, dictionary_samples)
+            ]
+        if num_shards > 0:
+            a = sc2ts.ShardedAlignmentStore.initialise(
+                store,
+                num_shards,
+                encoding=encoding,
+                codec=codec,
+                training_data=training_data,
+            )
+        else:
+            a = sc2ts.AlignmentStore.initialise(
+                store, encoding=encoding, codec=codec, training_data=training_data
+            )
     else:
-        a = sc2ts.AlignmentStore(store, "a")
+        a = sc2ts.open_alignment_store(store, "a")
     for fasta_path in fastas:
-        logging.info(f"Reading fasta {fasta_path}")
-        fasta = core.FastaReader(fasta_path)
-        a.append(fasta, show_progress=True)
+        logger.info(f"Reading fasta {fasta_path}")
+        counts = a.import_fasta(
+            fasta_path,
+            num_workers=num_workers,
+            transaction_size=transaction_size,
+            incremental=incremental,
+            show_progress=not no_progress,
+        )
+        click.echo(
+            f"{fasta_path}\tnew={counts['new']}\tchanged={counts['changed']}"
+            f"\tunchanged={counts['unchanged']}"
+        )
     a.close()
 
 
+@click.command()
+@click.argument("store", type=click.Path(exists=True))
+@click.argument("output", type=click.Path(file_okay=False))
+@click.option(
+    "--strains",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="File of strains to export, one per line (default to all)",
+)
+@click.option(
+    "--samples-chunk-size",
+    default=1000,
+    show_default=True,
+    type=int,
+    help="Number of samples in each zarr chunk",
+)
+@click.option(
+    "--sites-chunk-size",
+    default=10_000,
+    show_default=True,
+    type=int,
+    help="Number of sites in each zarr chunk",
+)
+@click.option(
+    "--num-workers",
+    default=0,
+    type=int,
+    help="Number of worker processes used to export chunks (default to none)",
+)
+@click.option("--no-progress", default=False, type=bool, help="Don't show progress")
+@click.option("-v", "--verbose", count=True)
+@click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
+def export_alignment_matrix(
+    store,
+    output,
+    strains,
+    samples_chunk_size,
+    sites_chunk_size,
+    num_workers,
+    no_progress,
+    verbose,
+    log_file,
+):
+    """
+    Export the encoded alignments in STORE to a sites by samples zarr
+    matrix at OUTPUT, for bulk analyses.
+    """
+    setup_logging(verbose, log_file)
+    if strains is not None:
+        with open(strains) as f:
+            strains = [line.strip() for line in f if len(line.strip()) > 0]
+    with sc2ts.open_alignment_store(store) as alignment_store:
+        matrix = alignment_store.export_zarr(
+            output,
+            strains=strains,
+            samples_chunk_size=samples_chunk_size,
+            sites_chunk_size=sites_chunk_size,
+            num_workers=num_workers,
+            show_progress=not no_progress,
+        )
+    print(matrix)
+
+
+@click.command()
+@click.argument("source", type=click.Path(exists=True))
+@click.argument("dest", type=click.Path(file_okay=False))
+@click.option("--num-shards", required=True, type=int, help="Number of shards")
+@click.option("--no-progress", default=False, type=bool, help="Don't show progress")
+@click.option("-v", "--verbose", count=True)
+@click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
+def reshard_alignments(source, dest, num_shards, no_progress, verbose, log_file):
+    """
+    Copy the alignment store SOURCE (sharded or not) to a new sharded store
+    DEST with the specified number of shards.
+    """
+    setup_logging(verbose, log_file)
+    store = sc2ts.reshard(source, dest, num_shards, show_progress=not no_progress)
+    print(store)
+
+
 @click.command()
 @click.argument("metadata")
 @click.argument("db")
+@click.option(
+    "--chunk-size",
+    default=100_000,
+    show_default=True,
+    type=int,
+    help="Number of rows read and inserted at a time",
+)
+@click.option(
+    "--index",
+    "indexes",
+    multiple=True,
+    help=(
+        "Comma separated list of columns to create an index on (may be "
+        "repeated). For example, Viridian_pangolin,date"
+    ),
+)
+@click.option(
+    "--lineage-column",
+    default=sc2ts.DEFAULT_LINEAGE_COLUMN,
+    show_default=True,
+    help="Column to pre-aggregate lineage counts by date for",
+)
+@click.option("--no-progress", default=False, type=bool, help="Don't show progress")
 @click.option("-v", "--verbose", count=True)
-def import_metadata(metadata, db, verbose):
+def import_metadata(
+    metadata, db, chunk_size, indexes, lineage_column, no_progress, verbose
+):
     """
     Convert a CSV formatted metadata file to a database for later use.
     """
     setup_logging(verbose)
-    sc2ts.MetadataDb.import_csv(metadata, db)
+    sc2ts.MetadataDb.import_csv(
+        metadata,
+        db,
+        indexes=[index.split(",") for index in indexes],
+        lineage_column=lineage_column,
+        chunk_size=chunk_size,
+        show_progress=not no_progress,
+    )
 
 
 @click.command()
 @click.argument("metadata", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(file_okay=False))
+@click.option(
+    "--column",
+    "columns",
+    multiple=True,
+    help=(
+        "Column to include in the snapshot (may be repeated; default to all). "
+        "The strain and date columns are always included."
+    ),
+)
+@click.option("-v", "--verbose", count=True)
+@click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
+def snapshot_metadata(metadata, output, columns, verbose, log_file):
+    """
+    Write a memory-mapped snapshot of the metadata DB METADATA to the
+    directory OUTPUT, which can be used in place of the DB for reading.
+    """
+    setup_logging(verbose, log_file)
+    columns = None if len(columns) == 0 else list(columns)
+    with sc2ts.MetadataDb(metadata) as metadata_db:
+        snapshot = metadata_db.create_snapshot(output, columns=columns)
+    print(snapshot)
+
+
+@click.command()
+@click.argument("metadata", type=click.Path(exists=True))
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
 def info_metadata(metadata, verbose, log_file):
@@ -217,32 +485,107 @@ def info_metadata(metadata, verbose, log_file):
     Information about a metadata DB
     """
     setup_logging(verbose, log_file)
-    with sc2ts.MetadataDb(metadata) as metadata_db:
+    with sc2ts.open_metadata_db(metadata) as metadata_db:
         print(metadata_db)
 
 
 @click.command()
 @click.argument("match_db", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--check-mask",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Check that the samples marked as used are those in this ARG",
+)
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
-def info_matches(match_db, verbose, log_file):
+def info_matches(match_db, check_mask, verbose, log_file):
     """
     Information about an alignment store
     """
     setup_logging(verbose, log_file)
-    with sc2ts.MatchDb(match_db) as db:
+    with sc2ts.MatchDb(match_db, readonly=True) as db:
+        if check_mask is not None:
+            db.check_mask(tszip.load(check_mask))
+            print("used sample mask is consistent")
         print(db)
         print("last date = ", db.last_date())
         print("cost\tpercent\tcount")
-        df = db.as_dataframe()
         total = len(db)
-        hmm_cost_counter = collections.Counter(df["hmm_cost"].astype(int))
+        hmm_cost_counter = db.hmm_cost_counts()
         for cost in sorted(hmm_cost_counter.keys()):
             count = hmm_cost_counter[cost]
             percent = count / total * 100
             print(f"{cost}\t{percent:.1f}\t{count}")
 
 
+@click.command()
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.argument("dest", type=click.Path(dir_okay=False))
+@click.option("--no-progress", default=False, type=bool, help="Don't show progress")
+@click.option("-v", "--verbose", count=True)
+@click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
+def migrate_matches(source, dest, no_progress, verbose, log_file):
+    """
+    Convert the match DB SOURCE created by an earlier version of sc2ts to
+    a new match DB DEST using the current schema.
+    """
+    setup_logging(verbose, log_file)
+    match_db = sc2ts.migrate_match_db(source, dest, show_progress=not no_progress)
+    with match_db:
+        print(match_db)
+
+
+@click.command()
+@click.argument("match_db", type=click.Path(exists=True, dir_okay=False))
+@click.argument("archive", type=click.Path(dir_okay=False))
+@click.option(
+    "--retrospective-window",
+    default=30,
+    show_default=True,
+    type=int,
+    help=(
+        "Archive samples matched too long before the last match date to "
+        "be reconsidered by extend with this window"
+    ),
+)
+@click.option(
+    "--used",
+    default=False,
+    show_default=True,
+    type=bool,
+    help=(
+        "Also archive samples that are used in the ARG. Note that reruns of "
+        "extend from an earlier date will then not see these samples"
+    ),
+)
+@click.option(
+    "--vacuum", default=True, show_default=True, type=bool, help="VACUUM MATCH_DB"
+)
+@click.option("-v", "--verbose", count=True)
+@click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
+def archive_matches(
+    match_db, archive, retrospective_window, used, vacuum, verbose, log_file
+):
+    """
+    Move samples that extend will not query again from the match DB
+    MATCH_DB to the match DB ARCHIVE, keeping MATCH_DB small.
+    """
+    setup_logging(verbose, log_file)
+    with sc2ts.MatchDb(match_db) as db:
+        last_date = db.last_date()
+        before = None
+        if last_date is not None:
+            # Future days only query matches after (date - window)
+            before = sc2ts.parse_date(last_date) - datetime.timedelta(
+                days=retrospective_window - 1
+            )
+            before = str(before.date())
+        num_moved = db.archive(archive, before=before, used=used, vacuum=vacuum)
+        print(f"Archived {num_moved} samples matched before {before}")
+        print(db)
+
+
 @click.command()
 @click.argument("ts_path", type=click.Path(exists=True, dir_okay=False))
 @click.option("-R", "--recombinants", is_flag=True)
@@ -304,6 +647,13 @@ def add_provenance(ts, output_file):
     flag_value=True,
     help=("If true, add the problematic regions problematic sites"),
 )
+@click.option(
+    "--codec",
+    type=click.Choice(["bz2", "zstd", "lz4"]),
+    default="bz2",
+    show_default=True,
+    help="Compression codec used for samples in the match DB",
+)
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
 def initialise(
@@ -312,6 +662,7 @@ def initialise(
     problematic_sites,
     mask_flanks,
     mask_problematic_regions,
+    codec,
     verbose,
     log_file,
 ):
@@ -336,11 +687,11 @@ def initialise(
     base_ts = sc2ts.initial_ts(np.unique(problematic))
     add_provenance(base_ts, ts)
     logger.info(f"New base ts at {ts}")
-    sc2ts.MatchDb.initialise(match_db)
+    sc2ts.MatchDb.initialise(match_db, codec=codec)
 
 
 @click.command()
-@click.argument("metadata", type=click.Path(exists=True, dir_okay=False))
+@click.argument("metadata", type=click.Path(exists=True))
 @click.option("--counts/--no-counts", default=False)
 @click.option(
     "--after",
@@ -357,7 +708,7 @@ def list_dates(metadata, counts, after, before, verbose, log_file):
     List the dates included in specified metadataDB
     """
     setup_logging(verbose, log_file)
-    with sc2ts.MetadataDb(metadata) as metadata_db:
+    with sc2ts.open_metadata_db(metadata) as metadata_db:
         counter = metadata_db.date_sample_counts()
         for k in counter:
             if after <= k < before:
@@ -378,8 +729,8 @@ def summarise_base(ts, date, progress):
 @click.command()
 @click.argument("base_ts", type=click.Path(exists=True, dir_okay=False))
 @click.argument("date")
-@click.argument("alignments", type=click.Path(exists=True, dir_okay=False))
-@click.argument("metadata", type=click.Path(exists=True, dir_okay=False))
+@click.argument("alignments", type=click.Path(exists=True))
+@click.argument("metadata", type=click.Path(exists=True))
 @click.argument("matches", type=click.Path(exists=True, dir_okay=False))
 @click.argument("output_ts", type=click.Path(dir_okay=False))
 @num_mismatches
@@ -462,6 +813,17 @@ def summarise_base(ts, date, progress):
     type=int,
     help="Number of match threads (default to one)",
 )
+@hmm_cache
+@hmm_cache_size
+@click.option(
+    "--end-date",
+    default=None,
+    help=(
+        "Also extend with each later date in the metadata up to and including "
+        "this date, in the same process. OUTPUT_TS is then a pattern that is "
+        "formatted with each date, e.g. results/{}.ts"
+    ),
+)
 @click.option("--progress/--no-progress", default=True)
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
@@ -491,6 +853,9 @@ def extend(
     max_missing_sites,
     num_threads,
     random_seed,
+    hmm_cache,
+    hmm_cache_size,
+    end_date,
     progress,
     verbose,
     log_file,
@@ -502,12 +867,19 @@ def extend(
     database, and outputting the result to the specified file.
     """
     setup_logging(verbose, log_file)
+    if end_date is not None and output_ts.format(date) == output_ts:
+        raise click.BadParameter(
+            "OUTPUT_TS must be a pattern such as results/{}.ts with --end-date"
+        )
     base = tskit.load(base_ts)
     summarise_base(base, date, progress)
     with contextlib.ExitStack() as exit_stack:
-        alignment_store = exit_stack.enter_context(sc2ts.AlignmentStore(alignments))
-        metadata_db = exit_stack.enter_context(sc2ts.MetadataDb(metadata))
+        alignment_store = exit_stack.enter_context(
+            sc2ts.open_alignment_store(alignments)
+        )
+        metadata_db = exit_stack.enter_context(sc2ts.open_metadata_db(metadata))
         match_db = exit_stack.enter_context(sc2ts.MatchDb(matches))
+        cache = exit_stack.enter_context(open_hmm_cache(hmm_cache, hmm_cache_size))
 
         newer_matches = match_db.count_newer(date)
         if newer_matches > 0:
@@ -518,11 +890,20 @@ def extend(
                     abort=True,
                 )
                 match_db.delete_newer(date)
-        ts_out = sc2ts.extend(
+        dates = [date]
+        if end_date is not None:
+            dates += [
+                day
+                for day in metadata_db.date_sample_counts()
+                if date < day <= end_date
+            ]
+        # The TreeSequenceBuilders and haplotype index are updated from one
+        # day to the next rather than being rebuilt for each day.
+        results = sc2ts.extend_days(
             alignment_store=alignment_store,
             metadata_db=metadata_db,
             base_ts=base,
-            date=date,
+            dates=dates,
             match_db=match_db,
             num_mismatches=num_mismatches,
             hmm_cost_threshold=hmm_cost_threshold,
@@ -537,12 +918,15 @@ def extend(
             random_seed=random_seed,
             num_threads=num_threads,
             show_progress=progress,
+            hmm_cache=cache,
         )
-        add_provenance(ts_out, output_ts)
-    resource_usage = f"{date}:{summarise_usage()}"
-    logger.info(resource_usage)
-    if progress:
-        print(resource_usage, file=sys.stderr)
+        for day, ts_out in results:
+            path = output_ts if end_date is None else output_ts.format(day)
+            add_provenance(ts_out, path)
+            resource_usage = f"{day}:{summarise_usage()}"
+            logger.info(resource_usage)
+            if progress:
+                print(resource_usage, file=sys.stderr)
 
 
 @click.command()
@@ -557,7 +941,12 @@ def validate(alignment_db, ts_file, deletions_as_missing, verbose):
     setup_logging(verbose)
 
     ts = tszip.load(ts_file)
-    with sc2ts.AlignmentStore(alignment_db) as alignment_store:
+    if (pathlib.Path(alignment_db) / ".zgroup").exists():
+        # Alignments exported to a zarr matrix by export-alignment-matrix
+        alignment_store = sc2ts.AlignmentMatrix(alignment_db)
+    else:
+        alignment_store = sc2ts.open_alignment_store(alignment_db)
+    with alignment_store:
         sc2ts.validate(ts, alignment_store, deletions_as_missing, show_progress=True)
 
 
@@ -605,7 +994,7 @@ def export_metadata(ts_file, verbose):
 
 @click.command()
 @click.argument("ts", type=click.Path(exists=True, dir_okay=False))
-@click.argument("metadata", type=click.Path(exists=True, dir_okay=False))
+@click.argument("metadata", type=click.Path(exists=True))
 @click.option("-v", "--verbose", count=True)
 def tally_lineages(ts, metadata, verbose):
     """
@@ -615,7 +1004,7 @@ def tally_lineages(ts, metadata, verbose):
     """
     setup_logging(verbose)
     ts = tszip.load(ts)
-    with sc2ts.MetadataDb(metadata) as metadata_db:
+    with sc2ts.open_metadata_db(metadata) as metadata_db:
         df = info.tally_lineages(ts, metadata_db, show_progress=True)
     df.to_csv(sys.stdout, sep="\t", index=False)
 
@@ -642,6 +1031,8 @@ class MatchWork:
     samples: List
     num_mismatches: int
     direction: str
+    hmm_cache_path: str = None
+    hmm_cache_size: int = sc2ts.DEFAULT_HMM_CACHE_SIZE
 
 
 def _match_worker(work):
@@ -651,17 +1042,19 @@ def _match_worker(work):
     )
     logger.info(f"Start: {msg}")
     ts = tszip.load(work.ts_path)
-    sc2ts.match_tsinfer(
-        samples=work.samples,
-        ts=ts,
-        num_mismatches=work.num_mismatches,
-        mismatch_threshold=100,
-        # FIXME!
-        deletions_as_missing=False,
-        num_threads=0,
-        show_progress=False,
-        mirror_coordinates=work.direction == "reverse",
-    )
+    with open_hmm_cache(work.hmm_cache_path, work.hmm_cache_size) as cache:
+        sc2ts.match_tsinfer(
+            samples=work.samples,
+            ts=ts,
+            num_mismatches=work.num_mismatches,
+            mismatch_threshold=100,
+            # FIXME!
+            deletions_as_missing=False,
+            num_threads=0,
+            show_progress=False,
+            mirror_coordinates=work.direction == "reverse",
+            hmm_cache=cache,
+        )
     runs = []
     for sample in work.samples:
         runs.append(
@@ -677,7 +1070,7 @@ def _match_worker(work):
 
 
 @click.command(name="match")
-@click.argument("alignments_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("alignments_path", type=click.Path(exists=True))
 @click.argument("ts_path", type=click.Path(exists=True, dir_okay=False))
 @click.argument("strains", nargs=-1)
 @num_mismatches
@@ -701,6 +1094,8 @@ def _match_worker(work):
     type=int,
     help="Number of match threads (default to one)",
 )
+@hmm_cache
+@hmm_cache_size
 @click.option("--progress/--no-progress", default=True)
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
@@ -713,6 +1108,8 @@ def _match(
     mismatch_threshold,
     direction,
     num_threads,
+    hmm_cache,
+    hmm_cache_size,
     progress,
     verbose,
     log_file,
@@ -737,18 +1134,20 @@ def _match(
         if sample.haplotype is None:
             raise ValueError(f"No alignment stored for {sample.strain}")
 
-    sc2ts.match_tsinfer(
-        samples=samples,
-        ts=ts,
-        num_mismatches=num_mismatches,
-        deletions_as_missing=deletions_as_missing,
-        mismatch_threshold=mismatch_threshold,
-        num_threads=num_threads,
-        show_progress=progress,
-        progress_title=progress_title,
-        progress_phase="HMM",
-        mirror_coordinates=direction == "reverse",
-    )
+    with open_hmm_cache(hmm_cache, hmm_cache_size) as cache:
+        sc2ts.match_tsinfer(
+            samples=samples,
+            ts=ts,
+            num_mismatches=num_mismatches,
+            deletions_as_missing=deletions_as_missing,
+            mismatch_threshold=mismatch_threshold,
+            num_threads=num_threads,
+            show_progress=progress,
+            progress_title=progress_title,
+            progress_phase="HMM",
+            mirror_coordinates=direction == "reverse",
+            hmm_cache=cache,
+        )
     for sample in samples:
         run = HmmRun(
             strain=sample.strain,
@@ -779,7 +1178,7 @@ def find_previous_date_path(date, path_pattern):
 
 
 @click.command()
-@click.argument("alignments", type=click.Path(exists=True, dir_okay=False))
+@click.argument("alignments", type=click.Path(exists=True))
 @click.argument("ts", type=click.Path(exists=True, dir_okay=False))
 @click.argument("path_pattern")
 @num_mismatches
@@ -789,6 +1188,8 @@ def find_previous_date_path(date, path_pattern):
     type=int,
     help="Number of match threads (default to one)",
 )
+@hmm_cache
+@hmm_cache_size
 @click.option("--progress/--no-progress", default=True)
 @click.option("-v", "--verbose", count=True)
 @click.option("-l", "--log-file", default=None, type=click.Path(dir_okay=False))
@@ -798,6 +1199,8 @@ def rematch_recombinants(
     path_pattern,
     num_mismatches,
     num_threads,
+    hmm_cache,
+    hmm_cache_size,
     progress,
     verbose,
     log_file,
@@ -850,6 +1253,8 @@ def rematch_recombinants(
                     samples,
                     num_mismatches=num_mismatches,
                     direction=direction,
+                    hmm_cache_path=hmm_cache,
+                    hmm_cache_size=hmm_cache_size,
                 )
             )
 
@@ -883,8 +1288,13 @@ def cli():
 cli.add_command(import_alignments)
 cli.add_command(import_metadata)
 cli.add_command(info_alignments)
+cli.add_command(export_alignment_matrix)
+cli.add_command(reshard_alignments)
 cli.add_command(info_metadata)
+cli.add_command(snapshot_metadata)
 cli.add_command(info_matches)
+cli.add_command(migrate_matches)
+cli.add_command(archive_matches)
 cli.add_command(info_ts)
 cli.add_command(export_alignments)
 cli.add_command(export_metadata)
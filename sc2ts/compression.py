@@ -0,0 +1,155 @@
+"""
+Compression codecs used for values stored in the AlignmentStore and MatchDb.
+"""
+import bz2
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger(__name__)
+
+
+class Codec:
+    """
+    Base class for compression codecs. Codecs are described by a JSON
+    compatible config dictionary (see asdict), which is recorded in the
+    metadata of the containers that use them. Codecs must be picklable so
+    that they can be passed to worker processes.
+    """
+
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+    def asdict(self):
+        return {"name": self.name}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.asdict()})"
+
+
+class Bz2Codec(Codec):
+    name = "bz2"
+
+    def compress(self, data):
+        return bz2.compress(data)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard compression, optionally using a dictionary trained on
+    representative values (see train_dictionary).
+    """
+
+    name = "zstd"
+
+    def __init__(self, level=3, dictionary=None):
+        if zstandard is None:
+            raise ImportError("The zstandard package is required for zstd codecs")
+        self.level = level
+        self.dictionary = dictionary
+        self._compressor = None
+        self._decompressor = None
+
+    def __getstate__(self):
+        return {"level": self.level, "dictionary": self.dictionary}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _compression_dict(self):
+        if self.dictionary is None:
+            return None
+        return zstandard.ZstdCompressionDict(self.dictionary)
+
+    def compress(self, data):
+        if self._compressor is None:
+            self._compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self._compression_dict()
+            )
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zstandard.ZstdDecompressor(
+                dict_data=self._compression_dict()
+            )
+        return self._decompressor.decompress(data)
+
+    def asdict(self):
+        return {
+            "name": self.name,
+            "level": self.level,
+            "has_dictionary": self.dictionary is not None,
+        }
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+
+    def __init__(self, level=0):
+        if lz4 is None:
+            raise ImportError("The lz4 package is required for lz4 codecs")
+        self.level = level
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+    def asdict(self):
+        return {"name": self.name, "level": self.level}
+
+
+CODECS = {
+    "bz2": Bz2Codec,
+    "zstd": ZstdCodec,
+    "lz4": Lz4Codec,
+}
+
+
+def get_codec(config=None, dictionary=None):
+    """
+    Return the codec described by the specified config dictionary (as
+    returned by Codec.asdict), or bz2 if config is None. Only zstd codecs
+    use the dictionary.
+    """
+    if config is None:
+        return Bz2Codec()
+    config = dict(config)
+    name = config.pop("name")
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}")
+    has_dictionary = config.pop("has_dictionary", False)
+    if name == "zstd":
+        if has_dictionary and dictionary is None:
+            raise ValueError("zstd dictionary missing")
+        config["dictionary"] = dictionary
+    return CODECS[name](**config)
+
+
+def train_dictionary(samples, dict_size=112640):
+    """
+    Return a zstd dictionary (as bytes) trained on the specified list of
+    example values.
+    """
+    if zstandard is None:
+        raise ImportError("The zstandard package is required to train dictionaries")
+    logger.info(f"Training {dict_size} byte zstd dictionary on {len(samples)} values")
+    return zstandard.train_dictionary(dict_size, list(samples)).as_bytes()
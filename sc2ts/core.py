@@ -3,6 +3,7 @@ import json
 import pathlib
 import collections.abc
 import csv
+import gzip
 
 import pyfaidx
 import numpy as np
@@ -51,6 +52,33 @@ class FastaReader(collections.abc.Mapping):
         return len(self.keys)
 
 
+def read_fasta(path):
+    """
+    Iterate over the (name, sequence) pairs in the specified FASTA file,
+    which may be gzip compressed. Unlike FastaReader no index is needed and
+    records are read sequentially. Names are the first word of the header
+    line and sequences are returned as bytes, without the "X" prefix used
+    to make coordinates 1-based.
+    """
+    with open(path, "rb") as f:
+        is_gzip = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if is_gzip else open
+    with opener(path, "rb") as f:
+        name = None
+        lines = []
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, b"".join(lines)
+                name = line[1:].split()[0].decode()
+                lines = []
+            elif line:
+                lines.append(line)
+        if name is not None:
+            yield name, b"".join(lines)
+
+
 data_path = pathlib.Path(__file__).parent / "data"
 
 
@@ -1,5 +1,5 @@
 from __future__ import annotations
-import bz2
+import atexit
 import logging
 import datetime
 import dataclasses
@@ -7,11 +7,15 @@ import collections
 import concurrent.futures as cf
 import time
 import json
+import contextlib
 import pickle
 import hashlib
 import sqlite3
 import pathlib
 import random
+import os
+import sys
+from multiprocessing import shared_memory
 
 import tqdm
 import tskit
@@ -24,6 +28,7 @@ import pandas as pd
 
 from . import core
 from . import alignments
+from . import compression
 from . import metadata
 from . import tree_ops
 
@@ -50,14 +55,175 @@ def get_progress(iterable, title, phase, show_progress, total=None):
     )
 
 
+# Version 1 MatchDbs store each Sample as a single compressed pickle.
+# Version 2 stores the HMM match path segments and mutations in their own
+# tables, along with a group key, the metadata as JSON and the haplotype
+# as a separately compressed int8 blob, so that samples can be grouped
+# and filtered in SQL. Samples that are in the ARG are flagged as used.
+MATCH_DB_SCHEMA_VERSION = 2
+
+# Number of rows fetched from the samples table at a time when
+# materialising Samples.
+MATCH_DB_PAGE_SIZE = 1000
+
+# Connection pragmas used by MatchDbs unless overridden. MatchDbs use
+# write-ahead logging, so that readers (e.g., info-matches) can run while
+# extend is writing, and so synchronous=NORMAL is safe against corruption,
+# only risking the last transactions on power loss. Negative cache sizes
+# are in KiB.
+DEFAULT_MATCH_DB_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024**2,
+}
+
+_SYNCHRONOUS_VALUES = {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"}
+
+
+def match_group_key(hmm_match):
+    """
+    Return the key used to group samples that have the same match path
+    and set of immediate reversions (see add_matching_results), as a
+    JSON string.
+    """
+    path = [[seg.left, seg.right, seg.parent] for seg in hmm_match.path]
+    immediate_reversions = [
+        [mut.site_id, mut.derived_state]
+        for mut in hmm_match.mutations
+        if mut.is_immediate_reversion
+    ]
+    return json.dumps([path, immediate_reversions], separators=(",", ":"))
+
+
+def _optional_bool(value):
+    return None if value is None else bool(value)
+
+
+# The codec used by match DB worker processes (see MatchDb.get_batches)
+_match_worker_codec = None
+
+
+def _init_match_worker(codec):
+    global _match_worker_codec
+    _match_worker_codec = codec
+
+
+def decode_match_rows(payload, codec=None):
+    """
+    Return the list of Samples decoded from the specified rows of a MatchDb
+    page payload, using the specified codec (or the codec of the current
+    worker process if None). Rows from schema version 1 contain only the
+    pickle.
+    """
+    if codec is None:
+        codec = _match_worker_codec
+    samples = []
+    for row in payload:
+        sample = pickle.loads(codec.decompress(row[0]))
+        if len(row) > 1:
+            metadata_json, haplotype, likelihood, path, mutations = row[1:]
+            sample.metadata = json.loads(metadata_json)
+            if haplotype is not None:
+                haplotype = codec.decompress(haplotype)
+                sample.haplotype = np.frombuffer(haplotype, dtype=np.int8).copy()
+            sample.hmm_match = HmmMatch(
+                [PathSegment(*seg) for seg in path],
+                [
+                    MatchMutation(
+                        site_id=mut[0],
+                        site_position=mut[1],
+                        inherited_state=mut[2],
+                        derived_state=mut[3],
+                        is_reversion=_optional_bool(mut[4]),
+                        is_immediate_reversion=_optional_bool(mut[5]),
+                    )
+                    for mut in mutations
+                ],
+                likelihood,
+            )
+        samples.append(sample)
+    return samples
+
+
+def _pragma_statements(pragmas):
+    # Returns the PRAGMA statements for the specified dictionary, which
+    # can't use bound parameters and so are validated here.
+    statements = []
+    for key, value in pragmas.items():
+        if key == "synchronous":
+            value = str(value).upper()
+            if value not in _SYNCHRONOUS_VALUES:
+                raise ValueError(f"Bad synchronous value: {value}")
+        elif key in ("cache_size", "mmap_size"):
+            value = int(value)
+        else:
+            raise ValueError(f"Unsupported MatchDb pragma: {key}")
+        statements.append(f"PRAGMA {key}={value}")
+    return statements
+
+
 class MatchDb:
-    def __init__(self, path):
-        uri = f"file:{path}"
+    """
+    A database of the HMM matches for each sample. If readonly is True
+    the database is opened for reading only, and can safely be used while
+    another process writes to it. The pragmas dictionary updates
+    DEFAULT_MATCH_DB_PRAGMAS for this connection.
+    """
+
+    def __init__(self, path, *, readonly=False, pragmas=None):
         self.path = path
-        self.uri = uri
-        self.conn = sqlite3.connect(uri, uri=True)
-        self.conn.row_factory = metadata.dict_factory
-        logger.debug(f"Opened MatchDb at {path} mode=rw")
+        self.uri = f"file:{path}"
+        self.readonly = readonly
+        self.conn = metadata.connect(path, readonly=readonly)
+        pragmas = {**DEFAULT_MATCH_DB_PRAGMAS, **(pragmas or {})}
+        if readonly:
+            pragmas.pop("synchronous")
+        for statement in _pragma_statements(pragmas):
+            self.conn.execute(statement)
+        self.codec = self._load_codec()
+        self.schema_version = self._load_schema_version()
+        if not readonly and self.schema_version == MATCH_DB_SCHEMA_VERSION:
+            # Persistent, but also converts MatchDbs created in other modes.
+            # Older schema versions can't be written to, so are left as is.
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        mode = "ro" if readonly else "rw"
+        logger.debug(
+            f"Opened MatchDb at {path} mode={mode} codec={self.codec} "
+            f"schema_version={self.schema_version} pragmas={pragmas}"
+        )
+
+    def _get_metadata(self, key, default=None):
+        # MatchDbs created before the metadata table was introduced use bz2
+        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name='metadata'"
+        with self.conn:
+            if self.conn.execute(sql).fetchone() is None:
+                return default
+            sql = "SELECT value FROM metadata WHERE key==?"
+            row = self.conn.execute(sql, (key,)).fetchone()
+        return default if row is None else row["value"]
+
+    def _load_codec(self):
+        config = self._get_metadata("codec")
+        if config is not None:
+            config = json.loads(config)
+        return compression.get_codec(config, self._get_metadata("codec_dictionary"))
+
+    def _load_schema_version(self):
+        sql = (
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name='path_segments'"
+        )
+        with self.conn:
+            if self.conn.execute(sql).fetchone() is None:
+                return 1
+        return MATCH_DB_SCHEMA_VERSION
+
+    def _check_schema_version(self):
+        if self.schema_version != MATCH_DB_SCHEMA_VERSION:
+            raise ValueError(
+                f"MatchDb at {self.path} has schema version {self.schema_version} "
+                "and is read-only; convert it with migrate_match_db"
+            )
 
     def __len__(self):
         sql = "SELECT COUNT(*) FROM samples"
@@ -72,6 +238,19 @@ class MatchDb:
             )
             return pd.DataFrame(cursor.fetchall())
 
+    def hmm_cost_counts(self):
+        """
+        Return a Counter mapping the (integer) HMM costs of all samples
+        to the number of samples with that cost.
+        """
+        sql = (
+            "SELECT CAST(hmm_cost AS INTEGER) AS cost, COUNT(*) FROM samples "
+            "GROUP BY cost"
+        )
+        with self.conn:
+            rows = self.conn.execute(sql).fetchall()
+        return collections.Counter({row["cost"]: row["COUNT(*)"] for row in rows})
+
     def last_date(self):
         sql = "SELECT MAX(match_date) FROM samples"
         with self.conn:
@@ -87,8 +266,110 @@ class MatchDb:
     def delete_newer(self, date):
         sql = "DELETE FROM samples WHERE match_date >= ?"
         with self.conn:
+            if self.schema_version > 1:
+                for table in ["path_segments", "match_mutations"]:
+                    self.conn.execute(
+                        f"DELETE FROM {table} WHERE strain IN "
+                        "(SELECT strain FROM samples WHERE match_date >= ?)",
+                        (date,),
+                    )
             self.conn.execute(sql, (date,))
 
+    def archive(self, archive_path, before=None, used=False, vacuum=True):
+        """
+        Move the samples matched before the specified date, and also those
+        used in the ARG if used is True, to the MatchDb at archive_path
+        (which is created with the same codec if it doesn't exist), and
+        return the number of samples moved. Archived samples are no longer
+        returned by get, but can be queried with attach_archive. The
+        database file is then VACUUMed to reclaim the space, if vacuum is
+        True.
+
+        Note that used samples are still returned by get when extend is
+        rerun from an earlier date (after delete_newer), so archiving them
+        means such reruns will not see them.
+
+        The rows are first copied to the archive in one transaction and then
+        deleted from this database in a second, because transactions that
+        span attached databases are not atomic in WAL mode. The copy
+        replaces any existing rows for the same strains, so an archive that
+        is interrupted between the two can safely be run again.
+        """
+        self._check_schema_version()
+        conditions = []
+        args = []
+        if before is not None:
+            conditions.append("match_date < ?")
+            args.append(str(before))
+        if used:
+            conditions.append("used==1")
+        if len(conditions) == 0:
+            raise ValueError("Must archive samples by date or used status")
+        where_clause = " OR ".join(conditions)
+
+        archive_path = pathlib.Path(archive_path)
+        dictionary = self._get_metadata("codec_dictionary")
+        if not archive_path.exists():
+            MatchDb._create(archive_path, self.codec.asdict(), dictionary).close()
+        with MatchDb(archive_path, readonly=True) as archive_db:
+            archive_db._check_schema_version()
+            if (
+                archive_db.codec.asdict() != self.codec.asdict()
+                or archive_db._get_metadata("codec_dictionary") != dictionary
+            ):
+                raise ValueError(f"Archive {archive_path} uses a different codec")
+
+        self.conn.execute("ATTACH DATABASE ? AS archive", (str(archive_path),))
+        moved = f"SELECT strain FROM samples WHERE {where_clause}"
+        tables = ["path_segments", "match_mutations"]
+        try:
+            with self.conn:
+                for table in tables:
+                    self.conn.execute(
+                        f"DELETE FROM archive.{table} WHERE strain IN ({moved})", args
+                    )
+                    self.conn.execute(
+                        f"INSERT INTO archive.{table} SELECT * FROM {table} "
+                        f"WHERE strain IN ({moved})",
+                        args,
+                    )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO archive.samples "
+                    f"SELECT * FROM samples WHERE {where_clause}",
+                    args,
+                )
+            with self.conn:
+                for table in tables:
+                    self.conn.execute(
+                        f"DELETE FROM {table} WHERE strain IN ({moved})", args
+                    )
+                cursor = self.conn.execute(
+                    f"DELETE FROM samples WHERE {where_clause}", args
+                )
+                num_moved = cursor.rowcount
+        finally:
+            self.conn.execute("DETACH DATABASE archive")
+        logger.info(f"Moved {num_moved} samples to archive {archive_path}")
+        if vacuum:
+            self.conn.execute("VACUUM")
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logger.info(f"Vacuumed MatchDb at {self.path}")
+        return num_moved
+
+    def attach_archive(self, archive_path):
+        """
+        Attach the archive MatchDb at the specified path (see archive) to
+        this connection, and create the temporary views all_samples,
+        all_path_segments and all_match_mutations, which contain the rows
+        of both databases, for analysis.
+        """
+        self.conn.execute("ATTACH DATABASE ? AS archive", (str(archive_path),))
+        for table in ["samples", "path_segments", "match_mutations"]:
+            self.conn.execute(
+                f"CREATE TEMP VIEW all_{table} AS SELECT * FROM main.{table} "
+                f"UNION ALL SELECT * FROM archive.{table}"
+            )
+
     def __str__(self):
         return f"MatchDb at {self.uri} has {len(self)} samples"
 
@@ -101,105 +382,484 @@ class MatchDb:
     def close(self):
         self.conn.close()
 
+    def _insert(self, samples, hmm_costs):
+        # Insert the specified samples with precomputed HMM costs
+        sample_rows = []
+        segment_rows = []
+        mutation_rows = []
+        for sample, hmm_cost in zip(samples, hmm_costs):
+            hmm_match = sample.hmm_match
+            # The path, mutations, metadata and haplotype are stored in
+            # their own columns, and the remainder of the Sample pickled.
+            remainder = dataclasses.replace(
+                sample, metadata=None, haplotype=None, hmm_match=None
+            )
+            haplotype = None
+            if sample.haplotype is not None:
+                h = np.asarray(sample.haplotype, dtype=np.int8)
+                haplotype = self.codec.compress(h.tobytes())
+            likelihood = hmm_match.likelihood
+            sample_rows.append(
+                (
+                    sample.strain,
+                    sample.date,
+                    float(hmm_cost),
+                    match_group_key(hmm_match),
+                    None if likelihood is None else float(likelihood),
+                    json.dumps(sample.metadata),
+                    haplotype,
+                    # Compressing drops this by ~10X, so worth it.
+                    self.codec.compress(pickle.dumps(remainder)),
+                    sample.strain,
+                )
+            )
+            for j, seg in enumerate(hmm_match.path):
+                segment_rows.append(
+                    (sample.strain, j, int(seg.left), int(seg.right), int(seg.parent))
+                )
+            for j, mut in enumerate(hmm_match.mutations):
+                position = mut.site_position
+                mutation_rows.append(
+                    (
+                        sample.strain,
+                        j,
+                        int(mut.site_id),
+                        None if position is None else int(position),
+                        mut.inherited_state,
+                        mut.derived_state,
+                        mut.is_reversion,
+                        mut.is_immediate_reversion,
+                    )
+                )
+        # Batch insert, for efficiency.
+        with self.conn:
+            # Samples already in the ARG are flagged as used on insertion
+            self.conn.executemany(
+                "INSERT INTO samples (strain, match_date, hmm_cost, group_key, "
+                "likelihood, metadata, haplotype, pickle, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+                "EXISTS (SELECT 1 FROM used_samples WHERE strain==?))",
+                sample_rows,
+            )
+            self.conn.executemany(
+                "INSERT INTO path_segments VALUES (?, ?, ?, ?, ?)", segment_rows
+            )
+            self.conn.executemany(
+                "INSERT INTO match_mutations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                mutation_rows,
+            )
+
     def add(self, samples, date, num_mismatches, show_progress=False):
         """
         Adds the specified matched samples to this MatchDb.
         """
-        sql = """\
-            INSERT INTO samples (
-            strain, match_date, hmm_cost, pickle)
-            VALUES (?, ?, ?, ?)
-            """
-        data = []
+        self._check_schema_version()
         hmm_cost = np.zeros(len(samples))
         bar = get_progress(
             enumerate(samples), date, "update mdb", show_progress, total=len(samples)
         )
         for j, sample in bar:
             assert sample.date == date
-            pkl = pickle.dumps(sample)
-            # BZ2 compressing drops this by ~10X, so worth it.
-            pkl_compressed = bz2.compress(pkl)
             hmm_cost[j] = sample.hmm_match.get_hmm_cost(num_mismatches)
-            args = (
-                sample.strain,
-                date,
-                hmm_cost[j],
-                pkl_compressed,
-            )
-            data.append(args)
             logger.debug(f"MatchDB insert: hmm_cost={hmm_cost[j]} {sample.summary()}")
-        # Batch insert, for efficiency.
-        with self.conn:
-            self.conn.executemany(sql, data)
+        self._insert(samples, hmm_cost)
         logger.info(
             f"Added {len(samples)} samples to match DB for {date}; "
             f"hmm_cost:min={hmm_cost.min()},max={hmm_cost.max()},"
             f"mean={hmm_cost.mean()},median={np.median(hmm_cost)}"
         )
 
-    def create_mask_table(self, ts):
-        # NOTE perhaps a better way to do this would be to simply delete
-        # the rows in the DB that *are* in the ts, as a separate
-        # transaction once we know that the trees have been saved to disk.
-        logger.info("Loading used samples into DB")
-        samples = [(strain,) for strain in ts.metadata["sc2ts"]["samples_strain"]]
-        logger.debug(f"Got {len(samples)} from ts")
+    def _set_metadata(self, key, value):
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (key TEXT, value, PRIMARY KEY (key))"
+        )
+        sql = "INSERT OR REPLACE INTO metadata VALUES (?, ?)"
+        self.conn.execute(sql, (key, value))
+
+    def create_mask_table(self, ts, rebuild=False):
+        """
+        Mark the samples in the specified ARG as used, so that they are
+        excluded from get and get_groups. The used_samples table and the
+        used flags on the samples table persist between calls, and as
+        strains are only ever appended to the ARG's samples_strain list,
+        only the strains added since the last call are normally processed.
+        The mask is rebuilt from scratch if rebuild is True, or if the ARG
+        is not a descendant of the last one (e.g., when rerunning from an
+        earlier date).
+        """
+        strains = ts.metadata["sc2ts"]["samples_strain"]
+        if self.schema_version == 1:
+            self._create_legacy_mask_table(strains)
+            return
+        num_recorded = int(self._get_metadata("mask_num_samples", 0))
+        last_strain = self._get_metadata("mask_last_strain")
+        incremental = not rebuild and (
+            num_recorded == 0
+            or (
+                num_recorded <= len(strains)
+                and strains[num_recorded - 1] == last_strain
+            )
+        )
+        new_strains = strains[num_recorded:] if incremental else strains
+        logger.info(
+            f"Marking {len(new_strains)} samples as used in DB "
+            f"({'incremental' if incremental else 'rebuild'})"
+        )
+        with self.conn:
+            if not incremental:
+                self.conn.execute("DELETE FROM used_samples")
+                self.conn.execute("UPDATE samples SET used=0 WHERE used==1")
+            args = [(strain,) for strain in new_strains]
+            self.conn.executemany("INSERT OR IGNORE INTO used_samples VALUES (?)", args)
+            self.conn.executemany("UPDATE samples SET used=1 WHERE strain==?", args)
+            self._set_metadata("mask_num_samples", len(strains))
+            self._set_metadata("mask_last_strain", strains[-1] if strains else None)
+        if logger.isEnabledFor(logging.DEBUG):
+            with self.conn:
+                row = self.conn.execute(
+                    "SELECT COUNT(*) FROM samples WHERE used==0"
+                ).fetchone()
+            logger.debug(f"DB contains {row['COUNT(*)']} samples not in ARG")
+
+    def _create_legacy_mask_table(self, strains):
+        # Schema version 1 MatchDbs rebuild the mask table each time, and
+        # exclude used samples with a join.
+        samples = [(strain,) for strain in strains]
         with self.conn:
             self.conn.execute("DROP TABLE IF EXISTS used_samples")
             self.conn.execute(
                 "CREATE TABLE used_samples (strain TEXT, PRIMARY KEY (strain))"
             )
             self.conn.executemany("INSERT INTO used_samples VALUES (?)", samples)
-        logger.debug("Built temporary table")
+
+    def check_mask(self, ts=None):
+        """
+        Check that the used flags on the samples table agree with the
+        used_samples table and, if an ARG is specified, that the
+        used_samples table contains exactly the samples in the ARG. Raises
+        a ValueError if not.
+        """
+        self._check_schema_version()
+        sql = (
+            "SELECT COUNT(*) FROM samples WHERE used != "
+            "(strain IN (SELECT strain FROM used_samples))"
+        )
         with self.conn:
-            cursor = self.conn.execute(
-                "SELECT COUNT(*) FROM samples LEFT JOIN used_samples "
+            num_bad_flags = self.conn.execute(sql).fetchone()["COUNT(*)"]
+            used = {
+                row["strain"]
+                for row in self.conn.execute("SELECT strain FROM used_samples")
+            }
+        if num_bad_flags > 0:
+            raise ValueError(f"{num_bad_flags} samples have incorrect used flags")
+        if ts is not None:
+            strains = set(ts.metadata["sc2ts"]["samples_strain"])
+            if used != strains:
+                raise ValueError(
+                    f"Used samples differ from ARG: {len(used - strains)} not in "
+                    f"ARG, {len(strains - used)} missing"
+                )
+
+    def _get_sql(self, where_clause, columns="samples.*"):
+        if self.schema_version == 1:
+            return (
+                f"SELECT {columns} FROM samples LEFT JOIN used_samples "
                 "ON samples.strain = used_samples.strain "
-                "WHERE used_samples.strain IS NULL"
+                f"WHERE used_samples.strain IS NULL AND {where_clause}"
+            )
+        return f"SELECT {columns} FROM samples WHERE used==0 AND ({where_clause})"
+
+    def _load_matches(self, strains):
+        # Returns the raw path segment and mutation rows of the HMM matches
+        # for the specified strains.
+        paths = collections.defaultdict(list)
+        mutations = collections.defaultdict(list)
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        for start in range(0, len(strains), 500):
+            batch = strains[start : start + 500]
+            placeholders = ", ".join("?" * len(batch))
+            sql = (
+                "SELECT strain, [left], [right], parent FROM path_segments "
+                f"WHERE strain IN ({placeholders}) ORDER BY strain, seg_index"
+            )
+            for row in cursor.execute(sql, batch):
+                paths[row[0]].append(row[1:])
+            sql = (
+                "SELECT strain, site_id, site_position, inherited_state, "
+                "derived_state, is_reversion, is_immediate_reversion "
+                f"FROM match_mutations WHERE strain IN ({placeholders}) "
+                "ORDER BY strain, mut_index"
             )
-            row = cursor.fetchone()
-            samples_not_in_ts = row["COUNT(*)"]
-        logger.info(f"DB contains {samples_not_in_ts} samples not in ARG")
+            for row in cursor.execute(sql, batch):
+                mutations[row[0]].append(row[1:])
+        return paths, mutations
+
+    def _page_payload(self, rows):
+        # Returns the data needed to decode the Samples for the specified
+        # rows of the samples table, which is sent to worker processes.
+        if self.schema_version == 1:
+            return [(row["pickle"],) for row in rows]
+        paths, mutations = self._load_matches([row["strain"] for row in rows])
+        return [
+            (
+                row["pickle"],
+                row["metadata"],
+                row["haplotype"],
+                row["likelihood"],
+                paths[row["strain"]],
+                mutations[row["strain"]],
+            )
+            for row in rows
+        ]
+
+    def _decode_pages(self, pages, num_workers):
+        # Yield the lists of Samples for each page of rows in order,
+        # decoding in a pool of num_workers processes if > 0.
+        if num_workers == 0:
+            for rows in pages:
+                yield decode_match_rows(self._page_payload(rows), self.codec)
+            return
+        with cf.ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_match_worker,
+            initargs=(self.codec,),
+        ) as executor:
+            futures = collections.deque()
+            for rows in pages:
+                futures.append(
+                    executor.submit(decode_match_rows, self._page_payload(rows))
+                )
+                # Bound the number of pages in flight
+                if len(futures) >= 2 * num_workers:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+    def get_batches(
+        self, where_clause, args=(), batch_size=MATCH_DB_PAGE_SIZE, num_workers=0
+    ):
+        """
+        Yield lists of up to batch_size of the Samples not used in the ARG
+        that satisfy the specified SQL where clause (see get), in the same
+        order as get. Rows are fetched a batch at a time, and decompressed
+        and unpickled in a pool of num_workers processes (or in this process
+        if num_workers is 0).
+        """
+        sql = self._get_sql(where_clause)
+        metadata.log_query(sql, args, self.conn)
+
+        def pages():
+            with self.conn:
+                cursor = self.conn.execute(sql, args)
+                while len(rows := cursor.fetchmany(batch_size)) > 0:
+                    yield rows
+
+        yield from self._decode_pages(pages(), num_workers)
+
+    def get(self, where_clause, args=()):
+        """
+        Yield the Samples not used in the ARG that satisfy the specified
+        SQL where clause, with "?" placeholders bound to the specified args.
+        """
+        for batch in self.get_batches(where_clause, args):
+            for sample in batch:
+                logger.debug(f"MatchDb got: {sample.summary()}")
+                yield sample
+
+    def get_many(self, strains, batch_size=MATCH_DB_PAGE_SIZE, num_workers=0):
+        """
+        Return the list of Samples for the specified strains, in the same
+        order, whether or not they are used in the ARG. Samples are decoded
+        in batches as in get_batches.
+        """
+
+        def pages():
+            for start in range(0, len(strains), batch_size):
+                batch = list(strains[start : start + batch_size])
+                placeholders = ", ".join("?" * len(batch))
+                sql = f"SELECT * FROM samples WHERE strain IN ({placeholders})"
+                with self.conn:
+                    rows = {row["strain"]: row for row in self.conn.execute(sql, batch)}
+                missing = set(batch) - set(rows)
+                if len(missing) > 0:
+                    raise KeyError(f"strains not in MatchDb: {sorted(missing)}")
+                yield [rows[strain] for strain in batch]
 
-    def get(self, where_clause):
+        samples = []
+        for batch in self._decode_pages(pages(), num_workers):
+            samples.extend(batch)
+        return samples
+
+    def count(self, where_clause, args=()):
+        """
+        Return the number of samples not used in the ARG that satisfy the
+        specified SQL where clause (see get).
+        """
+        sql = self._get_sql(where_clause, "COUNT(*)")
+        with self.conn:
+            return self.conn.execute(sql, args).fetchone()["COUNT(*)"]
+
+    def get_groups(
+        self,
+        where_clause,
+        args=(),
+        additional_keys=(),
+        min_group_size=1,
+        min_different_dates=1,
+    ):
+        """
+        Group the samples not used in the ARG that satisfy the specified
+        SQL where clause (see get) by their match group key (see
+        match_group_key) and the values of the specified additional
+        metadata keys, and return the groups with at least min_group_size
+        samples from at least min_different_dates dates. Groups are returned
+        as (group_key, additional_values, strains) tuples in order of their
+        first sample, with samples ordered by match date and then insertion.
+        """
+        self._check_schema_version()
+        key_columns = "".join(
+            f", json_extract(metadata, ?) AS key_{j}"
+            for j in range(len(additional_keys))
+        )
+        group_columns = "".join(f", key_{j}" for j in range(len(additional_keys)))
+        candidates = self._get_sql(
+            where_clause,
+            "samples.strain AS strain, match_date, group_key, metadata, "
+            "ROW_NUMBER() OVER (ORDER BY match_date, samples.rowid) AS ord",
+        )
+        # Members are only listed for the groups that pass the thresholds
         sql = (
-            "SELECT * FROM samples LEFT JOIN used_samples "
-            "ON samples.strain = used_samples.strain "
-            f"WHERE used_samples.strain IS NULL AND {where_clause}"
+            f"WITH candidates AS ({candidates}) "
+            f"SELECT group_key{key_columns}, MIN(ord) AS first, "
+            "COUNT(*) AS size, COUNT(DISTINCT match_date) AS num_dates, "
+            "CASE WHEN COUNT(*) >= ? AND COUNT(DISTINCT match_date) >= ? "
+            "THEN json_group_array(json_array(ord, strain)) END AS members "
+            f"FROM candidates GROUP BY group_key{group_columns} "
+            "ORDER BY first"
         )
+        args = (
+            *args,
+            *[f'$."{key}"' for key in additional_keys],
+            min_group_size,
+            min_different_dates,
+        )
+        metadata.log_query(sql, args, self.conn)
+        groups = []
         with self.conn:
-            logger.debug(f"MatchDb run: {sql}")
-            for row in self.conn.execute(sql):
-                pkl = row.pop("pickle")
-                sample = pickle.loads(bz2.decompress(pkl))
-                logger.debug(
-                    f"MatchDb got: {sample.summary()} hmm_cost={row['hmm_cost']}"
+            for row in self.conn.execute(sql, args):
+                values = [row[f"key_{j}"] for j in range(len(additional_keys))]
+                if row["members"] is None:
+                    logger.debug(
+                        f"Skipping size={row['size']} dates={row['num_dates']}: "
+                        f"group_key={row['group_key']} additional_keys={values}"
+                    )
+                    continue
+                members = sorted(json.loads(row["members"]))
+                groups.append(
+                    (row["group_key"], values, [strain for _, strain in members])
                 )
-                # print(row)
-                yield sample
+        return groups
+
+    def explain(self, where_clause, args=()):
+        """
+        Return the query plan used by get for the specified where clause and
+        args, e.g. to check that the match_date index is used.
+        """
+        return metadata.explain_query_plan(
+            self.conn, self._get_sql(where_clause), args
+        )
 
     @staticmethod
-    def initialise(db_path):
+    def initialise(db_path, codec="bz2", training_samples=None, pragmas=None):
+        """
+        Create a new, empty MatchDb at the specified path, removing any
+        existing file. The pickled samples are compressed using the specified
+        codec ("bz2", "zstd" or "lz4"). For zstd, a list of example Samples
+        can be provided as training_samples, which is used to train a
+        compression dictionary. The returned MatchDb is opened with the
+        specified pragmas (see MatchDb).
+        """
+        dictionary = None
+        if training_samples is not None:
+            if codec != "zstd":
+                raise ValueError("Compression dictionaries require the zstd codec")
+            dictionary = compression.train_dictionary(
+                [pickle.dumps(sample) for sample in training_samples]
+            )
+        codec_config = {"name": codec, "has_dictionary": dictionary is not None}
+        return MatchDb._create(db_path, codec_config, dictionary, pragmas)
+
+    @staticmethod
+    def _create(db_path, codec_config, dictionary=None, pragmas=None):
+        codec = compression.get_codec(codec_config, dictionary)
         db_path = pathlib.Path(db_path)
-        if db_path.exists():
-            db_path.unlink()
-        sql = """\
+        # A stale write-ahead log would be applied to the new database
+        for suffix in ["", "-wal", "-shm"]:
+            path = db_path.with_name(db_path.name + suffix)
+            if path.exists():
+                path.unlink()
+        samples_sql = """\
             CREATE TABLE samples (
             strain TEXT,
             match_date TEXT,
             hmm_cost REAL,
+            group_key TEXT,
+            likelihood REAL,
+            metadata TEXT,
+            haplotype BLOB,
             pickle BLOB,
+            used INTEGER DEFAULT 0,
             PRIMARY KEY (strain))
             """
+        path_segments_sql = """\
+            CREATE TABLE path_segments (
+            strain TEXT,
+            seg_index INTEGER,
+            [left] INTEGER,
+            [right] INTEGER,
+            parent INTEGER,
+            PRIMARY KEY (strain, seg_index)) WITHOUT ROWID
+            """
+        match_mutations_sql = """\
+            CREATE TABLE match_mutations (
+            strain TEXT,
+            mut_index INTEGER,
+            site_id INTEGER,
+            site_position INTEGER,
+            inherited_state TEXT,
+            derived_state TEXT,
+            is_reversion INTEGER,
+            is_immediate_reversion INTEGER,
+            PRIMARY KEY (strain, mut_index)) WITHOUT ROWID
+            """
 
         with sqlite3.connect(db_path) as conn:
-            conn.execute(sql)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(samples_sql)
+            conn.execute(path_segments_sql)
+            conn.execute(match_mutations_sql)
+            conn.execute(
+                "CREATE TABLE used_samples (strain TEXT, PRIMARY KEY (strain))"
+            )
             conn.execute(
                 "CREATE INDEX [ix_samples_match_date] on 'samples' " "([match_date]);"
             )
+            conn.execute(
+                "CREATE INDEX [ix_samples_group_key] on 'samples' ([group_key]);"
+            )
+            conn.execute("CREATE TABLE metadata (key TEXT, value, PRIMARY KEY (key))")
+            conn.execute(
+                "INSERT INTO metadata VALUES (?, ?)",
+                ("codec", json.dumps(codec.asdict())),
+            )
+            if dictionary is not None:
+                conn.execute(
+                    "INSERT INTO metadata VALUES (?, ?)",
+                    ("codec_dictionary", dictionary),
+                )
         logger.info(f"Created new MatchDb at {db_path}")
-        return MatchDb(db_path)
+        return MatchDb(db_path, pragmas=pragmas)
 
     def print_all(self):
         """
@@ -215,6 +875,34 @@ class MatchDb:
         print(df)
 
 
+def migrate_match_db(source, dest, show_progress=False):
+    """
+    Convert the MatchDb at source, which uses an earlier schema version,
+    to a new MatchDb at dest with the current schema, keeping the same
+    codec and HMM costs. Returns the new MatchDb.
+    """
+    with MatchDb(source, readonly=True) as source_db:
+        if source_db.schema_version == MATCH_DB_SCHEMA_VERSION:
+            raise ValueError(f"MatchDb at {source} already has the current schema")
+        dictionary = source_db._get_metadata("codec_dictionary")
+        config = source_db.codec.asdict()
+        dest_db = MatchDb._create(dest, config, dictionary)
+        total = len(source_db)
+        with source_db.conn:
+            cursor = source_db.conn.execute("SELECT * FROM samples ORDER BY rowid")
+            with tqdm.tqdm(
+                total=total, desc="Migrate", disable=not show_progress
+            ) as bar:
+                while len(rows := cursor.fetchmany(MATCH_DB_PAGE_SIZE)) > 0:
+                    samples = decode_match_rows(
+                        source_db._page_payload(rows), source_db.codec
+                    )
+                    dest_db._insert(samples, [row["hmm_cost"] for row in rows])
+                    bar.update(len(rows))
+    logger.info(f"Migrated {total} samples from {source} to {dest}")
+    return dest_db
+
+
 def mirror(x, L):
     return L - x
 
@@ -378,22 +1066,35 @@ def pad_sites(ts):
 
 # TODO remove this
 def match_recombinants(
-    samples, base_ts, num_mismatches, show_progress=False, num_threads=None
+    samples,
+    base_ts,
+    num_mismatches,
+    show_progress=False,
+    num_threads=None,
+    tsb_cache=None,
+    hmm_cache=None,
 ):
-    for hmm_pass in ["forward", "reverse", "no_recombination"]:
-        logger.info(f"Running {hmm_pass} pass for {len(samples)} recombinants")
-        match_tsinfer(
-            samples=samples,
-            ts=base_ts,
-            num_mismatches=1000 if hmm_pass == "no_recombination" else num_mismatches,
-            mismatch_threshold=100,
-            num_threads=num_threads,
-            show_progress=show_progress,
-            mirror_coordinates=hmm_pass == "reverse",
-        )
+    with contextlib.ExitStack() as stack:
+        if tsb_cache is None:
+            tsb_cache = stack.enter_context(TsbCache())
+        for hmm_pass in ["forward", "reverse", "no_recombination"]:
+            logger.info(f"Running {hmm_pass} pass for {len(samples)} recombinants")
+            match_tsinfer(
+                samples=samples,
+                ts=base_ts,
+                num_mismatches=(
+                    1000 if hmm_pass == "no_recombination" else num_mismatches
+                ),
+                mismatch_threshold=100,
+                num_threads=num_threads,
+                show_progress=show_progress,
+                mirror_coordinates=hmm_pass == "reverse",
+                tsb_cache=tsb_cache,
+                hmm_cache=hmm_cache,
+            )
 
-        for sample in samples:
-            sample.hmm_reruns[hmm_pass] = sample.hmm_match
+            for sample in samples:
+                sample.hmm_reruns[hmm_pass] = sample.hmm_match
 
 
 def match_samples(
@@ -405,50 +1106,107 @@ def match_samples(
     num_mismatches=None,
     show_progress=False,
     num_threads=None,
+    tsb_cache=None,
+    haplotype_index=None,
+    hmm_cache=None,
 ):
-    run_batch = samples
+    # Samples with the same effective haplotype get the same match, so we
+    # only match one representative of each.
+    groups = collections.defaultdict(list)
+    for sample in samples:
+        digest = haplotype_digest(sample.haplotype, deletions_as_missing)
+        groups[digest].append(sample)
+    unique_samples = [group[0] for group in groups.values()]
+    logger.info(
+        f"Matching {len(unique_samples)} unique haplotypes for {len(samples)} "
+        f"samples (dedup ratio={len(samples) / max(len(unique_samples), 1):.2f})"
+    )
+
+    if haplotype_index is None:
+        haplotype_index = HaplotypeIndex()
+    haplotype_index.update(base_ts)
+    run_batch = []
+    for sample in unique_samples:
+        node = haplotype_index.lookup(sample.haplotype, deletions_as_missing)
+        if node == -1:
+            run_batch.append(sample)
+        else:
+            path = [PathSegment(0, int(base_ts.sequence_length), node)]
+            sample.hmm_match = HmmMatch(path, [], likelihood=1.0)
+            logger.debug(f"Exact match {sample.strain}->{node} in haplotype index")
+    logger.info(
+        f"{len(unique_samples) - len(run_batch)} exact matches found in "
+        f"haplotype index; {len(run_batch)} remain"
+    )
 
-    for k in range(2):
-        logger.info(f"Running match={k} batch of {len(run_batch)}")
+    # All passes use the same TreeSequenceBuilder, which is freed on return
+    # unless owned by the caller.
+    with contextlib.ExitStack() as stack:
+        if tsb_cache is None:
+            tsb_cache = stack.enter_context(TsbCache())
+
+        for k in range(2):
+            logger.info(f"Running match={k} batch of {len(run_batch)}")
+            match_tsinfer(
+                samples=run_batch,
+                ts=base_ts,
+                num_mismatches=num_mismatches,
+                mismatch_threshold=k,
+                deletions_as_missing=deletions_as_missing,
+                num_threads=num_threads,
+                show_progress=show_progress,
+                progress_title=date,
+                progress_phase=f"match({k})",
+                tsb_cache=tsb_cache,
+                hmm_cache=hmm_cache,
+            )
+
+            exceeding_threshold = []
+            for sample in run_batch:
+                cost = sample.hmm_match.get_hmm_cost(num_mismatches)
+                if cost > k + 1:
+                    exceeding_threshold.append(sample)
+
+            num_matches_found = len(run_batch) - len(exceeding_threshold)
+            logger.info(
+                f"{num_matches_found} final matches found at k={k}; "
+                f"{len(exceeding_threshold)} remain"
+            )
+            run_batch = exceeding_threshold
+
+        logger.info(f"Running final batch of {len(run_batch)} at high precision")
         match_tsinfer(
             samples=run_batch,
             ts=base_ts,
             num_mismatches=num_mismatches,
-            mismatch_threshold=k,
+            # FIXME! temporary hack to enable big inference
+            num_threads=num_threads // 2,
             deletions_as_missing=deletions_as_missing,
-            num_threads=num_threads,
             show_progress=show_progress,
             progress_title=date,
-            progress_phase=f"match({k})",
+            progress_phase=f"match(F)",
+            tsb_cache=tsb_cache,
+            hmm_cache=hmm_cache,
         )
 
-        exceeding_threshold = []
-        for sample in run_batch:
-            cost = sample.hmm_match.get_hmm_cost(num_mismatches)
-            if cost > k + 1:
-                exceeding_threshold.append(sample)
-
-        num_matches_found = len(run_batch) - len(exceeding_threshold)
-        logger.info(
-            f"{num_matches_found} final matches found at k={k}; "
-            f"{len(exceeding_threshold)} remain"
-        )
-        run_batch = exceeding_threshold
-
-    logger.info(f"Running final batch of {len(run_batch)} at high precision")
-    match_tsinfer(
-        samples=run_batch,
-        ts=base_ts,
-        num_mismatches=num_mismatches,
-        num_threads=num_threads // 2,  # FIXME! temporary hack to enable big inference
-        deletions_as_missing=deletions_as_missing,
-        show_progress=show_progress,
-        progress_title=date,
-        progress_phase=f"match(F)",
-    )
+    for group in groups.values():
+        for sample in group[1:]:
+            sample.hmm_match = group[0].hmm_match.copy()
     return samples
 
 
+def haplotype_digest(haplotype, deletions_as_missing=False):
+    """
+    Return a digest of the haplotype used when matching the specified
+    sample haplotype, in which deletions are missing data if
+    deletions_as_missing is True.
+    """
+    h = np.asarray(haplotype, dtype=np.int8)
+    if deletions_as_missing:
+        h = np.where(h == DELETION, MISSING, h).astype(np.int8)
+    return hashlib.sha256(h.tobytes()).hexdigest()
+
+
 def check_base_ts(ts):
     md = ts.metadata
     assert "sc2ts" in md
@@ -458,21 +1216,210 @@ def check_base_ts(ts):
     return sc2ts_md["date"]
 
 
-def preprocess_worker(strains, alignment_store_path, keep_sites):
+def prefilter_missing_sites(
+    alignment_store, strains, num_keep_sites, max_missing_sites
+):
+    """
+    Return the strains that may have at most max_missing_sites missing sites
+    among the num_keep_sites sites used for matching, using the alignment
+    summaries stored at import to avoid decoding alignments. Only sites
+    outside the kept sites can account for the difference between the
+    total number of missing sites and the number at kept sites, so strains
+    are only removed if they must exceed the threshold. Strains without
+    summaries are retained.
+    """
+    summaries, no_summary = alignment_store.get_summaries(strains)
+    num_other_sites = core.REFERENCE_SEQUENCE_LENGTH - 1 - num_keep_sites
+    lower_bound = alignments.num_missing_sites(summaries) - num_other_sites
+    remove = ~no_summary & (lower_bound > max_missing_sites)
+    for j in np.where(remove)[0]:
+        logger.debug(
+            f"Filter {strains[j]}: missing>={lower_bound[j]} > {max_missing_sites}"
+        )
+    logger.info(f"Prefiltered {np.sum(remove)} samples on missing sites")
+    return [strain for strain, r in zip(strains, remove) if not r]
+
+
+# Alignment store kept open by each preprocess worker process between
+# tasks, along with its path, file identity and modification time (so that
+# stores that are replaced or written to on disk are reopened rather than
+# read through a stale readonly environment).
+_worker_alignment_store = None
+_worker_alignment_store_key = None
+
+
+def _alignment_store_key(path):
+    # The identity and modification time of each file in the store. A
+    # sharded store is a directory, whose mtime doesn't change when the
+    # shards are written to, so we use its metadata and shard files.
+    path = pathlib.Path(path)
+    files = [path]
+    if path.is_dir():
+        files = [path / "shards.json", *sorted(path.glob("shard_*.db"))]
+    key = [str(path)]
+    for file in files:
+        stat = os.stat(file)
+        key.append((stat.st_dev, stat.st_ino, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def _get_worker_alignment_store(path):
+    global _worker_alignment_store
+    global _worker_alignment_store_key
+    key = _alignment_store_key(path)
+    if _worker_alignment_store_key != key:
+        if _worker_alignment_store is not None:
+            _worker_alignment_store.close()
+        _worker_alignment_store = alignments.open_alignment_store(path)
+        _worker_alignment_store_key = key
+    return _worker_alignment_store
+
+
+def _attach_shared_memory(name):
+    # Pool workers share the parent's resource tracker (whether forked or
+    # spawned), so registering the segment again on attach is harmless and
+    # the parent's unlink unregisters it. Unregistering here would remove
+    # the parent's registration too.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def preprocess_worker(strains, alignment_store_path, keep_sites, shm_name, offset):
     assert keep_sites is not None
-    with alignments.AlignmentStore(alignment_store_path) as alignment_store:
+    alignment_store = _get_worker_alignment_store(alignment_store_path)
+    # The composition includes the original ambiguous bases, which are
+    # all encoded as missing data.
+    H, missing, compositions = alignment_store.get_many(
+        strains, keep_sites, composition=True
+    )
+    shm = _attach_shared_memory(shm_name)
+    try:
+        out = np.ndarray(
+            (offset + len(strains), len(keep_sites)), dtype=np.int8, buffer=shm.buf
+        )
+        out[offset:] = H
+        del out
+    finally:
+        shm.close()
+    return missing, compositions
+
+
+class PreprocessPool:
+    """
+    A pool of worker processes for preprocessing samples that is reused
+    across calls (see get_preprocess_pool). Workers keep the alignment
+    store open between tasks, and write haplotypes directly into a shared
+    memory matrix rather than returning them through pickles.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.executor = cf.ProcessPoolExecutor(max_workers=num_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def preprocess(
+        self,
+        strains,
+        alignment_store_path,
+        *,
+        keep_sites,
+        progress_title="",
+        show_progress=False,
+    ):
+        """
+        Return the list of Samples for the specified strains, in the same
+        order, with haplotypes at the specified sites. Strains that are
+        not in the alignment store have no haplotype.
+        """
+        if len(strains) == 0:
+            return []
+        keep_sites = np.asarray(keep_sites)
+        strains = list(strains)
+        splits = min(len(strains), 2 * self.num_workers)
+        offsets = np.linspace(0, len(strains), splits + 1).astype(int)
+        shape = (len(strains), len(keep_sites))
+        bar = get_progress(strains, progress_title, "preprocess", show_progress)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, np.prod(shape)))
+        try:
+            futures = {}
+            for start, stop in zip(offsets[:-1], offsets[1:]):
+                future = self.executor.submit(
+                    preprocess_worker,
+                    strains[start:stop],
+                    alignment_store_path,
+                    keep_sites,
+                    shm.name,
+                    start,
+                )
+                futures[future] = start
+            missing = np.ones(len(strains), dtype=bool)
+            compositions = [None] * len(strains)
+            for future in cf.as_completed(futures):
+                start = futures[future]
+                chunk_missing, chunk_compositions = future.result()
+                stop = start + len(chunk_missing)
+                missing[start:stop] = chunk_missing
+                compositions[start:stop] = chunk_compositions
+                bar.update(stop - start)
+            H = np.ndarray(shape, dtype=np.int8, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        bar.close()
+
         samples = []
-        for strain in strains:
-            alignment = alignment_store.get(strain, None)
+        for j, strain in enumerate(strains):
             sample = Sample(strain)
-            if alignment is not None:
-                a = alignment[keep_sites]
-                sample.haplotype = alignments.encode_alignment(a)
-                # Need to do this here because encoding gets rid of
-                # ambiguous bases etc.
-                sample.alignment_composition = collections.Counter(a)
+            if not missing[j]:
+                sample.haplotype = H[j]
+                sample.alignment_composition = compositions[j]
             samples.append(sample)
-    return samples
+        return samples
+
+
+__cached_preprocess_pool = None
+
+
+def get_preprocess_pool(num_workers=0):
+    """
+    Return the PreprocessPool with the specified number of workers, reusing
+    the pool from the previous call if possible.
+    """
+    global __cached_preprocess_pool
+    num_workers = max(1, num_workers)
+    pool = __cached_preprocess_pool
+    if pool is not None and pool.num_workers != num_workers:
+        pool.close()
+        pool = None
+    if pool is None:
+        logger.debug(f"Starting preprocess pool with {num_workers} workers")
+        pool = PreprocessPool(num_workers)
+        __cached_preprocess_pool = pool
+    return pool
+
+
+def shutdown_preprocess_pool():
+    """
+    Shut down the PreprocessPool cached by get_preprocess_pool, if any.
+    """
+    global __cached_preprocess_pool
+    if __cached_preprocess_pool is not None:
+        __cached_preprocess_pool.close()
+        __cached_preprocess_pool = None
+
+
+# Shut the cached pool's workers down cleanly at exit rather than leaving
+# the executor to be torn down during interpreter finalisation.
+atexit.register(shutdown_preprocess_pool)
 
 
 def preprocess(
@@ -484,24 +1431,14 @@ def preprocess(
     show_progress=False,
     num_workers=0,
 ):
-    if len(strains) == 0:
-        return []
-    num_workers = max(1, num_workers)
-    splits = min(len(strains), 2 * num_workers)
-    work = np.array_split(strains, splits)
-    samples = []
-    bar = get_progress(strains, progress_title, "preprocess", show_progress)
-    with cf.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        futures = [
-            executor.submit(preprocess_worker, w, alignment_store_path, keep_sites)
-            for w in work
-        ]
-        for future in cf.as_completed(futures):
-            for s in future.result():
-                bar.update()
-                samples.append(s)
-    bar.close()
-    return samples
+    pool = get_preprocess_pool(num_workers)
+    return pool.preprocess(
+        strains,
+        alignment_store_path,
+        keep_sites=keep_sites,
+        progress_title=progress_title,
+        show_progress=show_progress,
+    )
 
 
 def extend(
@@ -525,6 +1462,9 @@ def extend(
     max_missing_sites=None,
     random_seed=42,
     num_threads=0,
+    tsb_cache=None,
+    haplotype_index=None,
+    hmm_cache=None,
 ):
     if num_mismatches is None:
         num_mismatches = 3
@@ -553,14 +1493,23 @@ def extend(
         f"mutations={base_ts.num_mutations};date={previous_date}"
     )
 
-    metadata_matches = {md["strain"]: md for md in metadata_db.get(date)}
+    # Only the strains are needed until we know which samples have
+    # alignments, so avoid building the metadata rows for the others.
+    strains = list(metadata_db.get_range(date, date, columns=["strain"])["strain"])
+    num_metadata_matches = len(strains)
 
-    logger.info(f"Got {len(metadata_matches)} metadata matches")
+    logger.info(f"Got {num_metadata_matches} metadata matches")
+
+    keep_sites = base_ts.sites_position.astype(int)
+    if max_missing_sites < np.inf:
+        strains = prefilter_missing_sites(
+            alignment_store, strains, len(keep_sites), max_missing_sites
+        )
 
     preprocessed_samples = preprocess(
-        strains=list(metadata_matches.keys()),
+        strains=strains,
         alignment_store_path=alignment_store.path,
-        keep_sites=base_ts.sites_position.astype(int),
+        keep_sites=keep_sites,
         progress_title=date,
         show_progress=show_progress,
         num_workers=num_threads,
@@ -568,12 +1517,17 @@ def extend(
     # FIXME parametrise
     pango_lineage_key = "Viridian_pangolin"
 
-    samples = []
+    aligned_samples = []
     for s in preprocessed_samples:
         if s.haplotype is None:
             logger.debug(f"No alignment stored for {s.strain}")
-            continue
-        md = metadata_matches[s.strain]
+        else:
+            aligned_samples.append(s)
+    preprocessed_samples = aligned_samples
+    metadata_rows = metadata_db.get_many([s.strain for s in preprocessed_samples])
+
+    samples = []
+    for s, md in zip(preprocessed_samples, metadata_rows):
         s.metadata = md
         s.pango = md.get(pango_lineage_key, "Unknown")
         s.date = date
@@ -601,7 +1555,7 @@ def extend(
     ts = increment_time(date, base_ts)
     if len(samples) > 0:
         logger.info(
-            f"Got alignments for {len(samples)} of {len(metadata_matches)} in metadata"
+            f"Got alignments for {len(samples)} of {num_metadata_matches} in metadata"
         )
 
         samples = match_samples(
@@ -612,6 +1566,9 @@ def extend(
             deletions_as_missing=deletions_as_missing,
             show_progress=show_progress,
             num_threads=num_threads,
+            tsb_cache=tsb_cache,
+            haplotype_index=haplotype_index,
+            hmm_cache=hmm_cache,
         )
 
         characterise_match_mutations(base_ts, samples)
@@ -623,7 +1580,8 @@ def extend(
 
         logger.info(f"Update ARG with low-cost samples for {date}")
         ts, _ = add_matching_results(
-            f"match_date=='{date}' and hmm_cost>0 and hmm_cost<={hmm_cost_threshold}",
+            "match_date==? AND hmm_cost>0 AND hmm_cost<=?",
+            where_args=(date, hmm_cost_threshold),
             ts=ts,
             match_db=match_db,
             date=date,
@@ -631,13 +1589,15 @@ def extend(
             additional_node_flags=core.NODE_IN_SAMPLE_GROUP,
             show_progress=show_progress,
             phase="close",
+            num_workers=num_threads,
         )
 
     logger.info("Looking for retrospective matches")
     assert min_group_size is not None
     earliest_date = parse_date(date) - datetime.timedelta(days=retrospective_window)
     ts, groups = add_matching_results(
-        f"hmm_cost>0 AND match_date<'{date}' AND match_date>'{earliest_date}'",
+        "hmm_cost>0 AND match_date<? AND match_date>?",
+        where_args=(date, str(earliest_date)),
         ts=ts,
         match_db=match_db,
         date=date,
@@ -649,6 +1609,7 @@ def extend(
         additional_node_flags=core.NODE_IN_RETROSPECTIVE_SAMPLE_GROUP,
         show_progress=show_progress,
         phase="retro",
+        num_workers=num_threads,
     )
     for group in groups:
         logger.warning(
@@ -658,6 +1619,32 @@ def extend(
     return update_top_level_metadata(ts, date, groups, len(samples))
 
 
+def extend_days(*, base_ts, dates, tsb_cache=None, haplotype_index=None, **kwargs):
+    """
+    Extend base_ts with the samples for each of the specified dates in
+    turn, yielding the (date, ts) pair for each day. The remaining arguments
+    are passed to extend. The TsbCache (incremental by default) and the
+    HaplotypeIndex are kept across days, so that the TreeSequenceBuilder
+    and haplotype index for each day's ARG are updated from the previous
+    day's rather than being rebuilt from scratch.
+    """
+    if haplotype_index is None:
+        haplotype_index = HaplotypeIndex()
+    with contextlib.ExitStack() as stack:
+        if tsb_cache is None:
+            tsb_cache = stack.enter_context(TsbCache(incremental=True))
+        ts = base_ts
+        for date in dates:
+            ts = extend(
+                base_ts=ts,
+                date=date,
+                tsb_cache=tsb_cache,
+                haplotype_index=haplotype_index,
+                **kwargs,
+            )
+            yield date, ts
+
+
 def update_top_level_metadata(ts, date, retro_groups, num_samples):
     tables = ts.dump_tables()
     md = tables.metadata
@@ -733,9 +1720,9 @@ def match_path_ts(group):
 
 
 def add_exact_matches(match_db, ts, date):
-    where_clause = f"match_date=='{date}' AND hmm_cost==0"
-    logger.info(f"Querying match DB WHERE: {where_clause}")
-    samples = list(match_db.get(where_clause))
+    where_clause = "match_date==? AND hmm_cost==0"
+    logger.info(f"Querying match DB WHERE: {where_clause} ({date})")
+    samples = list(match_db.get(where_clause, (date,)))
     if len(samples) == 0:
         logger.info(f"No exact matches on {date}")
         return ts
@@ -887,62 +1874,68 @@ def add_matching_results(
     show_progress=False,
     additional_group_metadata_keys=list(),
     phase=None,
+    where_args=(),
+    num_workers=0,
 ):
-    logger.info(f"Querying match DB WHERE: {where_clause}")
-
-    # Group matches by path and set of immediate reversions.
-    grouped_matches = collections.defaultdict(list)
-    site_missing_samples = np.zeros(ts.num_sites, dtype=int)
-    site_deletion_samples = np.zeros(ts.num_sites, dtype=int)
-    num_samples = 0
-    for sample in match_db.get(where_clause):
-        assert all(mut.is_reversion is not None for mut in sample.hmm_match.mutations)
-        assert all(
-            mut.is_immediate_reversion is not None for mut in sample.hmm_match.mutations
-        )
-        path = tuple(sample.hmm_match.path)
-        immediate_reversions = tuple(
-            (mut.site_id, mut.derived_state)
-            for mut in sample.hmm_match.mutations
-            if mut.is_immediate_reversion
-        )
-        additional_metadata = [
-            sample.metadata.get(k, None) for k in additional_group_metadata_keys
-        ]
-        key = (path, immediate_reversions, *additional_metadata)
-        grouped_matches[key].append(sample)
-        num_samples += 1
+    logger.info(f"Querying match DB WHERE: {where_clause} {tuple(where_args)}")
 
+    num_samples = match_db.count(where_clause, where_args)
     if num_samples == 0:
         logger.info("No candidate samples found in MatchDb")
         return ts, []
 
-    groups = [
-        SampleGroup(
-            samples,
-            key[0],
-            key[1],
-            {k: v for k, v in zip(additional_group_metadata_keys, key[2:])},
-        )
-        for key, samples in grouped_matches.items()
+    # Group matches by path and set of immediate reversions. This is done
+    # in SQL using the precomputed group key, so that we only need to
+    # materialise the samples in groups that are large enough to add.
+    candidate_groups = match_db.get_groups(
+        where_clause,
+        where_args,
+        additional_keys=additional_group_metadata_keys,
+        min_group_size=min_group_size,
+        min_different_dates=min_different_dates,
+    )
+    strains = [
+        strain for _, _, group_strains in candidate_groups for strain in group_strains
     ]
-    logger.info(f"Got {len(groups)} groups for {num_samples} samples")
+    samples = dict(zip(strains, match_db.get_many(strains, num_workers=num_workers)))
+    groups = []
+    for _, additional_values, group_strains in candidate_groups:
+        group_samples = [samples[strain] for strain in group_strains]
+        for sample in group_samples:
+            assert all(
+                mut.is_reversion is not None for mut in sample.hmm_match.mutations
+            )
+            assert all(
+                mut.is_immediate_reversion is not None
+                for mut in sample.hmm_match.mutations
+            )
+        hmm_match = group_samples[0].hmm_match
+        immediate_reversions = tuple(
+            (mut.site_id, mut.derived_state)
+            for mut in hmm_match.mutations
+            if mut.is_immediate_reversion
+        )
+        groups.append(
+            SampleGroup(
+                group_samples,
+                tuple(hmm_match.path),
+                immediate_reversions,
+                dict(zip(additional_group_metadata_keys, additional_values)),
+            )
+        )
+    logger.info(
+        f"Got {len(groups)} groups with at least {min_group_size} samples and "
+        f"{min_different_dates} dates for {num_samples} samples"
+    )
 
+    site_missing_samples = np.zeros(ts.num_sites, dtype=int)
+    site_deletion_samples = np.zeros(ts.num_sites, dtype=int)
     tables = ts.dump_tables()
 
     attach_nodes = []
     added_groups = []
     with get_progress(groups, date, f"add({phase})", show_progress) as bar:
         for group in bar:
-            if (
-                len(group) < min_group_size
-                or len(group.date_count) < min_different_dates
-            ):
-                logger.debug(
-                    f"Skipping size={len(group)} dates={len(group.date_count)}: "
-                    f"{group.summary()}"
-                )
-                continue
             flat_ts = match_path_ts(group)
             if flat_ts.num_mutations == 0 or flat_ts.num_samples == 1:
                 poly_ts = flat_ts
@@ -1111,6 +2104,702 @@ def delete_immediate_reversion_nodes(ts, attach_nodes):
     return tables.tree_sequence()
 
 
+DEFAULT_HMM_CACHE_SIZE = 2**30
+
+
+def ts_digest(ts):
+    """
+    Return a digest of the parts of the specified ARG that affect the
+    HMM matches made against it.
+    """
+    # Only the state columns lack ts.* array accessors. ts.tables is a
+    # zero-copy view for numpy 2 builds of tskit, and a single copy otherwise.
+    tables = ts.tables
+    sites = tables.sites
+    mutations = tables.mutations
+    h = hashlib.sha256()
+    for column in [
+        ts.nodes_flags,
+        ts.nodes_time,
+        ts.edges_left,
+        ts.edges_right,
+        ts.edges_parent,
+        ts.edges_child,
+        ts.sites_position,
+        sites.ancestral_state,
+        sites.ancestral_state_offset,
+        ts.mutations_site,
+        ts.mutations_node,
+        ts.mutations_parent,
+        mutations.derived_state,
+        mutations.derived_state_offset,
+    ]:
+        h.update(len(column).to_bytes(8, "little"))
+        h.update(column.tobytes())
+    return h.hexdigest()
+
+
+class HmmCache:
+    """
+    A persistent on-disk cache of the HMM matches made by match_tsinfer,
+    so that rerunning a day or rematching samples against the same ARG
+    doesn't repeat the work. Matches are keyed by the sample's haplotype,
+    the ARG and the matching parameters, and the least recently used
+    matches are evicted when the total size of the stored matches exceeds
+    max_size bytes. The cache can be shared by several processes.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_HMM_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.num_hits = 0
+        self.num_misses = 0
+        self.conn = metadata.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS hmm_matches ("
+                "key TEXT PRIMARY KEY, hmm_match BLOB, size INTEGER, "
+                "last_used INTEGER) WITHOUT ROWID"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_hmm_matches_last_used "
+                "ON hmm_matches(last_used)"
+            )
+        # The digest of the last ARG used, as it's expensive to compute
+        self._ts = None
+        self._ts_digest = None
+        logger.debug(f"Opened HmmCache at {path} with {len(self)} matches")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self.conn:
+            row = self.conn.execute("SELECT COUNT(*) FROM hmm_matches").fetchone()
+        return row["COUNT(*)"]
+
+    def close(self):
+        logger.info(
+            f"HmmCache at {self.path}: hits={self.num_hits} misses={self.num_misses}"
+        )
+        self.conn.close()
+
+    @property
+    def size(self):
+        """
+        The total size in bytes of the stored matches.
+        """
+        with self.conn:
+            row = self.conn.execute("SELECT SUM(size) FROM hmm_matches").fetchone()
+        return row["SUM(size)"] or 0
+
+    def key(
+        self,
+        haplotype,
+        ts,
+        *,
+        num_mismatches,
+        mismatch_threshold,
+        likelihood_threshold,
+        mirror_coordinates=False,
+        deletions_as_missing=False,
+    ):
+        """
+        Return the key for the match of the specified haplotype against ts.
+        """
+        if ts is not self._ts:
+            self._ts_digest = ts_digest(ts)
+            self._ts = ts
+        parts = [
+            haplotype_digest(haplotype, deletions_as_missing),
+            self._ts_digest,
+            float(num_mismatches),
+            mismatch_threshold,
+            float(likelihood_threshold),
+            "reverse" if mirror_coordinates else "forward",
+            bool(deletions_as_missing),
+        ]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return the HmmMatch stored for the specified key, or None.
+        """
+        return self.get_many([key])[0]
+
+    def get_many(self, keys, batch_size=MATCH_DB_PAGE_SIZE):
+        """
+        Return the list of HmmMatches stored for the specified keys, in the
+        same order, with None for keys that are not in the cache. The last
+        used times of the matches found are updated together for each batch.
+        """
+        keys = list(keys)
+        hmm_matches = []
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start : start + batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            with self.conn:
+                rows = {
+                    row["key"]: row["hmm_match"]
+                    for row in self.conn.execute(
+                        "SELECT key, hmm_match FROM hmm_matches "
+                        f"WHERE key IN ({placeholders})",
+                        batch,
+                    )
+                }
+                now = time.time_ns()
+                self.conn.executemany(
+                    "UPDATE hmm_matches SET last_used=? WHERE key==?",
+                    [(now, key) for key in rows],
+                )
+            for key in batch:
+                pkl = rows.get(key)
+                hmm_matches.append(None if pkl is None else pickle.loads(pkl))
+        num_hits = sum(hmm_match is not None for hmm_match in hmm_matches)
+        self.num_hits += num_hits
+        self.num_misses += len(keys) - num_hits
+        return hmm_matches
+
+    def put(self, items):
+        """
+        Store the specified (key, HmmMatch) pairs, evicting the least
+        recently used matches if the cache exceeds its maximum size.
+        """
+        data = []
+        for key, hmm_match in items:
+            pkl = pickle.dumps(hmm_match)
+            data.append((key, pkl, len(pkl), time.time_ns()))
+        if len(data) == 0:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hmm_matches VALUES (?, ?, ?, ?)", data
+            )
+            num_evicted = 0
+            row = self.conn.execute("SELECT SUM(size) FROM hmm_matches").fetchone()
+            if row["SUM(size)"] > self.max_size:
+                num_evicted = self.conn.execute(
+                    "DELETE FROM hmm_matches WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(size) OVER "
+                    "(ORDER BY last_used DESC, key) AS total FROM hmm_matches) "
+                    "WHERE total > ?)",
+                    (self.max_size,),
+                ).rowcount
+        logger.debug(f"Stored {len(data)} matches in HmmCache; evicted {num_evicted}")
+
+
+class TsbCache:
+    """
+    A cache of the TreeSequenceBuilders and coordinate maps returned by
+    make_tsb, so that a builder is built once for each (ts, num_alleles,
+    mirror_coordinates) combination and shared by all the match passes
+    that use it (matching only reads the builder). Builders can use a lot
+    of memory for large ARGs, so they should be freed when no longer needed
+    by calling free, or by using the cache as a context manager.
+
+    If incremental is True the cache is intended to be kept across
+    consecutive days: when asked for a builder for a new ts, the builder
+    for the previous ts is updated in place with update_tsb where possible
+    rather than being rebuilt from scratch, and builders for older ARGs are
+    dropped. If verify is True, every builder returned for a new ts is
+    checked against a fresh make_tsb, raising a ValueError if they differ.
+    """
+
+    def __init__(self, incremental=False, verify=False):
+        self.incremental = incremental
+        self.verify = verify
+        self.entries = {}
+        self.num_builds = 0
+        self.num_updates = 0
+        self.num_hits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.free()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, ts, num_alleles, mirror_coordinates=False):
+        """
+        Return the (tsb, coord_map) pair for the specified parameters, as
+        returned by make_tsb.
+        """
+        # We keep a reference to ts in the entry, so its id can't be reused
+        key = (id(ts), num_alleles, mirror_coordinates)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.num_hits += 1
+            return entry[1:3]
+        before = time.perf_counter()
+        if self.incremental:
+            entry = self._update(ts, num_alleles, mirror_coordinates)
+        if entry is None:
+            tsb, coord_map = make_tsb(ts, num_alleles, mirror_coordinates)
+            entry = (ts, tsb, coord_map, 0)
+            self.num_builds += 1
+            action = "Built"
+        else:
+            self.num_updates += 1
+            action = "Updated"
+        logger.info(
+            f"{action} TreeSequenceBuilder num_alleles={num_alleles} "
+            f"mirror_coordinates={mirror_coordinates} in "
+            f"{time.perf_counter() - before:.2f}s"
+        )
+        if self.verify:
+            verify_tsb(entry[1], ts, num_alleles, mirror_coordinates, entry[3])
+        self.entries[key] = entry
+        return entry[1:3]
+
+    def _update(self, ts, num_alleles, mirror_coordinates):
+        previous = None
+        for key in list(self.entries.keys()):
+            entry = self.entries[key]
+            if entry[0] is not ts:
+                # Builders for older ARGs won't be needed again
+                del self.entries[key]
+                if key[1:] == (num_alleles, mirror_coordinates):
+                    previous = entry
+        if previous is None or mirror_coordinates:
+            # Mirroring changes the coordinates of all edges, so we don't
+            # try to update mirrored builders
+            return None
+        base_ts, tsb, coord_map, time_offset = previous
+        time_offset = update_tsb(tsb, base_ts, ts, time_offset)
+        if time_offset is None:
+            logger.info("Cannot update TreeSequenceBuilder incrementally")
+            return None
+        return (ts, tsb, coord_map, time_offset)
+
+    def free(self):
+        """
+        Release all the cached builders.
+        """
+        logger.debug(
+            f"Freeing {len(self.entries)} TreeSequenceBuilders "
+            f"(builds={self.num_builds} updates={self.num_updates} "
+            f"hits={self.num_hits})"
+        )
+        self.entries.clear()
+
+
+def _extension_time_shift(base_ts, ts):
+    """
+    Return the uniform shift in node times between base_ts and ts if ts
+    extends base_ts by appending nodes along with their edges and mutations,
+    leaving the sites and the existing nodes, edges and mutations unchanged.
+    Return None otherwise.
+    """
+    n = base_ts.num_nodes
+    if (
+        ts.num_nodes < n
+        or not np.array_equal(ts.sites_position, base_ts.sites_position)
+        or not np.array_equal(ts.nodes_flags[:n], base_ts.nodes_flags)
+    ):
+        return None
+    shift = ts.nodes_time[:n] - base_ts.nodes_time
+    if n > 0 and not np.allclose(shift, shift[0]):
+        return None
+    # Accessing ts.tables copies all the tables, so only do it once.
+    base_tables = base_ts.tables
+    tables = ts.tables
+    if not np.array_equal(
+        tables.sites.ancestral_state, base_tables.sites.ancestral_state
+    ):
+        return None
+
+    # The relative order of the existing edges and mutations is unchanged
+    # by appending new ones, so we can compare them without sorting.
+    base_edges = base_ts.edges_child < n
+    edges = ts.edges_child < n
+    for column in ["left", "right", "parent", "child"]:
+        a = getattr(base_ts, f"edges_{column}")[base_edges]
+        b = getattr(ts, f"edges_{column}")[edges]
+        if not np.array_equal(a, b):
+            return None
+    base_mutations = base_ts.mutations_node < n
+    mutations = ts.mutations_node < n
+    if not (
+        np.array_equal(
+            base_ts.mutations_site[base_mutations], ts.mutations_site[mutations]
+        )
+        and np.array_equal(
+            base_ts.mutations_node[base_mutations], ts.mutations_node[mutations]
+        )
+        and np.array_equal(
+            base_tables.mutations.derived_state[base_mutations],
+            tables.mutations.derived_state[mutations],
+        )
+    ):
+        return None
+    return shift[0] if n > 0 else 0
+
+
+def update_tsb(tsb, base_ts, ts, time_offset=0):
+    """
+    Update the specified TreeSequenceBuilder, which represents base_ts with
+    node times reduced by time_offset, in place so that it represents ts.
+    This is only possible when ts extends base_ts by appending nodes along
+    with their edges and mutations, leaving the existing nodes, edges and
+    mutations unchanged up to a uniform shift in node times (as made by
+    increment_time). The builder cannot delete edges or mutations, so days
+    on which existing nodes were rewired (e.g. by coalesce_mutations) must
+    be rebuilt with make_tsb instead. Returns the time_offset of the updated
+    builder, or None (leaving tsb unchanged) if ts cannot be reached from
+    base_ts in this way.
+    """
+    shift = _extension_time_shift(base_ts, ts)
+    if shift is None:
+        return None
+    n = base_ts.num_nodes
+    time_offset += shift
+    for u in range(n, ts.num_nodes):
+        v = tsb.add_node(ts.nodes_time[u] - time_offset, int(ts.nodes_flags[u]))
+        assert v == u
+
+    position_map = np.hstack([ts.sites_position, [ts.sequence_length]])
+    position_map[0] = 0
+    edges = ts.edges_child >= n
+    left = np.searchsorted(position_map, ts.edges_left[edges])
+    if np.any(position_map[left] != ts.edges_left[edges]):
+        raise ValueError("Invalid left coordinates")
+    right = np.searchsorted(position_map, ts.edges_right[edges])
+    if np.any(position_map[right] != ts.edges_right[edges]):
+        raise ValueError("Invalid right coordinates")
+    child = ts.edges_child[edges]
+    parent = ts.edges_parent[edges]
+    index = np.lexsort((left, child))
+    left = left[index].astype(np.uint32)
+    right = right[index].astype(np.uint32)
+    parent = parent[index]
+    child = child[index]
+    # Paths must be added for a child all at once, left-to-right
+    breaks = np.where(np.diff(child) != 0)[0] + 1
+    for start, end in zip(np.hstack([[0], breaks]), np.hstack([breaks, [len(child)]])):
+        tsb.add_path(
+            int(child[start]),
+            left[start:end],
+            right[start:end],
+            parent[start:end],
+            compress=False,
+        )
+
+    mutations = ts.mutations_node >= n
+    tables = ts.tables
+    assert np.all(
+        tables.mutations.derived_state_offset == np.arange(ts.num_mutations + 1)
+    )
+    derived_state = alignments.encode_alignment(
+        tables.mutations.derived_state[mutations].view("S1").astype(str)
+    )
+    site = ts.mutations_site[mutations]
+    node = ts.mutations_node[mutations]
+    for u in np.unique(node):
+        selection = node == u
+        tsb.add_mutations(int(u), site[selection], derived_state[selection])
+    tsb.freeze_indexes()
+    assert tsb.num_match_nodes == ts.num_nodes
+    return time_offset
+
+
+def verify_tsb(tsb, ts, num_alleles, mirror_coordinates=False, time_offset=0):
+    """
+    Check that the specified TreeSequenceBuilder, whose node times are
+    reduced by time_offset, is equivalent to the one returned by make_tsb
+    for the specified parameters, raising a ValueError if not.
+    """
+    expected, _ = make_tsb(ts, num_alleles, mirror_coordinates)
+    flags, times = tsb.dump_nodes()
+    expected_flags, expected_times = expected.dump_nodes()
+    if not np.array_equal(flags, expected_flags):
+        raise ValueError("TreeSequenceBuilder node flags differ")
+    if not np.allclose(times + time_offset, expected_times):
+        raise ValueError("TreeSequenceBuilder node times differ")
+    for name in ["edges", "mutations"]:
+        columns = getattr(tsb, f"dump_{name}")()
+        expected_columns = getattr(expected, f"dump_{name}")()
+        for a, b in zip(columns, expected_columns):
+            if not np.array_equal(a, b):
+                raise ValueError(f"TreeSequenceBuilder {name} differ")
+
+
+@numba.njit
+def _compute_fingerprints(
+    nodes,
+    edge_start,
+    edges_left,
+    edges_right,
+    edges_parent,
+    mutation_start,
+    mutations_position,
+    mutations_delta,
+    sequence_length,
+    fingerprint,
+    parent,
+):
+    for u in nodes:
+        value = np.uint64(0)
+        j = edge_start[u]
+        num_edges = edge_start[u + 1] - j
+        parent[u] = -2 if num_edges == 0 else -1
+        if num_edges == 1 and edges_left[j] == 0 and edges_right[j] == sequence_length:
+            parent[u] = edges_parent[j]
+            value = fingerprint[parent[u]]
+        elif num_edges > 0:
+            # Recombinant: walk up the ancestry of each interval, combining
+            # the mutations inherited over it.
+            stack = [
+                (edges_parent[k], edges_left[k], edges_right[k])
+                for k in range(j, j + num_edges)
+            ]
+            while len(stack) > 0:
+                v, left, right = stack.pop()
+                for k in range(mutation_start[v], mutation_start[v + 1]):
+                    if left <= mutations_position[k] < right:
+                        value ^= mutations_delta[k]
+                for k in range(edge_start[v], edge_start[v + 1]):
+                    edge_left = max(left, edges_left[k])
+                    edge_right = min(right, edges_right[k])
+                    if edge_left < edge_right:
+                        stack.append((edges_parent[k], edge_left, edge_right))
+        for k in range(mutation_start[u], mutation_start[u + 1]):
+            value ^= mutations_delta[k]
+        fingerprint[u] = value
+
+
+@numba.njit
+def _compute_node_alleles(
+    u,
+    edge_start,
+    edges_left,
+    edges_right,
+    edges_parent,
+    mutation_start,
+    mutations_site,
+    mutations_position,
+    mutations_derived_state,
+    alleles,
+):
+    # Walk up the ancestry of each interval of u's genome, descendants
+    # before ancestors, so the first mutation seen at a site sets its
+    # allele. Mutations at the same node are in order of age, youngest last.
+    is_set = np.zeros(alleles.shape[0], dtype=np.bool_)
+    stack = [(u, 0.0, np.inf)]
+    while len(stack) > 0:
+        v, left, right = stack.pop()
+        for k in range(mutation_start[v + 1] - 1, mutation_start[v] - 1, -1):
+            site = mutations_site[k]
+            if left <= mutations_position[k] < right and not is_set[site]:
+                alleles[site] = mutations_derived_state[k]
+                is_set[site] = True
+        for k in range(edge_start[v], edge_start[v + 1]):
+            edge_left = max(left, edges_left[k])
+            edge_right = min(right, edges_right[k])
+            if edge_left < edge_right:
+                stack.append((edges_parent[k], edge_left, edge_right))
+
+
+class HaplotypeIndex:
+    """
+    An index from the fingerprints of node haplotypes to node IDs, used
+    to find samples that exactly match a node in the ARG without running
+    the HMM.
+
+    The fingerprint of a haplotype is the XOR of random 64 bit hashes of
+    the (site, allele) pairs at which it differs from the ancestral state,
+    so that a node's fingerprint is its parent's fingerprint XOR the
+    changes made by its own mutations. Call update with each day's base ARG
+    to keep the index in sync: when the new ARG extends the last one by
+    appending nodes only the fingerprints of the new nodes are computed,
+    and otherwise the index is rebuilt.
+
+    Sample groups often have the same haplotype as some of their samples.
+    The HMM matches such a set of nodes, connected by edges without
+    mutations, to its oldest member, and never matches root nodes, so
+    only these canonical nodes are looked up.
+    """
+
+    def __init__(self, seed=42):
+        self.seed = seed
+        self.ts = None
+        self.allele_hash = None
+        self.fingerprint = None
+        self.parent = None
+        self.mutated_sites = None
+        self.ancestral_state = None
+        self.derived_state = None
+        self.ancestry = None
+        self.sorted_fingerprint = None
+        self.sorted_node = None
+
+    def update(self, ts):
+        """
+        Update the index so that it represents the specified ARG.
+        """
+        if ts is self.ts:
+            return
+        before = time.perf_counter()
+        tables = ts.tables
+        assert np.all(
+            tables.sites.ancestral_state_offset == np.arange(ts.num_sites + 1)
+        )
+        assert np.all(
+            tables.mutations.derived_state_offset == np.arange(ts.num_mutations + 1)
+        )
+        self.derived_state = alignments.encode_alignment(
+            tables.mutations.derived_state.view("S1").astype(str)
+        )
+        self.ancestry = None
+        n = 0
+        if self.ts is not None and _extension_time_shift(self.ts, ts) is not None:
+            n = self.ts.num_nodes
+            self.fingerprint = np.concatenate(
+                [self.fingerprint, np.zeros(ts.num_nodes - n, dtype=np.uint64)]
+            )
+            self.parent = np.concatenate(
+                [self.parent, np.zeros(ts.num_nodes - n, dtype=np.int32)]
+            )
+        else:
+            rng = np.random.default_rng(self.seed)
+            self.allele_hash = rng.integers(
+                np.iinfo(np.uint64).max,
+                size=(ts.num_sites, len(core.ALLELES)),
+                dtype=np.uint64,
+                endpoint=True,
+            )
+            self.ancestral_state = alignments.encode_alignment(
+                tables.sites.ancestral_state.view("S1").astype(str)
+            )
+            # The reference haplotype has fingerprint zero
+            self.allele_hash[np.arange(ts.num_sites), self.ancestral_state] = 0
+            self.fingerprint = np.zeros(ts.num_nodes, dtype=np.uint64)
+            self.parent = np.zeros(ts.num_nodes, dtype=np.int32)
+            self.mutated_sites = np.zeros(ts.num_sites, dtype=bool)
+        self._compute(ts, n)
+        self.ts = ts
+
+        # Parent is -1 for recombinants and -2 for roots
+        is_matchable = self.parent != -2
+        parent = np.maximum(self.parent, 0)
+        is_duplicate = (
+            (self.parent >= 0)
+            & is_matchable[parent]
+            & (self.fingerprint[parent] == self.fingerprint)
+        )
+        nodes = np.where(is_matchable & ~is_duplicate)[0]
+        self.sorted_node = nodes[np.argsort(self.fingerprint[nodes], kind="stable")]
+        self.sorted_fingerprint = self.fingerprint[self.sorted_node]
+        logger.info(
+            f"{'Updated' if n > 0 else 'Built'} haplotype index for "
+            f"{ts.num_nodes - n} nodes in {time.perf_counter() - before:.2f}s"
+        )
+
+    def _compute(self, ts, n):
+        # Recombinant nodes need the edges and mutations of all their
+        # ancestors, but otherwise we only need those of the new nodes.
+        edges = np.where(ts.edges_child >= n)[0]
+        mutations = np.where(ts.mutations_node >= n)[0]
+        if np.any(ts.edges_left[edges] != 0) or np.any(
+            ts.edges_right[edges] != ts.sequence_length
+        ):
+            edges = np.arange(ts.num_edges)
+            mutations = np.arange(ts.num_mutations)
+        index = edges[np.argsort(ts.edges_child[edges], kind="stable")]
+        edge_start = np.searchsorted(ts.edges_child[index], np.arange(ts.num_nodes + 1))
+
+        site = ts.mutations_site[mutations]
+        parent = ts.mutations_parent[mutations]
+        derived = self.derived_state[mutations]
+        inherited = np.where(
+            parent == -1,
+            self.ancestral_state[site],
+            self.derived_state[np.maximum(parent, 0)],
+        )
+        delta = self.allele_hash[site, derived] ^ self.allele_hash[site, inherited]
+        self.mutated_sites[site] = True
+        node = ts.mutations_node[mutations]
+        mutation_index = np.argsort(node, kind="stable")
+        mutation_start = np.searchsorted(
+            node[mutation_index], np.arange(ts.num_nodes + 1)
+        )
+
+        # Parents are always older than their children
+        nodes = n + np.argsort(-ts.nodes_time[n:], kind="stable")
+        _compute_fingerprints(
+            nodes.astype(np.int32),
+            edge_start,
+            ts.edges_left[index],
+            ts.edges_right[index],
+            ts.edges_parent[index],
+            mutation_start,
+            ts.sites_position[site[mutation_index]],
+            delta[mutation_index],
+            ts.sequence_length,
+            self.fingerprint,
+            self.parent,
+        )
+
+    def lookup(self, haplotype, deletions_as_missing=False):
+        """
+        Return the ID of the node that the HMM would match the specified
+        sample haplotype to exactly, or -1 if there is not exactly one
+        canonical node with a compatible haplotype.
+        Missing data is compatible with any allele, but we can only use the
+        index when the sample's missing sites carry no mutations in the ARG
+        (so that all nodes have the ancestral state there); -1 is returned
+        otherwise. The alleles of the node found are checked against the
+        sample at its non-missing sites, so that a fingerprint collision
+        returns -1 rather than a wrong match.
+        """
+        is_missing = haplotype == MISSING
+        if deletions_as_missing:
+            is_missing |= haplotype == DELETION
+        if np.any(is_missing & self.mutated_sites):
+            return -1
+        site = np.where(~is_missing)[0]
+        fingerprint = np.bitwise_xor.reduce(self.allele_hash[site, haplotype[site]])
+        start = np.searchsorted(self.sorted_fingerprint, fingerprint, side="left")
+        stop = np.searchsorted(self.sorted_fingerprint, fingerprint, side="right")
+        if stop - start != 1:
+            return -1
+        node = int(self.sorted_node[start])
+        if not np.array_equal(self.node_alleles(node)[site], haplotype[site]):
+            logger.warning(f"Haplotype index fingerprint collision at node {node}")
+            return -1
+        return node
+
+    def node_alleles(self, node):
+        """
+        Return the encoded alleles of the specified node at all sites.
+        """
+        ts = self.ts
+        if self.ancestry is None:
+            # Only needed for index hits, so we build it on demand.
+            edges = np.argsort(ts.edges_child, kind="stable")
+            mutations = np.argsort(ts.mutations_node, kind="stable")
+            nodes = np.arange(ts.num_nodes + 1)
+            self.ancestry = (
+                np.searchsorted(ts.edges_child[edges], nodes),
+                ts.edges_left[edges],
+                ts.edges_right[edges],
+                ts.edges_parent[edges],
+                np.searchsorted(ts.mutations_node[mutations], nodes),
+                ts.mutations_site[mutations],
+                ts.sites_position[ts.mutations_site[mutations]],
+                self.derived_state[mutations],
+            )
+        alleles = self.ancestral_state.copy()
+        _compute_node_alleles(node, *self.ancestry, alleles)
+        return alleles
+
+
 def make_tsb(ts, num_alleles, mirror_coordinates=False):
     if mirror_coordinates:
         # TODO inline this conversion here because we're doing an additional
@@ -1179,12 +2868,52 @@ def match_tsinfer(
     progress_title=None,
     progress_phase=None,
     mirror_coordinates=False,
+    tsb_cache=None,
+    hmm_cache=None,
 ):
-
     num_alleles = 4 if deletions_as_missing else 5
     mu, rho = solve_num_mismatches(num_mismatches, num_alleles)
 
-    tsb, coord_map = make_tsb(ts, num_alleles, mirror_coordinates)
+    def get_likelihood_threshold(sample):
+        if mismatch_threshold is not None:
+            # Likelihood threshold is slightly less than k mutations
+            return mu**mismatch_threshold * 0.99
+        assert sample.hmm_match is not None
+        return sample.hmm_match.likelihood
+
+    cache_keys = []
+    if hmm_cache is not None:
+        keys = [
+            hmm_cache.key(
+                sample.haplotype,
+                ts,
+                num_mismatches=num_mismatches,
+                mismatch_threshold=mismatch_threshold,
+                likelihood_threshold=get_likelihood_threshold(sample),
+                mirror_coordinates=mirror_coordinates,
+                deletions_as_missing=deletions_as_missing,
+            )
+            for sample in samples
+        ]
+        run_batch = []
+        for sample, key, hmm_match in zip(samples, keys, hmm_cache.get_many(keys)):
+            if hmm_match is None:
+                run_batch.append(sample)
+                cache_keys.append(key)
+            else:
+                sample.hmm_match = hmm_match
+        logger.info(
+            f"Found {len(samples) - len(run_batch)} matches in HmmCache; "
+            f"{len(run_batch)} remain"
+        )
+        samples = run_batch
+    if len(samples) == 0:
+        return
+
+    if tsb_cache is None:
+        tsb, coord_map = make_tsb(ts, num_alleles, mirror_coordinates)
+    else:
+        tsb, coord_map = tsb_cache.get(ts, num_alleles, mirror_coordinates)
 
     def match_worker(strain, h, likelihood_threshold):
         matcher = _tsinfer.AncestorMatcher(
@@ -1241,12 +2970,7 @@ def match_tsinfer(
                 h = h[::-1]
             if deletions_as_missing:
                 h[h == DELETION] = MISSING
-            if mismatch_threshold is not None:
-                # Likelihood threshold is slightly less than k mutations
-                likelihood_threshold = mu**mismatch_threshold * 0.99
-            else:
-                assert sample.hmm_match is not None
-                likelihood_threshold = sample.hmm_match.likelihood
+            likelihood_threshold = get_likelihood_threshold(sample)
             future = executor.submit(match_worker, sample.strain, h, likelihood_threshold)
             future_to_sample[future] = sample
 
@@ -1264,6 +2988,10 @@ def match_tsinfer(
             bar.update()
         bar.close()
 
+    if hmm_cache is not None:
+        hmm_cache.put(
+            (key, sample.hmm_match) for key, sample in zip(cache_keys, samples)
+        )
 
 
 @dataclasses.dataclass(frozen=True)
@@ -1319,6 +3047,13 @@ class HmmMatch:
             "mutations": [x.asdict() for x in self.mutations],
         }
 
+    def copy(self):
+        return HmmMatch(
+            list(self.path),
+            [dataclasses.replace(mutation) for mutation in self.mutations],
+            likelihood=self.likelihood,
+        )
+
     def summary(self):
         return (
             f"path={self.path_summary()} "
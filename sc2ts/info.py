@@ -153,15 +153,10 @@ def tally_lineages(ts, metadata_db, show_progress=False):
         counter[node.metadata[key]] += 1
 
     # print(counter)
-    result = metadata_db.query(
-        f"SELECT {key}, COUNT(*) FROM samples "
-        f"WHERE date <= '{date}'"
-        f" GROUP BY {key}"
-    )
+    db_counts = metadata_db.lineage_counts(date, key)
     data = []
     today = datetime.datetime.fromisoformat(date)
-    for row in result:
-        pango = row[key]
+    for pango, db_count in db_counts.items():
         if pango in cov_lineages:
             lin_data = cov_lineages[pango]
         else:
@@ -178,7 +173,7 @@ def tally_lineages(ts, metadata_db, show_progress=False):
         data.append(
             {
                 "arg_count": counter[pango],
-                "db_count": row["COUNT(*)"],
+                "db_count": db_count,
                 "earliest_date": lin_data.earliest_date,
                 "latest_date": lin_data.latest_date,
                 "earliest_date_offset": (today - earliest_date).days,
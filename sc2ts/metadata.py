@@ -1,13 +1,132 @@
+import bisect
 import collections
 import logging
 import sqlite3
+import json
 import pathlib
+import shutil
+import time
 
+import tqdm
+import numpy as np
 import pandas as pd
 
 
 logger = logging.getLogger(__name__)
 
+# SQLite types of the columns in the Viridian metadata that are not stored
+# as text. Dates are stored as ISO formatted text.
+METADATA_SCHEMA = {
+    "strain": "TEXT",
+    "date": "TEXT",
+    "Viridian_N": "INTEGER",
+    "Viridian_cons_len": "INTEGER",
+    "Viridian_cons_het": "INTEGER",
+}
+
+_PANDAS_TYPES = {"TEXT": str, "INTEGER": "Int64", "REAL": "float64"}
+
+# The column holding the Pango lineage of each sample, which is
+# pre-aggregated by date on import.
+DEFAULT_LINEAGE_COLUMN = "Viridian_pangolin"
+
+SNAPSHOT_FORMAT_VERSION = 2
+
+
+# Number of prepared statements kept by each connection. Our hot queries
+# are all parameterised, so this comfortably holds all distinct statements.
+STATEMENT_CACHE_SIZE = 256
+
+
+def connect(path, *, readonly=False):
+    """
+    Return a sqlite3 connection to the specified path with rows returned
+    as dictionaries, and a statement cache of STATEMENT_CACHE_SIZE.
+    """
+    uri = f"file:{path}"
+    if readonly:
+        uri += "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = dict_factory
+    return conn
+
+
+def explain_query_plan(conn, sql, args=()):
+    """
+    Return the list of query plan steps that SQLite reports for the
+    specified statement and bound arguments, for debugging index usage.
+    """
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", args).fetchall()
+    return [row["detail"] for row in rows]
+
+
+def log_query(sql, args=(), conn=None):
+    """
+    Log the specified query and its arguments at debug level, along with
+    its query plan if a connection is provided.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Running query: {sql} args={tuple(args)}")
+        if conn is not None:
+            for step in explain_query_plan(conn, sql, args):
+                logger.debug(f"Query plan: {step}")
+
+
+def _infer_sql_type(values):
+    """
+    Return the SQLite type for the specified column of a DataFrame read
+    by pandas, as used for columns that are not in the schema.
+    """
+    if values.isna().all():
+        return "TEXT"
+    if pd.api.types.is_integer_dtype(values):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(values):
+        return "REAL"
+    return "TEXT"
+
+
+def _convert_inferred(values, sql_type):
+    """
+    Convert the specified Series of text values from a column whose type
+    was inferred as sql_type, returning the converted values and the type,
+    which is widened (INTEGER to REAL, or either to TEXT) if the values
+    don't fit it.
+    """
+    if sql_type == "TEXT":
+        return values, sql_type
+    numbers = pd.to_numeric(values, errors="coerce")
+    if (values.notna() & numbers.isna()).any():
+        return values, "TEXT"
+    if sql_type == "INTEGER":
+        if pd.api.types.is_integer_dtype(pd.to_numeric(values.dropna())):
+            return numbers.astype("Int64"), sql_type
+        sql_type = "REAL"
+    return numbers.astype("float64"), sql_type
+
+
+def _normalise_dates(dates):
+    """
+    Return the specified Series of dates as ISO formatted text, allowing
+    single digit months and days and ignoring any time. Values that are
+    not full dates (such as 2020-01) are left unchanged, with a warning.
+    """
+    parts = dates.astype(str).str.extract(
+        r"^\s*(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ]\S*)?\s*$"
+    )
+    parts.columns = ["year", "month", "day"]
+    parsed = pd.to_datetime(parts.astype(float), errors="coerce")
+    normalised = parsed.dt.strftime("%Y-%m-%d")
+    bad = dates.notna() & parsed.isna()
+    if bad.any():
+        examples = list(dates[bad].unique()[:5])
+        logger.warning(
+            f"Storing {bad.sum()} dates not in YYYY-MM-DD format unchanged: "
+            f"{examples}"
+        )
+        normalised = normalised.where(~bad, dates)
+    return normalised.where(dates.notna(), None)
+
 
 def dict_factory(cursor, row):
     col_names = [col[0] for col in cursor.description]
@@ -16,26 +135,133 @@ def dict_factory(cursor, row):
 
 class MetadataDb(collections.abc.Mapping):
     def __init__(self, path):
-        uri = f"file:{path}"
-        uri += "?mode=ro"
-        self.uri = uri
+        self.uri = f"file:{path}?mode=ro"
         self.path = path
-        self.conn = sqlite3.connect(uri, uri=True)
-        self.conn.row_factory = dict_factory
+        self.conn = connect(path, readonly=True)
         logger.debug(f"Opened MetadataDb at {path} mode=ro")
 
     @staticmethod
-    def import_csv(csv_path, db_path, sep="\t"):
-        df = pd.read_csv(csv_path, sep=sep)
+    def import_csv(
+        csv_path,
+        db_path,
+        sep="\t",
+        *,
+        schema=None,
+        indexes=None,
+        lineage_column=DEFAULT_LINEAGE_COLUMN,
+        chunk_size=100_000,
+        show_progress=False,
+    ):
+        """
+        Create a new MetadataDb at db_path from the specified CSV file,
+        removing any existing file. The file is read in chunks of chunk_size
+        rows, each of which is inserted in a single transaction, so that
+        memory usage is bounded. Column types are given by METADATA_SCHEMA,
+        updated with the specified schema dictionary mapping column names to
+        SQLite types (TEXT, INTEGER or REAL). The types of other columns
+        are inferred from the first chunk, as INTEGER or REAL if pandas reads
+        them as numbers and TEXT otherwise, and are widened if later chunks
+        contain values that don't fit. Full dates are normalised to ISO
+        format (YYYY-MM-DD); other dates are stored unchanged.
+
+        Indexes are built after all rows have been inserted. As well as the
+        strain and date indexes, an index is created for each item in
+        indexes, which is either a column name or a sequence of column
+        names. Multi-column indexes can cover queries entirely; for example,
+        ("Viridian_pangolin", "date") answers lineage counts up to a given
+        date from the index alone. If lineage_column is not None and is in
+        the file, the lineage_counts table with the number of samples for
+        each (date, lineage) pair is also built, and used by
+        lineage_counts and date_sample_counts. Returns the number of rows
+        imported.
+        """
+        types = {**METADATA_SCHEMA, **(schema or {})}
+        for col, sql_type in types.items():
+            if sql_type not in _PANDAS_TYPES:
+                raise ValueError(f"Unsupported type {sql_type} for column {col}")
+        columns = list(pd.read_csv(csv_path, sep=sep, nrows=0).columns)
+        first_chunk = pd.read_csv(
+            csv_path,
+            sep=sep,
+            nrows=chunk_size,
+            dtype={col: _PANDAS_TYPES[t] for col, t in types.items() if col in columns},
+        )
+        column_types = {
+            col: types.get(col, _infer_sql_type(first_chunk[col])) for col in columns
+        }
+        index_columns = []
+        for index in indexes or []:
+            index = [index] if isinstance(index, str) else list(index)
+            unknown = set(index) - set(columns)
+            if len(index) == 0 or len(unknown) > 0:
+                raise ValueError(f"Cannot index unknown columns: {sorted(unknown)}")
+            index_columns.append(index)
+        if lineage_column not in columns:
+            lineage_column = None
+        # Columns with inferred types are read as text and converted chunk
+        # by chunk, so that their types can be widened.
+        inferred = [col for col in columns if col not in types]
+        dtype = {col: _PANDAS_TYPES[t] for col, t in column_types.items()}
+        dtype.update({col: str for col in inferred})
+        initial_types = dict(column_types)
+
         db_path = pathlib.Path(db_path)
         if db_path.exists():
             db_path.unlink()
+        before = time.perf_counter()
+        num_rows = 0
+        columns_sql = ", ".join(f"[{col}] {t}" for col, t in column_types.items())
+        insert_sql = f"INSERT INTO samples VALUES ({', '.join('?' * len(columns))})"
+        reader = pd.read_csv(csv_path, sep=sep, dtype=dtype, chunksize=chunk_size)
+        bar = tqdm.tqdm(
+            desc="Import", unit="rows", unit_scale=True, disable=not show_progress
+        )
         with sqlite3.connect(db_path) as conn:
-            df.to_sql("samples", conn, index=False)
+            # The database is rebuilt from scratch on failure, so we don't
+            # need a rollback journal.
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(f"CREATE TABLE samples ({columns_sql})")
+            for chunk in reader:
+                if "date" in chunk:
+                    chunk["date"] = _normalise_dates(chunk["date"])
+                for col in inferred:
+                    chunk[col], sql_type = _convert_inferred(
+                        chunk[col], column_types[col]
+                    )
+                    if sql_type != column_types[col]:
+                        logger.warning(
+                            f"Widening column {col} from {column_types[col]} to "
+                            f"{sql_type} at row {num_rows}"
+                        )
+                        column_types[col] = sql_type
+                rows = chunk.astype(object).where(chunk.notna(), None)
+                with conn:
+                    conn.executemany(
+                        insert_sql, rows.itertuples(index=False, name=None)
+                    )
+                num_rows += len(chunk)
+                bar.update(len(chunk))
+            bar.close()
+            if column_types != initial_types:
+                _retype_samples(conn, column_types)
+            logger.info(f"Inserted {num_rows} rows; building indexes")
             conn.execute(
                 "CREATE UNIQUE INDEX [ix_samples_strain] on 'samples' ([strain]);"
             )
             conn.execute("CREATE INDEX [ix_samples_date] on 'samples' ([date]);")
+            for index in index_columns:
+                name = "ix_samples_" + "_".join(index)
+                cols = ", ".join(f"[{col}]" for col in index)
+                conn.execute(f"CREATE INDEX [{name}] on 'samples' ({cols});")
+            if lineage_column is not None:
+                logger.info(f"Building lineage counts for {lineage_column}")
+                _build_lineage_counts(conn, lineage_column)
+            conn.execute("ANALYZE")
+        conn.close()
+        duration = time.perf_counter() - before
+        logger.info(f"Imported {num_rows} rows to {db_path} in {duration:.1f}s")
+        return num_rows
 
     def __enter__(self):
         return self
@@ -70,19 +296,212 @@ class MetadataDb(collections.abc.Mapping):
         self.conn.close()
 
     def query(self, sql, args=None):
-        logger.debug(f"Running query:{sql}")
+        """
+        Run the specified SQL statement with the specified bound arguments,
+        yielding the resulting rows.
+        """
+        args = () if args is None else args
+        log_query(sql, args, self.conn)
         with self.conn:
-            for row in self.conn.execute(sql):
+            for row in self.conn.execute(sql, args):
                 yield row
 
+    def explain(self, sql, args=()):
+        """
+        Return the query plan for the specified statement (see
+        explain_query_plan).
+        """
+        return explain_query_plan(self.conn, sql, args)
+
     def get(self, date):
         sql = "SELECT * FROM samples WHERE date==?"
         with self.conn:
             for row in self.conn.execute(sql, [date]):
                 yield row
 
+    @property
+    def columns(self):
+        """
+        The names of the columns in the samples table.
+        """
+        with self.conn:
+            rows = self.conn.execute("PRAGMA table_info(samples)").fetchall()
+        return [row["name"] for row in rows]
+
+    def _select_columns(self, columns):
+        if columns is None:
+            return "*"
+        unknown = set(columns) - set(self.columns)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown columns: {sorted(unknown)}")
+        return ", ".join(f"[{col}]" for col in columns)
+
+    def get_range(self, start, end, columns=None, as_frame=True):
+        """
+        Return the specified columns (all by default) of the samples with
+        dates between start and end inclusive, ordered by date and then
+        in import order. The result is a pandas DataFrame, or a dictionary
+        mapping column names to numpy arrays if as_frame is False. Rows are
+        read directly from the cursor, without building a dictionary for
+        each row.
+        """
+        sql = (
+            f"SELECT {self._select_columns(columns)} FROM samples "
+            "WHERE date>=? AND date<=? ORDER BY date, rowid"
+        )
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        with self.conn:
+            rows = cursor.execute(sql, [start, end]).fetchall()
+        names = [col[0] for col in cursor.description]
+        cursor.close()
+        if as_frame:
+            return pd.DataFrame.from_records(rows, columns=names)
+        values = list(zip(*rows)) if len(rows) > 0 else [()] * len(names)
+        return {name: np.array(v) for name, v in zip(names, values)}
+
+    def get_many(self, strains, columns=None, batch_size=500):
+        """
+        Return a list of the rows (as for __getitem__) for the specified
+        strains, looked up in batches of batch_size strains per query.
+        Raises a KeyError if any strain is not in the DB.
+        """
+        select = self._select_columns(columns)
+        if columns is not None and "strain" not in columns:
+            select += ", [strain] AS __strain"
+        key = "strain" if columns is None or "strain" in columns else "__strain"
+        rows = {}
+        with self.conn:
+            for j in range(0, len(strains), batch_size):
+                batch = list(strains[j : j + batch_size])
+                placeholders = ", ".join("?" * len(batch))
+                sql = f"SELECT {select} FROM samples WHERE strain IN ({placeholders})"
+                for row in self.conn.execute(sql, batch):
+                    rows[row[key]] = row
+        result = []
+        for strain in strains:
+            if strain not in rows:
+                raise KeyError(f"strain {strain} not in DB")
+            row = dict(rows[strain])
+            row.pop("__strain", None)
+            result.append(row)
+        return result
+
+    def create_snapshot(self, path, columns=None):
+        """
+        Write the specified columns (all by default) to a MetadataSnapshot
+        in the directory at the specified path, removing any existing
+        snapshot there, and return it. The strain and date columns are
+        always included, and columns keep their order in the database.
+        """
+        if columns is None:
+            columns = self.columns
+        self._select_columns(columns)
+        # Keep the column order of the samples table
+        keep = set(columns) | {"strain", "date"}
+        columns = [col for col in self.columns if col in keep]
+        with self.conn:
+            info = self.conn.execute("PRAGMA table_info(samples)").fetchall()
+        sql_types = {row["name"]: row["type"].upper() for row in info}
+        path = pathlib.Path(path)
+        if (path / "snapshot.json").exists():
+            shutil.rmtree(path)
+        elif path.exists() and any(path.iterdir()):
+            raise ValueError(f"{path} exists and is not a metadata snapshot")
+        path.mkdir(parents=True, exist_ok=True)
+
+        # One column at a time, to bound memory usage
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        column_types = {}
+        for j, col in enumerate(columns):
+            sql = f"SELECT [{col}] FROM samples ORDER BY date, rowid"
+            with self.conn:
+                values = [row[0] for row in cursor.execute(sql)]
+            column_types[col] = _snapshot_type(sql_types[col])
+            data, mask, categories = _snapshot_column(values, column_types[col], col)
+            np.save(path / f"column_{j}.npy", data)
+            if mask is not None:
+                np.save(path / f"column_{j}.mask.npy", mask)
+            if categories is not None:
+                np.save(path / f"column_{j}.categories.npy", categories[0])
+                np.save(path / f"column_{j}.category_offsets.npy", categories[1])
+            if col == "strain":
+                if mask is not None:
+                    raise ValueError("Null strains not supported")
+                # Strains are unique, so the codes map strains to rows
+                rows = np.zeros(len(data), dtype=np.int64)
+                rows[data] = np.arange(len(data))
+                np.save(path / "strain_index_rows.npy", rows)
+            elif col == "date":
+                # Null dates are sorted first and are not in the date index.
+                # The remaining codes are sorted, and include every date.
+                start = 0 if mask is None else int(np.sum(mask))
+                num_dates = len(categories[1]) - 1
+                date_offsets = start + np.searchsorted(
+                    data[start:], np.arange(num_dates + 1)
+                )
+                np.save(path / "date_offsets.npy", date_offsets)
+        cursor.close()
+        with open(path / "snapshot.json", "w") as f:
+            json.dump(
+                {
+                    "format_version": SNAPSHOT_FORMAT_VERSION,
+                    "num_rows": len(self),
+                    "columns": column_types,
+                },
+                f,
+            )
+        logger.info(f"Created metadata snapshot at {path} with columns {columns}")
+        return MetadataSnapshot(path)
+
+    @property
+    def lineage_column(self):
+        """
+        The column summarised in the lineage_counts table, or None if the
+        table has not been built.
+        """
+        sql = "SELECT value FROM aggregates WHERE name=='lineage_counts'"
+        try:
+            with self.conn:
+                row = self.conn.execute(sql).fetchone()
+        except sqlite3.OperationalError:
+            # Databases imported before the aggregates were added
+            return None
+        return None if row is None else row["value"]
+
+    def lineage_counts(self, date=None, column=DEFAULT_LINEAGE_COLUMN):
+        """
+        Return a Counter mapping the values of the specified lineage column
+        to the number of samples with dates up to and including the
+        specified date (all samples if None), ordered by lineage. The
+        pre-aggregated lineage_counts table is used if it summarises this
+        column, and otherwise the samples table is scanned.
+        """
+        if column == self.lineage_column:
+            table, key, count = "lineage_counts", "pango", "SUM(count)"
+        else:
+            self._select_columns([column])
+            table, key, count = "samples", f"[{column}]", "COUNT(*)"
+        where, args = "", ()
+        if date is not None:
+            where, args = "WHERE date <= ?", (date,)
+        sql = f"SELECT {key}, {count} FROM {table} {where} "
+        sql += f"GROUP BY {key} ORDER BY {key}"
+        log_query(sql, args, self.conn)
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        with self.conn:
+            return collections.Counter(dict(cursor.execute(sql, args)))
+
     def date_sample_counts(self):
-        sql = "SELECT date, COUNT(*) FROM samples GROUP BY date ORDER BY date;"
+        if self.lineage_column is not None:
+            sql = (
+                "SELECT date, SUM(count) AS [COUNT(*)] FROM lineage_counts "
+                "GROUP BY date ORDER BY date;"
+            )
+        else:
+            sql = "SELECT date, COUNT(*) FROM samples GROUP BY date ORDER BY date;"
         counts = collections.Counter()
         with self.conn:
             for row in self.conn.execute(sql):
@@ -100,3 +519,316 @@ class MetadataDb(collections.abc.Mapping):
             for row in self.conn.execute(sql, [date]):
                 dates.append(row["date"])
         return dates
+
+
+def _retype_samples(conn, column_types):
+    # Rebuilds the samples table with the specified column types, converting
+    # the values that were inserted before the types were widened.
+    columns_sql = ", ".join(f"[{col}] {t}" for col, t in column_types.items())
+    values_sql = ", ".join(f"CAST([{col}] AS {t})" for col, t in column_types.items())
+    with conn:
+        conn.execute(f"CREATE TABLE samples_retyped ({columns_sql})")
+        conn.execute(f"INSERT INTO samples_retyped SELECT {values_sql} FROM samples")
+        conn.execute("DROP TABLE samples")
+        conn.execute("ALTER TABLE samples_retyped RENAME TO samples")
+
+
+def _build_lineage_counts(conn, lineage_column):
+    # The samples table is never updated after import, so the aggregate
+    # can't go stale.
+    conn.execute("CREATE TABLE lineage_counts (date TEXT, pango TEXT, count INTEGER)")
+    conn.execute(
+        f"INSERT INTO lineage_counts SELECT date, [{lineage_column}], COUNT(*) "
+        f"FROM samples GROUP BY date, [{lineage_column}]"
+    )
+    conn.execute("CREATE INDEX [ix_lineage_counts_date] on 'lineage_counts' (date)")
+    conn.execute("CREATE TABLE aggregates (name TEXT PRIMARY KEY, value TEXT)")
+    conn.execute(
+        "INSERT INTO aggregates VALUES ('lineage_counts', ?)", (lineage_column,)
+    )
+    conn.commit()
+
+
+def _snapshot_type(sql_type):
+    if "INT" in sql_type:
+        return "INTEGER"
+    if sql_type in ("REAL", "FLOAT", "DOUBLE"):
+        return "REAL"
+    return "TEXT"
+
+
+def _snapshot_column(values, column_type, name):
+    # Returns the numpy array of values for a column, a boolean array
+    # marking the null values (or None if there are none), and for TEXT
+    # columns the (buffer, offsets) encoding of the sorted distinct values.
+    # TEXT values are stored as codes into these categories, so that
+    # long or repeated strings don't inflate the column to a fixed width.
+    python_type = {"TEXT": str, "INTEGER": int, "REAL": (int, float)}[column_type]
+    mask = np.array([value is None for value in values], dtype=bool)
+    for value in values:
+        if value is not None and not isinstance(value, python_type):
+            raise ValueError(f"Value {value!r} in column {name} is not {column_type}")
+    categories = None
+    if column_type == "TEXT":
+        distinct = sorted({value for value in values if value is not None})
+        codes = {value: j for j, value in enumerate(distinct)}
+        data = np.array([codes.get(value, 0) for value in values], dtype=np.int32)
+        categories = _encode_strings(distinct)
+    else:
+        dtype = np.int64 if column_type == "INTEGER" else np.float64
+        data = np.array([0 if value is None else value for value in values], dtype)
+    return data, mask if np.any(mask) else None, categories
+
+
+def _encode_strings(strings):
+    # Returns the UTF-8 encoded strings concatenated into a byte buffer,
+    # and the offset of each string in the buffer.
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return buffer, offsets
+
+
+class _Categories(collections.abc.Sequence):
+    """
+    The sorted distinct values of a TEXT column in a MetadataSnapshot,
+    decoded on access from a UTF-8 byte buffer and offsets.
+    """
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, j):
+        start, stop = self.offsets[j], self.offsets[j + 1]
+        return self.buffer[start:stop].tobytes().decode()
+
+    def find(self, value):
+        """
+        Return the code of the specified value, or -1 if it is not present.
+        """
+        j = bisect.bisect_left(self, value)
+        if j < len(self) and self[j] == value:
+            return j
+        return -1
+
+    def decode(self, codes):
+        """
+        Return an object array of the values for the specified codes.
+        """
+        unique, inverse = np.unique(codes, return_inverse=True)
+        values = np.array([self[code] for code in unique], dtype=object)
+        return values[inverse]
+
+
+def open_metadata_db(path):
+    """
+    Open the MetadataDb or MetadataSnapshot at the specified path.
+    """
+    if pathlib.Path(path).is_dir():
+        return MetadataSnapshot(path)
+    return MetadataDb(path)
+
+
+class MetadataSnapshot(collections.abc.Mapping):
+    """
+    A read-only snapshot of a MetadataDb (see MetadataDb.create_snapshot)
+    stored as memory-mapped numpy columns, with rows sorted by date. Strains
+    are looked up in a sorted strain index, and dates in an index of the
+    row ranges for each date, so that many processes can share the same
+    pages without any SQLite overhead. Provides the same read API as
+    MetadataDb, with rows returned as dictionaries.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / "snapshot.json") as f:
+            info = json.load(f)
+        if info["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"MetadataSnapshot format version {info['format_version']} "
+                "not supported; recreate it with create_snapshot"
+            )
+        self.num_rows = info["num_rows"]
+        self.column_types = info["columns"]
+        self.data = {}
+        self.masks = {}
+        self.categories = {}
+        for j, (col, column_type) in enumerate(self.column_types.items()):
+            self.data[col] = self._load(f"column_{j}.npy")
+            mask_path = f"column_{j}.mask.npy"
+            if (self.path / mask_path).exists():
+                self.masks[col] = self._load(mask_path)
+            if column_type == "TEXT":
+                self.categories[col] = _Categories(
+                    self._load(f"column_{j}.categories.npy"),
+                    self._load(f"column_{j}.category_offsets.npy"),
+                )
+        self.strain_index_rows = self._load("strain_index_rows.npy")
+        # There are few distinct dates, so we keep them decoded
+        self.date_index = np.array(list(self.categories["date"]), dtype=str)
+        self.date_offsets = self._load("date_offsets.npy")
+        logger.debug(f"Opened MetadataSnapshot at {path}")
+
+    def _load(self, name):
+        return np.load(self.path / name, mmap_mode="r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return f"MetadataSnapshot at {self.path} contains {len(self)} sequences"
+
+    @property
+    def columns(self):
+        return list(self.column_types)
+
+    def __len__(self):
+        return self.num_rows
+
+    def _value(self, col, row):
+        mask = self.masks.get(col)
+        if mask is not None and mask[row]:
+            return None
+        value = self.data[col][row].item()
+        if col in self.categories:
+            value = self.categories[col][value]
+        return value
+
+    def _row(self, row, columns=None):
+        columns = self.columns if columns is None else columns
+        return {col: self._value(col, row) for col in columns}
+
+    def _strain_rows(self, strains):
+        # Returns the row of each strain, or -1 if it is not present
+        categories = self.categories["strain"]
+        rows = np.full(len(strains), -1, dtype=np.int64)
+        for j, strain in enumerate(strains):
+            code = categories.find(strain)
+            if code != -1:
+                rows[j] = self.strain_index_rows[code]
+        return rows
+
+    def _check_columns(self, columns):
+        if columns is not None:
+            unknown = set(columns) - set(self.columns)
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown columns: {sorted(unknown)}")
+
+    def __getitem__(self, key):
+        row = self._strain_rows([key])[0]
+        if row == -1:
+            raise KeyError(f"strain {key} not in DB")
+        return self._row(row)
+
+    def __contains__(self, key):
+        return self._strain_rows([key])[0] != -1
+
+    def __iter__(self):
+        categories = self.categories["strain"]
+        for code in self.data["strain"]:
+            yield categories[code]
+
+    def _date_rows(self, start, end):
+        # Returns the range of rows with dates between start and end inclusive
+        left = np.searchsorted(self.date_index, start, side="left")
+        right = np.searchsorted(self.date_index, end, side="right")
+        if left >= right:
+            return 0, 0
+        return self.date_offsets[left], self.date_offsets[right]
+
+    def get(self, date):
+        start, stop = self._date_rows(date, date)
+        for row in range(start, stop):
+            yield self._row(row)
+
+    def get_range(self, start, end, columns=None, as_frame=True):
+        """
+        Return the specified columns (all by default) of the samples with
+        dates between start and end inclusive. See MetadataDb.get_range.
+        """
+        self._check_columns(columns)
+        columns = self.columns if columns is None else columns
+        first, stop = self._date_rows(start, end)
+        result = {}
+        for col in columns:
+            values = np.array(self.data[col][first:stop])
+            if col in self.categories:
+                values = self.categories[col].decode(values)
+            mask = self.masks.get(col)
+            if mask is not None and np.any(mask[first:stop]):
+                values = values.astype(object)
+                values[mask[first:stop]] = None
+            result[col] = values
+        if as_frame:
+            return pd.DataFrame(result, columns=columns)
+        return result
+
+    def get_many(self, strains, columns=None, batch_size=None):
+        """
+        Return a list of the rows for the specified strains. See
+        MetadataDb.get_many.
+        """
+        self._check_columns(columns)
+        rows = self._strain_rows(strains)
+        result = []
+        for strain, row in zip(strains, rows):
+            if row == -1:
+                raise KeyError(f"strain {strain} not in DB")
+            result.append(self._row(row, columns))
+        return result
+
+    def lineage_counts(self, date=None, column=DEFAULT_LINEAGE_COLUMN):
+        """
+        Return a Counter mapping the values of the specified lineage column
+        to the number of samples with dates up to and including the
+        specified date. See MetadataDb.lineage_counts.
+        """
+        self._check_columns([column])
+        start, stop = 0, self.num_rows
+        if date is not None:
+            right = np.searchsorted(self.date_index, date, side="right")
+            start = self.date_offsets[0]
+            stop = self.date_offsets[right]
+        values = self.data[column][start:stop]
+        mask = self.masks.get(column)
+        counts = collections.Counter()
+        if mask is not None:
+            mask = mask[start:stop]
+            num_null = int(np.sum(mask))
+            if num_null > 0:
+                counts[None] = num_null
+            values = values[~mask]
+        if column in self.categories:
+            categories = self.categories[column]
+            num_values = np.bincount(values, minlength=len(categories))
+            for code in np.where(num_values > 0)[0]:
+                counts[categories[code]] = int(num_values[code])
+        else:
+            for value, count in zip(*np.unique(values, return_counts=True)):
+                counts[value.item()] = int(count)
+        return counts
+
+    def date_sample_counts(self):
+        counts = collections.Counter()
+        for date, count in zip(self.date_index, np.diff(self.date_offsets)):
+            date = date.item()
+            if len(date) == 10 and date.startswith("20"):
+                counts[date] = int(count)
+        return counts
+
+    def get_days(self, date=None):
+        if date is None:
+            date = "2000-01-01"
+        start = np.searchsorted(self.date_index, date, side="right")
+        return [d.item() for d in self.date_index[start:]]
@@ -2,7 +2,6 @@ import numpy as np
 
 import tqdm
 
-from . import alignments
 from . import core
 
 MISSING = -1
@@ -13,20 +12,11 @@ def _validate_samples(
     ts, samples, alignment_store, deletions_as_missing, show_progress
 ):
     strains = [ts.node(u).metadata["strain"] for u in samples]
-    G = np.zeros((ts.num_sites, len(samples)), dtype=np.int8)
     keep_sites = ts.sites_position.astype(int)
-    strains_iter = enumerate(strains)
-    with tqdm.tqdm(
-        strains_iter,
-        desc="Read",
-        total=len(strains),
-        position=1,
-        leave=False,
-        disable=not show_progress,
-    ) as bar:
-        for j, strain in bar:
-            a = alignments.encode_alignment(alignment_store[strain])
-            G[:, j] = a[keep_sites]
+    H, missing = alignment_store.get_many(strains, keep_sites)
+    if np.any(missing):
+        raise KeyError(f"{strains[np.where(missing)[0][0]]} not found")
+    G = H.T
 
     vars_iter = ts.variants(samples=samples, alleles=tuple(core.ALLELES))
     with tqdm.tqdm(
@@ -1,3 +1,7 @@
+import collections
+import json
+
+import lmdb
 import numpy as np
 import pytest
 from numpy.testing import assert_array_equal
@@ -29,6 +33,714 @@ class TestAlignmentsStore:
         assert "SRR11772659" in fx_alignment_store
         assert "NOT_IN_STORE" not in fx_alignment_store
 
+    def test_format_version(self, fx_alignment_store):
+        assert fx_alignment_store.format_version == sa.FORMAT_VERSION
+
+    def test_get_encoded(self, fx_alignment_store):
+        h = fx_alignment_store["SRR11772659"]
+        a = fx_alignment_store.get_encoded("SRR11772659")
+        assert a.alleles.dtype == np.int8
+        assert_array_equal(a.alleles, sa.encode_alignment(h))
+        assert_array_equal(a.decode(), h)
+
+    def test_get_encoded_missing(self, fx_alignment_store):
+        with pytest.raises(KeyError):
+            fx_alignment_store.get_encoded("NOT_IN_STORE")
+
+
+class TestGetMany:
+    strains = ["SRR11772659", "SRR11597116", "SRR11597188"]
+
+    def test_all_sites(self, fx_alignment_store):
+        H, missing = fx_alignment_store.get_many(self.strains)
+        assert H.shape == (3, core.REFERENCE_SEQUENCE_LENGTH)
+        assert H.dtype == np.int8
+        assert not np.any(missing)
+        for j, strain in enumerate(self.strains):
+            assert_array_equal(H[j], sa.encode_alignment(fx_alignment_store[strain]))
+
+    def test_keep_sites(self, fx_alignment_store):
+        keep_sites = np.arange(1, 1000, 3)
+        H, missing = fx_alignment_store.get_many(self.strains, keep_sites)
+        assert H.shape == (3, len(keep_sites))
+        for j, strain in enumerate(self.strains):
+            a = sa.encode_alignment(fx_alignment_store[strain])
+            assert_array_equal(H[j], a[keep_sites])
+
+    def test_characters(self, fx_alignment_store):
+        keep_sites = [0, 1, 100, 29903]
+        H, missing = fx_alignment_store.get_many(
+            self.strains, keep_sites, encoded=False
+        )
+        for j, strain in enumerate(self.strains):
+            assert_array_equal(H[j], fx_alignment_store[strain][keep_sites])
+
+    def test_missing(self, fx_alignment_store):
+        strains = ["NOT_IN_STORE", self.strains[0], "ALSO_NOT"]
+        H, missing, compositions = fx_alignment_store.get_many(
+            strains, [1, 2, 3], composition=True
+        )
+        assert_array_equal(missing, [True, False, True])
+        assert np.all(H[missing] == -1)
+        assert compositions[0] is None
+        assert compositions[2] is None
+
+    def test_composition(self, fx_alignment_store):
+        keep_sites = np.arange(0, 29904, 2)
+        _, _, compositions = fx_alignment_store.get_many(
+            self.strains, keep_sites, composition=True
+        )
+        for strain, composition in zip(self.strains, compositions):
+            h = fx_alignment_store[strain][keep_sites]
+            assert composition == collections.Counter(h)
+
+    def test_empty(self, fx_alignment_store):
+        H, missing = fx_alignment_store.get_many([], [1, 2])
+        assert H.shape == (0, 2)
+        assert missing.shape == (0,)
+
+    def test_duplicates(self, fx_alignment_store):
+        strains = self.strains[:1] * 3
+        H, missing = fx_alignment_store.get_many(strains, [1, 2, 3])
+        assert not np.any(missing)
+        assert np.all(H == H[0])
+
+
+class TestReadFasta:
+    def test_gzip_matches_faidx(self, fx_alignments_fasta):
+        reader = core.FastaReader(fx_alignments_fasta)
+        records = list(core.read_fasta("tests/data/alignments.fasta.gz"))
+        assert [name for name, _ in records] == list(reader)
+        for name, sequence in records[:5]:
+            h = np.frombuffer(b"X" + sequence, dtype="S1").astype(str)
+            assert_array_equal(h, reader[name])
+
+    def test_plain(self, tmp_path):
+        path = tmp_path / "x.fasta"
+        path.write_text(">a description\nACGT\nNN\n\n>b\r\n--\r\n>c\n")
+        records = list(core.read_fasta(path))
+        assert records == [("a", b"ACGTNN"), ("b", b"--"), ("c", b"")]
+
+    def test_empty(self, tmp_path):
+        path = tmp_path / "x.fasta"
+        path.write_text("")
+        assert list(core.read_fasta(path)) == []
+
+
+class TestImportFasta:
+    @pytest.mark.parametrize("encoding", ["int8", "delta"])
+    @pytest.mark.parametrize(
+        ["num_workers", "chunk_size", "transaction_size"],
+        [(0, 100, 10_000), (0, 7, 10), (2, 5, 13)],
+    )
+    def test_matches_append(
+        self,
+        tmp_path,
+        fx_alignment_store,
+        encoding,
+        num_workers,
+        chunk_size,
+        transaction_size,
+    ):
+        path = tmp_path / "alignments.db"
+        with sa.AlignmentStore.initialise(path, encoding=encoding) as store:
+            n = store.import_fasta(
+                "tests/data/alignments.fasta.gz",
+                num_workers=num_workers,
+                chunk_size=chunk_size,
+                transaction_size=transaction_size,
+            )
+            assert n == {"new": len(fx_alignment_store)}
+        with sa.AlignmentStore(path) as store:
+            assert list(store.keys()) == list(fx_alignment_store.keys())
+            for k in list(store.keys())[::5]:
+                assert_array_equal(store[k], fx_alignment_store[k])
+
+    def test_legacy_format(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        h = core.get_reference_sequence(as_array=True)
+        legacy_alignment_store(path, {"reference": h})
+        with sa.AlignmentStore(path, "a") as store:
+            store.import_fasta("tests/data/alignments.fasta.gz")
+        with sa.AlignmentStore(path) as store:
+            assert store.format_version == 1
+            assert len(store) == len(fx_alignment_store) + 1
+            strain = "SRR11772659"
+            assert_array_equal(store[strain], fx_alignment_store[strain])
+
+
+    def test_legacy_format_incremental(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        h = core.get_reference_sequence(as_array=True)
+        legacy_alignment_store(path, {"reference": h})
+        with sa.AlignmentStore(path, "a") as store:
+            with pytest.raises(ValueError, match="legacy"):
+                store.import_fasta("tests/data/alignments.fasta.gz", incremental=True)
+
+
+class TestIncrementalImport:
+    fasta_path = "tests/data/alignments.fasta.gz"
+
+    def test_reimport_unchanged(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        n = len(fx_alignment_store)
+        with sa.AlignmentStore.initialise(path) as store:
+            assert store.import_fasta(self.fasta_path) == {"new": n}
+            # Non-incremental imports rewrite everything, but still classify
+            assert store.import_fasta(self.fasta_path) == {"unchanged": n}
+            assert store.import_fasta(self.fasta_path, incremental=True) == {
+                "unchanged": n
+            }
+            manifest = store.get_import_manifest(self.fasta_path)
+            assert manifest["complete"]
+            assert manifest["num_records"] == n
+
+    def test_changed_and_new(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        strains = list(fx_alignment_store.keys())
+        with sa.AlignmentStore.initialise(path) as store:
+            ref = core.get_reference_sequence(as_array=True)
+            store.append({strains[0]: ref, strains[1]: fx_alignment_store[strains[1]]})
+            counts = store.import_fasta(self.fasta_path, incremental=True)
+            assert counts == {
+                "changed": 1,
+                "unchanged": 1,
+                "new": len(strains) - 2,
+            }
+        with sa.AlignmentStore(path) as store:
+            assert len(store) == len(strains)
+            assert_array_equal(store[strains[0]], fx_alignment_store[strains[0]])
+
+    def test_skip_complete(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        with sa.AlignmentStore.initialise(path) as store:
+            store.import_fasta(self.fasta_path, incremental=True)
+            first = store.get_import_manifest(self.fasta_path)
+            counts = store.import_fasta(self.fasta_path, incremental=True)
+            assert counts == {"unchanged": len(fx_alignment_store)}
+            assert store.get_import_manifest(self.fasta_path) == first
+
+    @pytest.mark.parametrize("num_committed", [0, 10, 30])
+    def test_resume(self, tmp_path, fx_alignment_store, num_committed):
+        path = tmp_path / "alignments.db"
+        fasta_path = tmp_path / "alignments.fasta"
+        strains = list(fx_alignment_store.keys())
+        with open(fasta_path, "w") as f:
+            for strain in strains:
+                print(f">{strain}", file=f)
+                print("".join(fx_alignment_store[strain][1:]), file=f)
+        with sa.AlignmentStore.initialise(path) as store:
+            store.import_fasta(fasta_path, chunk_size=5, transaction_size=10)
+            # Simulate an import interrupted after num_committed records
+            manifest = store.get_import_manifest(fasta_path)
+            manifest["num_records"] = num_committed
+            manifest["complete"] = False
+            manifest["counts"] = {"new": num_committed}
+            with store.env.begin(write=True, db=store.manifest_db) as txn:
+                key = str(fasta_path.resolve()).encode()
+                txn.put(key, json.dumps(manifest).encode())
+            counts = store.import_fasta(fasta_path, incremental=True)
+            assert counts == {
+                "new": num_committed,
+                "unchanged": len(strains) - num_committed,
+            }
+            assert store.get_import_manifest(fasta_path)["complete"]
+
+    def test_file_modified(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        fasta_path = tmp_path / "alignments.fasta"
+        strain = "SRR11772659"
+        h = "".join(fx_alignment_store[strain][1:])
+        with open(fasta_path, "w") as f:
+            print(f">{strain}\n{h}", file=f)
+        with sa.AlignmentStore.initialise(path) as store:
+            assert store.import_fasta(fasta_path, incremental=True) == {"new": 1}
+            with open(fasta_path, "w") as f:
+                print(f">{strain}\n{h}\n>other\n{h}", file=f)
+            counts = store.import_fasta(fasta_path, incremental=True)
+            assert counts == {"new": 1, "unchanged": 1}
+            assert len(store) == 2
+
+
+class TestSummaries:
+    def test_summarise_alignment(self):
+        h = np.array(list("XACGTN-RYA.N"), dtype="S1")
+        summary = sa.summarise_alignment(h)
+        assert summary["num_A"] == 2
+        assert summary["num_C"] == 1
+        assert summary["num_G"] == 1
+        assert summary["num_T"] == 1
+        assert summary["num_deletions"] == 1
+        assert summary["num_N"] == 2
+        assert summary["num_ambiguous"] == 3
+        assert summary["first_called"] == 1
+        assert summary["last_called"] == 9
+        assert sa.num_missing_sites(summary) == 5
+
+    def test_summarise_all_missing(self):
+        h = np.array(list("XNNN"), dtype="S1")
+        summary = sa.summarise_alignment(h)
+        assert summary["num_N"] == 3
+        assert summary["first_called"] == -1
+        assert summary["last_called"] == -1
+
+    def test_matches_alignments(self, fx_alignment_store):
+        strains = list(fx_alignment_store.keys())
+        summaries, missing = fx_alignment_store.get_summaries(strains)
+        assert not np.any(missing)
+        for strain, summary in zip(strains, summaries):
+            h = fx_alignment_store[strain]
+            assert summary == sa.summarise_alignment(h)
+            counts = collections.Counter(h[1:])
+            assert summary["num_N"] == counts["N"]
+            assert summary["num_deletions"] == counts["-"]
+        all_summaries, missing = fx_alignment_store.get_summaries()
+        assert not np.any(missing)
+        assert_array_equal(all_summaries, summaries)
+
+    def test_missing_strains(self, fx_alignment_store):
+        summaries, missing = fx_alignment_store.get_summaries(["x", "SRR11772659"])
+        assert list(missing) == [True, False]
+        assert summaries[0]["num_N"] == 0
+        assert summaries[0]["first_called"] == -1
+
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    def test_import_fasta(self, tmp_path, fx_alignment_store, num_workers):
+        path = tmp_path / "alignments.db"
+        with sa.AlignmentStore.initialise(path, encoding="delta") as store:
+            store.import_fasta(
+                "tests/data/alignments.fasta.gz", num_workers=num_workers
+            )
+            summaries, _ = store.get_summaries()
+        assert_array_equal(summaries, fx_alignment_store.get_summaries()[0])
+
+    def test_update_summaries(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        strains = list(fx_alignment_store.keys())[:5]
+        with sa.AlignmentStore.initialise(path) as store:
+            store.append({strain: fx_alignment_store[strain] for strain in strains})
+            with store.env.begin(write=True) as txn:
+                txn.drop(store.summaries_db, delete=False)
+            assert np.all(store.get_summaries(strains)[1])
+            assert store.update_summaries() == len(strains)
+            assert store.update_summaries() == 0
+            summaries, missing = store.get_summaries(strains)
+        assert not np.any(missing)
+        assert_array_equal(summaries, fx_alignment_store.get_summaries(strains)[0])
+
+    def test_legacy_format(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        h = core.get_reference_sequence(as_array=True)
+        legacy_alignment_store(path, {"reference": h})
+        with sa.AlignmentStore(path, "a") as store:
+            summaries, missing = store.get_summaries(["reference"])
+            assert list(missing) == [True]
+            assert len(store.get_summaries()[0]) == 0
+            with pytest.raises(ValueError, match="legacy"):
+                store.update_summaries()
+
+
+class TestAlignmentMatrix:
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    @pytest.mark.parametrize("samples_chunk_size", [1, 7, 100])
+    def test_export_all(
+        self, tmp_path, fx_alignment_store, num_workers, samples_chunk_size
+    ):
+        matrix = fx_alignment_store.export_zarr(
+            tmp_path / "alignments.zarr",
+            samples_chunk_size=samples_chunk_size,
+            sites_chunk_size=1000,
+            num_workers=num_workers,
+        )
+        strains = list(fx_alignment_store)
+        assert list(matrix) == strains
+        assert len(matrix) == len(strains)
+        assert matrix.num_sites == core.REFERENCE_SEQUENCE_LENGTH - 1
+        assert_array_equal(matrix.sites_position, np.arange(1, matrix.num_sites + 1))
+        H, _ = fx_alignment_store.get_many(strains)
+        assert_array_equal(matrix.get_genotypes(), H[:, 1:].T)
+        for strain, h in zip(strains, H):
+            assert_array_equal(matrix[strain], h[1:])
+
+    def test_export_subset(self, tmp_path, fx_alignment_store):
+        strains = list(fx_alignment_store)[::3]
+        sites = [1, 100, 200, 5000, 29903]
+        matrix = fx_alignment_store.export_zarr(
+            tmp_path / "alignments.zarr", strains=strains, sites=sites
+        )
+        assert list(matrix) == strains
+        assert list(matrix.sites_position) == sites
+        H, _ = fx_alignment_store.get_many(strains, sites)
+        assert_array_equal(matrix.get_genotypes(), H.T)
+        matrix = sa.AlignmentMatrix(tmp_path / "alignments.zarr")
+        assert_array_equal(matrix.get_genotypes(), H.T)
+
+    @pytest.mark.parametrize("num_workers", [0, 1, 3])
+    def test_get_genotypes(self, tmp_path, fx_alignment_store, num_workers):
+        matrix = fx_alignment_store.export_zarr(
+            tmp_path / "alignments.zarr", samples_chunk_size=4
+        )
+        strains = list(fx_alignment_store)
+        strains = strains[::-2] + strains[:3]
+        sites = [55, 100, 241, 29000]
+        H, _ = fx_alignment_store.get_many(strains, sites)
+        G = matrix.get_genotypes(strains, sites, num_workers=num_workers)
+        assert_array_equal(G, H.T)
+        G = matrix.get_genotypes(strains, num_workers=num_workers)
+        assert G.shape == (matrix.num_sites, len(strains))
+        assert_array_equal(G[sites[0] - 1], H[:, 0])
+
+    def test_get_many(self, tmp_path, fx_alignment_store):
+        matrix = fx_alignment_store.export_zarr(tmp_path / "alignments.zarr")
+        strains = ["x", "SRR11772659", "y"]
+        sites = [100, 200, 300]
+        H1, missing1 = matrix.get_many(strains, sites)
+        H2, missing2 = fx_alignment_store.get_many(strains, sites)
+        assert_array_equal(H1, H2)
+        assert_array_equal(missing1, missing2)
+
+    def test_errors(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.zarr"
+        with pytest.raises(KeyError, match="not_a_strain"):
+            fx_alignment_store.export_zarr(path, strains=["not_a_strain"])
+        with pytest.raises(ValueError, match="sorted"):
+            fx_alignment_store.export_zarr(path, sites=[2, 1])
+        matrix = fx_alignment_store.export_zarr(path, sites=[1, 2])
+        with pytest.raises(KeyError):
+            matrix.get_genotypes(sites=[3])
+        with pytest.raises(KeyError):
+            matrix.get_genotypes(strains=["not_a_strain"])
+        with pytest.raises(KeyError):
+            matrix["not_a_strain"]
+
+
+class TestShardedAlignmentStore:
+    fasta_path = "tests/data/alignments.fasta.gz"
+
+    def test_strain_shard(self):
+        shards = [sa.strain_shard(f"strain_{j}", 4) for j in range(100)]
+        assert set(shards) == {0, 1, 2, 3}
+        assert sa.strain_shard("SRR11772659", 4) == sa.strain_shard("SRR11772659", 4)
+        assert sa.strain_shard("SRR11772659", 1) == 0
+
+    @pytest.mark.parametrize("num_shards", [1, 3])
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    def test_import_fasta(self, tmp_path, fx_alignment_store, num_shards, num_workers):
+        path = tmp_path / "sharded"
+        with sa.ShardedAlignmentStore.initialise(path, num_shards) as store:
+            counts = store.import_fasta(self.fasta_path, num_workers=num_workers)
+            assert counts == {"new": len(fx_alignment_store)}
+        with sa.open_alignment_store(path) as store:
+            assert isinstance(store, sa.ShardedAlignmentStore)
+            assert store.num_shards == num_shards
+            assert len(store) == len(fx_alignment_store)
+            assert set(store) == set(fx_alignment_store)
+            for j in range(num_shards):
+                for strain in store.shard(j):
+                    assert sa.strain_shard(strain, num_shards) == j
+            strain = "SRR11772659"
+            assert strain in store
+            assert "x" not in store
+            assert_array_equal(store[strain], fx_alignment_store[strain])
+
+    def test_incremental(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "sharded"
+        n = len(fx_alignment_store)
+        with sa.ShardedAlignmentStore.initialise(path, 3) as store:
+            store.import_fasta(self.fasta_path, incremental=True)
+            counts = store.import_fasta(self.fasta_path, incremental=True)
+            assert counts == {"unchanged": n}
+
+    def test_import_missing_file(self, tmp_path):
+        with sa.ShardedAlignmentStore.initialise(tmp_path / "sharded", 3) as store:
+            with pytest.raises(FileNotFoundError):
+                store.import_fasta(tmp_path / "missing.fasta")
+            assert len(store) == 0
+
+    def test_lazy_open(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "sharded"
+        strains = list(fx_alignment_store)[:3]
+        with sa.ShardedAlignmentStore.initialise(path, 4) as store:
+            store.append({strain: fx_alignment_store[strain] for strain in strains})
+        with sa.ShardedAlignmentStore(path) as store:
+            assert store._shards == [None] * 4
+            store.get_encoded(strains[0])
+            j = sa.strain_shard(strains[0], 4)
+            assert [s is not None for s in store._shards] == [k == j for k in range(4)]
+
+    @pytest.mark.parametrize("encoded", [True, False])
+    def test_get_many(self, tmp_path, fx_alignment_store, encoded):
+        path = tmp_path / "sharded"
+        with sa.ShardedAlignmentStore.initialise(path, 3, encoding="delta") as store:
+            store.import_fasta(self.fasta_path)
+        strains = list(fx_alignment_store)[::2] + ["x"]
+        sites = [1, 100, 2000, 29903]
+        with sa.ShardedAlignmentStore(path) as store:
+            result = store.get_many(strains, sites, encoded, composition=True)
+            expected = fx_alignment_store.get_many(
+                strains, sites, encoded, composition=True
+            )
+            assert_array_equal(result[0], expected[0])
+            assert_array_equal(result[1], expected[1])
+            assert result[2] == expected[2]
+            summaries, missing = store.get_summaries(strains)
+            expected = fx_alignment_store.get_summaries(strains)
+            assert_array_equal(summaries, expected[0])
+            assert_array_equal(missing, expected[1])
+            assert len(store.get_summaries()[0]) == len(fx_alignment_store)
+
+    def test_export_zarr(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "sharded"
+        with sa.ShardedAlignmentStore.initialise(path, 3) as store:
+            store.import_fasta(self.fasta_path)
+            matrix = store.export_zarr(tmp_path / "alignments.zarr", num_workers=2)
+        strains = list(matrix)
+        H, _ = fx_alignment_store.get_many(strains)
+        assert_array_equal(matrix.get_genotypes(), H[:, 1:].T)
+
+    @pytest.mark.parametrize("codec", ["bz2", "zstd"])
+    def test_reshard(self, tmp_path, fx_alignment_store, codec):
+        path = tmp_path / "sharded"
+        with sa.ShardedAlignmentStore.initialise(path, 2, codec=codec) as store:
+            store.import_fasta(self.fasta_path)
+        store = sa.reshard(path, tmp_path / "resharded", 5)
+        with store:
+            assert store.num_shards == 5
+            assert store.shard(0).codec.name == codec
+            assert set(store) == set(fx_alignment_store)
+            strains = list(fx_alignment_store)
+            H1, _ = store.get_many(strains)
+            H2, _ = fx_alignment_store.get_many(strains)
+            assert_array_equal(H1, H2)
+            assert not np.any(store.get_summaries(strains)[1])
+        with sa.ShardedAlignmentStore(tmp_path / "resharded", "a") as store:
+            counts = store.import_fasta(self.fasta_path)
+            assert counts == {"unchanged": len(strains)}
+
+    def test_reshard_unsharded(self, tmp_path, fx_alignment_store):
+        store = sa.reshard(fx_alignment_store.path, tmp_path / "resharded", 2)
+        with store:
+            assert len(store) == len(fx_alignment_store)
+            strain = "SRR11772659"
+            assert_array_equal(store[strain], fx_alignment_store[strain])
+
+    def test_reshard_different_dictionaries(self, tmp_path, fx_alignment_store):
+        pytest.importorskip("zstandard")
+        path = tmp_path / "sharded"
+        strains = list(fx_alignment_store)
+        with sa.ShardedAlignmentStore.initialise(
+            path,
+            2,
+            codec="zstd",
+            training_data=[fx_alignment_store[k] for k in strains[:20]],
+        ) as store:
+            store.import_fasta(self.fasta_path)
+        # Replace the second shard with one using a different dictionary.
+        shard_path = path / "shard_0001.db"
+        with sa.AlignmentStore(shard_path) as shard:
+            alignments = {k: shard[k] for k in shard}
+        shard_path.unlink()
+        with sa.AlignmentStore.initialise(
+            shard_path,
+            codec="zstd",
+            training_data=[fx_alignment_store[k] for k in strains[20:40]],
+        ) as shard:
+            shard.append(alignments)
+        with sa.reshard(path, tmp_path / "resharded", 3) as store:
+            assert set(store) == set(strains)
+            H1, _ = store.get_many(strains)
+            H2, _ = fx_alignment_store.get_many(strains)
+            assert_array_equal(H1, H2)
+
+    def test_reshard_legacy(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        h = core.get_reference_sequence(as_array=True)
+        legacy_alignment_store(path, {"a": h, "b": h})
+        with sa.reshard(path, tmp_path / "resharded", 2) as store:
+            assert set(store) == {"a", "b"}
+            assert_array_equal(store["a"], h)
+
+    def test_initialise_existing_directory(self, tmp_path):
+        path = tmp_path / "sharded"
+        path.mkdir()
+        (path / "other").write_text("x")
+        with pytest.raises(ValueError, match="not a sharded"):
+            sa.ShardedAlignmentStore.initialise(path, 2)
+        (path / "other").unlink()
+        sa.ShardedAlignmentStore.initialise(path, 2).close()
+        with sa.ShardedAlignmentStore.initialise(path, 3) as store:
+            assert store.num_shards == 3
+            assert len(list(path.glob("shard_*.db"))) == 3
+
+    def test_read_only(self, tmp_path):
+        path = tmp_path / "sharded"
+        sa.ShardedAlignmentStore.initialise(path, 2).close()
+        with sa.ShardedAlignmentStore(path) as store:
+            with pytest.raises(ValueError, match="writing"):
+                store.import_fasta(self.fasta_path)
+
+
+def legacy_alignment_store(path, alignments):
+    env = lmdb.Environment(str(path), subdir=False, map_size=1024**3)
+    with env.begin(write=True) as txn:
+        for k, v in alignments.items():
+            txn.put(k.encode(), sa.compress_alignment(np.char.upper(v)))
+    env.close()
+
+
+class TestAlignmentStoreFormats:
+    def example_alignments(self):
+        ref = core.get_reference_sequence(as_array=True)
+        h1 = ref.copy()
+        h1[1:10] = "N"
+        h1[100] = "R"
+        h1[200] = "-"
+        h1[300] = "y"
+        h2 = ref.copy()
+        h2[-5:] = "."
+        return {"x1": h1, "x2": h2}
+
+    def test_initialise(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        with sa.AlignmentStore.initialise(path) as store:
+            assert len(store) == 0
+            assert store.format_version == sa.FORMAT_VERSION
+        with sa.AlignmentStore(path) as store:
+            assert len(store) == 0
+            assert store.format_version == sa.FORMAT_VERSION
+
+    def test_initialise_overwrites(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        with sa.AlignmentStore.initialise(path) as store:
+            store.append(self.example_alignments())
+        with sa.AlignmentStore.initialise(path) as store:
+            assert len(store) == 0
+
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        alignments = self.example_alignments()
+        with sa.AlignmentStore.initialise(path) as store:
+            store.append(alignments)
+        with sa.AlignmentStore(path) as store:
+            assert set(store.keys()) == set(alignments.keys())
+            for k, v in alignments.items():
+                assert_array_equal(store[k], np.char.upper(v))
+
+    @pytest.mark.parametrize("encoding", ["int8", "delta"])
+    def test_round_trip_encoding(self, tmp_path, encoding):
+        path = tmp_path / "alignments.db"
+        alignments = self.example_alignments()
+        with sa.AlignmentStore.initialise(path, encoding=encoding) as store:
+            store.append(alignments)
+        with sa.AlignmentStore(path) as store:
+            assert store.encoding == encoding
+            for k, v in alignments.items():
+                assert_array_equal(store[k], np.char.upper(v))
+            keys = list(alignments.keys())
+            H, missing = store.get_many(keys, [50, 100, 200, 300])
+            assert not np.any(missing)
+            for j, k in enumerate(keys):
+                a = sa.encode_alignment(np.char.upper(alignments[k]))
+                assert_array_equal(H[j], a[[50, 100, 200, 300]])
+
+    @pytest.mark.parametrize("codec", ["bz2", "zstd", "lz4"])
+    def test_round_trip_codec(self, tmp_path, codec):
+        pytest.importorskip({"bz2": "bz2", "zstd": "zstandard", "lz4": "lz4"}[codec])
+        path = tmp_path / "alignments.db"
+        alignments = self.example_alignments()
+        with sa.AlignmentStore.initialise(path, codec=codec) as store:
+            store.append(alignments)
+        with sa.AlignmentStore(path) as store:
+            assert store.codec.name == codec
+            for k, v in alignments.items():
+                assert_array_equal(store[k], np.char.upper(v))
+
+    def test_zstd_dictionary(self, tmp_path, fx_alignment_store):
+        pytest.importorskip("zstandard")
+        path = tmp_path / "alignments.db"
+        strains = list(fx_alignment_store.keys())
+        training_data = [fx_alignment_store[k] for k in strains[:40]]
+        with sa.AlignmentStore.initialise(
+            path, codec="zstd", training_data=training_data
+        ) as store:
+            store.import_fasta("tests/data/alignments.fasta.gz", num_workers=2)
+        with sa.AlignmentStore(path) as store:
+            assert store.metadata["codec"]["has_dictionary"]
+            for k in strains[::7]:
+                assert_array_equal(store[k], fx_alignment_store[k])
+
+    def test_dictionary_requires_zstd(self, tmp_path):
+        with pytest.raises(ValueError, match="zstd"):
+            sa.AlignmentStore.initialise(
+                tmp_path / "x.db", training_data=[np.array(["A"])]
+            )
+
+    def test_default_codec(self, tmp_path):
+        with sa.AlignmentStore(tmp_path / "x.db", "a") as store:
+            assert store.codec.name == "bz2"
+
+    def test_unknown_encoding(self, tmp_path):
+        with pytest.raises(ValueError, match="encoding"):
+            sa.AlignmentStore.initialise(tmp_path / "x.db", encoding="utf8")
+
+    def test_legacy_format(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        alignments = self.example_alignments()
+        legacy_alignment_store(path, alignments)
+        with sa.AlignmentStore(path) as store:
+            assert store.format_version == 1
+            assert len(store) == 2
+            for k, v in alignments.items():
+                assert_array_equal(store[k], np.char.upper(v))
+                a = store.get_encoded(k)
+                assert_array_equal(a.alleles, sa.encode_alignment(store[k]))
+
+    def test_legacy_format_append(self, tmp_path):
+        path = tmp_path / "alignments.db"
+        alignments = self.example_alignments()
+        legacy_alignment_store(path, {"x1": alignments["x1"]})
+        with sa.AlignmentStore(path, "a") as store:
+            store.append({"x2": alignments["x2"]})
+        with sa.AlignmentStore(path) as store:
+            assert store.format_version == 1
+            assert_array_equal(store["x2"], np.char.upper(alignments["x2"]))
+
+
+class TestEncodedAlignment:
+    def example(self):
+        h = np.array(list("XACGT-NRYacgtN.W"), dtype="U1")
+        return h, sa.EncodedAlignment.from_characters(np.char.upper(h))
+
+    def test_ambiguous(self):
+        h, a = self.example()
+        assert_array_equal(a.ambiguous_position, [0, 7, 8, 14, 15])
+        assert_array_equal(a.ambiguous_base, ["X", "R", "Y", ".", "W"])
+
+    def test_bytes_round_trip(self):
+        h, a = self.example()
+        b = sa.EncodedAlignment.frombytes(a.tobytes())
+        assert_array_equal(a.alleles, b.alleles)
+        assert_array_equal(a.ambiguous_position, b.ambiguous_position)
+        assert_array_equal(a.ambiguous_base, b.ambiguous_base)
+
+    @pytest.mark.parametrize(
+        "sites", [None, [0], [1, 2, 3], [0, 7, 14], [3, 0, 8, 8], np.arange(16)]
+    )
+    def test_sites(self, sites):
+        h, a = self.example()
+        upper = np.char.upper(h)
+        x = upper if sites is None else upper[sites]
+        assert_array_equal(a.decode(sites), x)
+        assert_array_equal(a.haplotype(sites), sa.encode_alignment(x))
+        assert a.composition(sites) == collections.Counter(x)
+
+    def test_real_composition(self, fx_alignment_store):
+        h = fx_alignment_store["SRR11772659"]
+        a = fx_alignment_store.get_encoded("SRR11772659")
+        assert a.composition() == collections.Counter(h)
+        sites = np.arange(1, len(h), 3)
+        assert a.composition(sites) == collections.Counter(h[sites])
+
 
 def test_get_gene_coordinates():
     d = core.get_gene_coordinates()
@@ -112,3 +824,66 @@ class TestEncodeAligment:
 #         assert len(ma.masked_sites) == 133
 #         assert ma.masked_sites[0] == 1
 #         assert ma.masked_sites[-1] == 29903
+
+
+class TestDeltaAlignment:
+    def example(self):
+        h = core.get_reference_sequence(as_array=True).copy()
+        h[1:50] = "N"
+        h[100] = "R"
+        h[101] = "N"
+        h[500] = "G" if h[500] != "G" else "A"
+        h[600:610] = "-"
+        h[-20:] = "N"
+        return h, sa.DeltaAlignment.from_characters(h)
+
+    def test_differences(self):
+        h, a = self.example()
+        assert_array_equal(a.diff_position, [500] + list(range(600, 610)))
+        assert_array_equal(a.missing_start, [0, 100, len(h) - 20])
+        assert_array_equal(a.missing_length, [50, 2, 20])
+        assert_array_equal(a.ambiguous_position, [0, 100])
+
+    def test_reference(self):
+        h = core.get_reference_sequence(as_array=True)
+        a = sa.DeltaAlignment.from_characters(h)
+        assert len(a.diff_position) == 0
+        assert_array_equal(a.missing_start, [0])
+        assert_array_equal(a.decode(), h)
+
+    def test_bytes_round_trip(self):
+        h, a = self.example()
+        b = sa.DeltaAlignment.frombytes(a.tobytes())
+        assert_array_equal(b.decode(), h)
+
+    def test_bad_length(self):
+        with pytest.raises(ValueError, match="length"):
+            sa.DeltaAlignment.from_characters(np.array(list("ACGT")))
+
+    @pytest.mark.parametrize(
+        "sites",
+        [
+            None,
+            [0],
+            [49, 50, 51],
+            [100, 101, 102, 500, 605],
+            [29903, 0, 605, 605],
+            np.arange(1, 29904, 7),
+        ],
+    )
+    def test_sites(self, sites):
+        h, a = self.example()
+        x = h if sites is None else h[sites]
+        assert_array_equal(a.decode(sites), x)
+        assert_array_equal(a.haplotype(sites), sa.encode_alignment(x))
+        assert a.composition(sites) == collections.Counter(x)
+
+    def test_matches_encoded(self, fx_alignment_store):
+        for strain in ["SRR11772659", "SRR11597116"]:
+            h = fx_alignment_store[strain]
+            a = sa.DeltaAlignment.from_characters(h)
+            b = sa.EncodedAlignment.from_characters(h)
+            sites = np.arange(1, len(h), 2)
+            assert_array_equal(a.haplotype(), b.haplotype())
+            assert_array_equal(a.haplotype(sites), b.haplotype(sites))
+            assert a.composition(sites) == b.composition(sites)
@@ -7,6 +7,7 @@ import pytest
 import tskit
 
 import sc2ts
+import util
 from sc2ts import __main__ as main
 from sc2ts import cli
 
@@ -105,6 +106,141 @@ class TestInitialise:
         assert "max_memory" in resources
 
 
+class TestImportAlignments:
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    @pytest.mark.parametrize("encoding", ["int8", "delta"])
+    def test_gzip(self, tmp_path, fx_alignment_store, num_workers, encoding):
+        store_path = tmp_path / "alignments.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"import-alignments {store_path} tests/data/alignments.fasta.gz "
+            f"--initialise=True --encoding={encoding} --num-workers={num_workers} "
+            "--no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        with sc2ts.AlignmentStore(store_path) as store:
+            assert store.encoding == encoding
+            assert len(store) == len(fx_alignment_store)
+            strain = "SRR11772659"
+            assert np.array_equal(store[strain], fx_alignment_store[strain])
+
+    def test_incremental(self, tmp_path, fx_alignment_store):
+        store_path = tmp_path / "alignments.db"
+        fasta_path = "tests/data/alignments.fasta.gz"
+        runner = ct.CliRunner(mix_stderr=False)
+        cmd = f"import-alignments {store_path} {fasta_path} --no-progress=True"
+        result = runner.invoke(
+            cli.cli, cmd + " --initialise=True", catch_exceptions=False
+        )
+        assert result.exit_code == 0
+        n = len(fx_alignment_store)
+        assert result.stdout.splitlines() == [
+            f"{fasta_path}\tnew={n}\tchanged=0\tunchanged=0"
+        ]
+        result = runner.invoke(cli.cli, cmd + " --incremental", catch_exceptions=False)
+        assert result.exit_code == 0
+        assert result.stdout.splitlines() == [
+            f"{fasta_path}\tnew=0\tchanged=0\tunchanged={n}"
+        ]
+
+
+class TestShardedAlignments:
+    def test_import_reshard(self, tmp_path, fx_alignment_store):
+        store_path = tmp_path / "sharded"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"import-alignments {store_path} tests/data/alignments.fasta.gz "
+            "--initialise=True --num-shards=3 --num-workers=2 --no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cli.cli,
+            f"reshard-alignments {store_path} {tmp_path / 'resharded'} "
+            "--num-shards=2 --no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cli.cli,
+            f"info-alignments {tmp_path / 'resharded'}",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        assert "contains 55 alignments in 2 shards" in result.stdout
+
+
+class TestInfoAlignments:
+    def test_defaults(self, fx_alignment_store):
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"info-alignments {fx_alignment_store.path}",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        assert "contains 55 alignments" in result.stdout
+        assert "num_missing" in result.stdout
+
+
+class TestExportAlignmentMatrix:
+    def test_defaults(self, tmp_path, fx_alignment_store):
+        output = tmp_path / "alignments.zarr"
+        strains_path = tmp_path / "strains.txt"
+        strains = list(fx_alignment_store)[:5]
+        strains_path.write_text("\n".join(strains) + "\n")
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"export-alignment-matrix {fx_alignment_store.path} {output} "
+            f"--strains={strains_path} --samples-chunk-size=2 --no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        matrix = sc2ts.AlignmentMatrix(output)
+        assert list(matrix) == strains
+        H, _ = fx_alignment_store.get_many(strains)
+        assert np.array_equal(matrix.get_genotypes(), H[:, 1:].T)
+
+
+class TestExtend:
+    def test_end_date(self, tmp_path, fx_ts_map, fx_alignment_store, fx_metadata_db):
+        base_path = tmp_path / "base.ts"
+        fx_ts_map["2020-01-28"].dump(base_path)
+        match_db_path = tmp_path / "match.db"
+        sc2ts.MatchDb.initialise(match_db_path).close()
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"extend {base_path} 2020-01-29 {fx_alignment_store.path} "
+            f"{fx_metadata_db.path} {match_db_path} {tmp_path}/{{}}.ts "
+            "--end-date=2020-01-31 --no-progress",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        for date in ["2020-01-29", "2020-01-30", "2020-01-31"]:
+            ts = tskit.load(tmp_path / f"{date}.ts")
+            ts.tables.assert_equals(fx_ts_map[date].tables, ignore_provenance=True)
+        assert not (tmp_path / "2020-02-01.ts").exists()
+
+    def test_end_date_needs_pattern(self, tmp_path, fx_ts_map, fx_metadata_db):
+        base_path = tmp_path / "base.ts"
+        fx_ts_map["2020-01-28"].dump(base_path)
+        match_db_path = tmp_path / "match.db"
+        sc2ts.MatchDb.initialise(match_db_path).close()
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"extend {base_path} 2020-01-29 {base_path} {fx_metadata_db.path} "
+            f"{match_db_path} {tmp_path}/out.ts --end-date=2020-01-31",
+        )
+        assert result.exit_code != 0
+        assert "pattern" in result.stderr
+
+
 class TestMatch:
 
     def test_single_defaults(self, tmp_path, fx_ts_map, fx_alignment_store):
@@ -128,6 +264,24 @@ class TestMatch:
         assert len(d["match"]["path"]) == 1
         assert len(d["match"]["mutations"]) == 5
 
+    def test_sharded_store(self, tmp_path, fx_ts_map, fx_alignment_store):
+        strain = "ERR4206593"
+        ts_path = tmp_path / "ts.ts"
+        fx_ts_map["2020-02-04"].dump(ts_path)
+        store_path = tmp_path / "sharded"
+        with sc2ts.ShardedAlignmentStore.initialise(store_path, 2) as store:
+            store.append({strain: fx_alignment_store[strain]})
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"match {store_path} {ts_path} {strain}",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        d = json.loads(result.stdout)
+        assert d["strain"] == strain
+        assert len(d["match"]["mutations"]) == 5
+
     def test_multi_defaults(self, tmp_path, fx_ts_map, fx_alignment_store):
         copies = 10
         strains = ["ERR4206593"] * 10
@@ -176,6 +330,27 @@ class TestMatch:
         assert len(d["match"]["path"]) == 1
         assert len(d["match"]["mutations"]) == 5
 
+    def test_hmm_cache(self, tmp_path, fx_ts_map, fx_alignment_store):
+        strain = "ERR4206593"
+        ts = fx_ts_map["2020-02-04"]
+        ts_path = tmp_path / "ts.ts"
+        ts.dump(ts_path)
+        cache_path = tmp_path / "hmm_cache.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        outputs = []
+        for _ in range(2):
+            result = runner.invoke(
+                cli.cli,
+                f"match {fx_alignment_store.path} {ts_path} {strain} "
+                f"--hmm-cache={cache_path}",
+                catch_exceptions=False,
+            )
+            assert result.exit_code == 0
+            outputs.append(result.stdout)
+        assert outputs[0] == outputs[1]
+        with sc2ts.HmmCache(cache_path) as cache:
+            assert len(cache) == 1
+
 
 class TestRunRematchRecombinants:
 
@@ -213,6 +388,29 @@ class TestRunRematchRecombinants:
         assert len(results["recombinant_example_1_0"]) == 2
         assert len(results["recombinant_example_1_1"]) == 2
 
+    @pytest.mark.parametrize("num_threads", [0, 2])
+    def test_hmm_cache(
+        self, tmp_path, fx_recombinant_example_1, fx_data_cache, num_threads
+    ):
+        ts_path = fx_data_cache / "recombinant_ex1.ts"
+        as_path = fx_data_cache / "recombinant_ex1_alignments.db"
+        pattern = str(fx_data_cache) + "/{}.ts"
+        cache_path = tmp_path / "hmm_cache.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        cmd = (
+            f"rematch-recombinants {as_path} {ts_path} {pattern} "
+            f"--num-threads={num_threads} --hmm-cache={cache_path}"
+        )
+        outputs = []
+        for _ in range(2):
+            result = runner.invoke(cli.cli, cmd, catch_exceptions=False)
+            assert result.exit_code == 0
+            outputs.append(sorted(result.stdout.splitlines()))
+        assert outputs[0] == outputs[1]
+        with sc2ts.HmmCache(cache_path) as cache:
+            # Two strains matched in each direction
+            assert len(cache) == 4
+
 
 class TestInfoMatches:
     def test_defaults(self, fx_match_db):
@@ -224,6 +422,72 @@ class TestInfoMatches:
         )
         assert result.exit_code == 0
 
+    def test_check_mask(self, tmp_path, fx_ts_map, fx_match_db):
+        ts_path = tmp_path / "ts.ts"
+        # The mask is set from the base ARG of the last day matched
+        fx_ts_map["2020-02-11"].dump(ts_path)
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"info-matches {fx_match_db.path} --check-mask={ts_path}",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        assert "used sample mask is consistent" in result.stdout
+
+
+class TestMigrateMatches:
+    def test_defaults(self, tmp_path):
+        L = int(sc2ts.core.REFERENCE_SEQUENCE_LENGTH)
+        samples = [
+            sc2ts.Sample(
+                f"x{j}",
+                "2020-01-01",
+                haplotype=np.zeros(10, dtype=np.int8),
+                hmm_match=sc2ts.HmmMatch([sc2ts.PathSegment(0, L, 1)], []),
+            )
+            for j in range(3)
+        ]
+        source = tmp_path / "v1.db"
+        util.get_v1_match_db(source, samples, "2020-01-01", 3).close()
+        dest = tmp_path / "v2.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"migrate-matches {source} {dest} --no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        assert "has 3 samples" in result.stdout
+        with sc2ts.MatchDb(dest) as match_db:
+            assert match_db.schema_version == sc2ts.MATCH_DB_SCHEMA_VERSION
+            assert len(match_db) == 3
+
+
+class TestArchiveMatches:
+    def test_defaults(self, tmp_path, fx_match_db):
+        match_db_path = tmp_path / "match.db"
+        # Copy the DB so that the cached fixture isn't modified
+        with sc2ts.MatchDb(match_db_path) as match_db:
+            fx_match_db.conn.backup(match_db.conn)
+            total = len(match_db)
+        archive_path = tmp_path / "archive.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"archive-matches {match_db_path} {archive_path} "
+            "--retrospective-window=7",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        assert "matched before 2020-02-07" in result.stdout
+        with sc2ts.MatchDb(match_db_path) as match_db:
+            num_hot = len(match_db)
+            dates = set(match_db.as_dataframe()["match_date"])
+        assert min(dates) >= "2020-02-07"
+        with sc2ts.MatchDb(archive_path) as archive_db:
+            assert len(archive_db) + num_hot == total
+
 
 class TestListDates:
     def test_defaults(self, fx_metadata_db):
@@ -287,3 +551,48 @@ class TestListDates:
             "2020-02-11\t2",
             "2020-02-13\t4",
         ]
+
+
+class TestSnapshotMetadata:
+    def test_list_dates_counts(self, tmp_path, fx_metadata_db):
+        output = tmp_path / "snapshot"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"snapshot-metadata {fx_metadata_db.path} {output} "
+            "--column=Viridian_pangolin",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        snapshot = sc2ts.MetadataSnapshot(output)
+        assert snapshot.columns == ["strain", "date", "Viridian_pangolin"]
+        results = []
+        for path in [fx_metadata_db.path, output]:
+            result = runner.invoke(
+                cli.cli,
+                f"list-dates {path} --counts",
+                catch_exceptions=False,
+            )
+            assert result.exit_code == 0
+            results.append(result.stdout)
+        assert results[0] == results[1]
+
+
+class TestImportMetadata:
+    def test_indexes(self, tmp_path, fx_metadata_db):
+        db_path = tmp_path / "metadata.db"
+        runner = ct.CliRunner(mix_stderr=False)
+        result = runner.invoke(
+            cli.cli,
+            f"import-metadata tests/data/metadata.tsv {db_path} "
+            "--index=Viridian_pangolin,date --index=Country --no-progress=True",
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0
+        with sc2ts.MetadataDb(db_path) as db:
+            assert db.lineage_column == "Viridian_pangolin"
+            assert db.lineage_counts() == fx_metadata_db.lineage_counts()
+            rows = db.query("SELECT name FROM sqlite_master WHERE type='index'")
+            names = {row["name"] for row in rows}
+        assert "ix_samples_Viridian_pangolin_date" in names
+        assert "ix_samples_Country" in names
@@ -0,0 +1,63 @@
+import pickle
+
+import pytest
+
+from sc2ts import compression
+
+
+def example_values():
+    return [(b"ACGT" * 100 + str(j).encode()) * 10 for j in range(200)]
+
+
+class TestCodecs:
+    @pytest.mark.parametrize("name", ["bz2", "zstd", "lz4"])
+    def test_round_trip(self, name):
+        pytest.importorskip({"bz2": "bz2", "zstd": "zstandard", "lz4": "lz4"}[name])
+        codec = compression.get_codec({"name": name})
+        for value in example_values()[:10]:
+            compressed = codec.compress(value)
+            assert len(compressed) < len(value)
+            assert codec.decompress(compressed) == value
+
+    @pytest.mark.parametrize("name", ["bz2", "zstd", "lz4"])
+    def test_config_round_trip(self, name):
+        pytest.importorskip({"bz2": "bz2", "zstd": "zstandard", "lz4": "lz4"}[name])
+        codec = compression.get_codec({"name": name})
+        other = compression.get_codec(codec.asdict())
+        assert type(other) == type(codec)
+        assert other.asdict() == codec.asdict()
+
+    def test_default(self):
+        assert isinstance(compression.get_codec(), compression.Bz2Codec)
+
+    def test_unknown(self):
+        with pytest.raises(ValueError, match="Unknown codec"):
+            compression.get_codec({"name": "xz"})
+
+
+class TestZstdDictionary:
+    def test_round_trip(self):
+        pytest.importorskip("zstandard")
+        values = example_values()
+        dictionary = compression.train_dictionary(values, dict_size=4096)
+        codec = compression.ZstdCodec(dictionary=dictionary)
+        assert codec.asdict()["has_dictionary"]
+        for value in values[:10]:
+            assert codec.decompress(codec.compress(value)) == value
+        other = compression.get_codec(codec.asdict(), dictionary)
+        assert other.decompress(codec.compress(values[0])) == values[0]
+
+    def test_missing_dictionary(self):
+        pytest.importorskip("zstandard")
+        with pytest.raises(ValueError, match="dictionary"):
+            compression.get_codec({"name": "zstd", "has_dictionary": True})
+
+    def test_pickle(self):
+        pytest.importorskip("zstandard")
+        values = example_values()
+        dictionary = compression.train_dictionary(values, dict_size=4096)
+        codec = compression.ZstdCodec(level=5, dictionary=dictionary)
+        compressed = codec.compress(values[0])
+        other = pickle.loads(pickle.dumps(codec))
+        assert other.level == 5
+        assert other.decompress(compressed) == values[0]
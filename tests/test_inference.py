@@ -1,6 +1,7 @@
 import collections
 import hashlib
 import logging
+import sqlite3
 
 import numpy as np
 import numpy.testing as nt
@@ -111,6 +112,540 @@ class TestInitialTs:
         assert alignment == sc2ts.core.get_reference_sequence()
 
 
+def example_match_db_samples(n, date="2020-01-01"):
+    L = int(sc2ts.core.REFERENCE_SEQUENCE_LENGTH)
+    samples = []
+    for j in range(n):
+        hmm_match = sc2ts.HmmMatch([sc2ts.PathSegment(0, L, 1)], [])
+        samples.append(
+            sc2ts.Sample(
+                f"x{j}",
+                date,
+                haplotype=np.zeros(10, dtype=np.int8),
+                hmm_match=hmm_match,
+                metadata={"index": j},
+            )
+        )
+    return samples
+
+
+class TestMatchDb:
+    @pytest.mark.parametrize("codec", ["bz2", "zstd", "lz4"])
+    def test_codec_round_trip(self, tmp_path, codec):
+        pytest.importorskip({"bz2": "bz2", "zstd": "zstandard", "lz4": "lz4"}[codec])
+        samples = example_match_db_samples(5)
+        path = tmp_path / "match.db"
+        sc2ts.MatchDb.initialise(path, codec=codec)
+        with sc2ts.MatchDb(path) as match_db:
+            assert match_db.codec.name == codec
+            match_db.add(samples, "2020-01-01", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            result = sorted(match_db.get("hmm_cost==0"), key=lambda s: s.strain)
+        assert [s.strain for s in result] == [s.strain for s in samples]
+        assert [s.metadata for s in result] == [s.metadata for s in samples]
+
+    def test_zstd_dictionary(self, tmp_path):
+        pytest.importorskip("zstandard")
+        samples = example_match_db_samples(100)
+        path = tmp_path / "match.db"
+        sc2ts.MatchDb.initialise(path, codec="zstd", training_samples=samples)
+        with sc2ts.MatchDb(path) as match_db:
+            assert match_db.codec.dictionary is not None
+            match_db.add(samples[:3], "2020-01-01", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            assert len(list(match_db.get("hmm_cost==0"))) == 3
+
+    def test_legacy_bz2(self, tmp_path):
+        path = tmp_path / "match.db"
+        sc2ts.MatchDb.initialise(path)
+        with sc2ts.MatchDb(path) as match_db:
+            match_db.conn.execute("DROP TABLE metadata")
+        samples = example_match_db_samples(2)
+        with sc2ts.MatchDb(path) as match_db:
+            assert match_db.codec.name == "bz2"
+            match_db.add(samples, "2020-01-01", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            assert len(list(match_db.get("hmm_cost==0"))) == 2
+
+    def test_get_bound_args(self, tmp_path):
+        path = tmp_path / "match.db"
+        with sc2ts.MatchDb.initialise(path) as match_db:
+            match_db.add(example_match_db_samples(2, "2020-01-01"), "2020-01-01", 3)
+            samples = example_match_db_samples(3, "2020-01-02")
+            for sample in samples:
+                sample.strain += "_2"
+            match_db.add(samples, "2020-01-02", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            for date, n in [("2020-01-01", 2), ("2020-01-02", 3), ("x' OR 1==1", 0)]:
+                result = list(match_db.get("match_date==?", (date,)))
+                assert len(result) == n
+            result = list(
+                match_db.get("match_date>? AND match_date<=?", ("2020", "2020-01-01"))
+            )
+            assert len(result) == 2
+
+    def test_explain_uses_date_index(self, tmp_path):
+        path = tmp_path / "match.db"
+        with sc2ts.MatchDb.initialise(path) as match_db:
+            match_db.create_mask_table(sc2ts.initial_ts())
+            plan = match_db.explain(
+                "hmm_cost>0 AND match_date<? AND match_date>?",
+                ("2020-02-01", "2020-01-01"),
+            )
+        assert any("ix_samples_match_date" in step for step in plan)
+
+
+def example_match(strain, date="2020-01-01", path=((0, 29904, 1),), mutations=()):
+    hmm_match = sc2ts.HmmMatch(
+        [sc2ts.PathSegment(*seg) for seg in path],
+        [
+            sc2ts.MatchMutation(
+                site_id=site,
+                site_position=site + 100,
+                inherited_state="A",
+                derived_state=derived,
+                is_reversion=False,
+                is_immediate_reversion=immediate_reversion,
+            )
+            for site, derived, immediate_reversion in mutations
+        ],
+        likelihood=0.5,
+    )
+    return sc2ts.Sample(
+        strain,
+        date,
+        pango="B.1",
+        metadata={"strain": strain, "date": date, "country": strain[0]},
+        haplotype=np.array([0, 1, 2, 3, 4, -1], dtype=np.int8),
+        hmm_match=hmm_match,
+    )
+
+
+def assert_samples_equal(s1, s2):
+    assert s1.strain == s2.strain
+    assert s1.date == s2.date
+    assert s1.pango == s2.pango
+    assert s1.metadata == s2.metadata
+    nt.assert_array_equal(s1.haplotype, s2.haplotype)
+    assert s1.haplotype.dtype == s2.haplotype.dtype
+    assert s1.hmm_match == s2.hmm_match
+
+
+def mask_ts(strains):
+    # Returns the initial ts with the specified strains appended to the
+    # samples_strain metadata
+    tables = sc2ts.initial_ts().dump_tables()
+    md = tables.metadata
+    md["sc2ts"]["samples_strain"] += strains
+    tables.metadata = md
+    return tables.tree_sequence()
+
+
+class TestMatchDbSchema:
+    def example_samples(self, date="2020-01-01"):
+        return [
+            example_match("a1", date, mutations=[(5, "C", False)]),
+            example_match("b1", date, mutations=[(5, "T", True), (7, "G", False)]),
+            example_match("a2", date, mutations=[(6, "C", False)]),
+            example_match("b2", date, path=[(0, 100, 2), (100, 29904, 1)]),
+            example_match("a3", date, mutations=[(5, "T", True)]),
+        ]
+
+    def test_round_trip(self, tmp_path):
+        samples = self.example_samples()
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            assert match_db.schema_version == sc2ts.MATCH_DB_SCHEMA_VERSION
+            match_db.add(samples, "2020-01-01", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            result = list(match_db.get("hmm_cost>=0"))
+            strains = ["a3", "b2", "a1"]
+            many = match_db.get_many(strains)
+        assert len(result) == len(samples)
+        for s1, s2 in zip(samples, result):
+            assert_samples_equal(s1, s2)
+        assert [s.strain for s in many] == strains
+
+    @pytest.mark.parametrize("batch_size", [1, 2, 100])
+    @pytest.mark.parametrize("num_workers", [0, 2])
+    def test_get_batches(self, tmp_path, batch_size, num_workers):
+        samples = self.example_samples()
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(samples, "2020-01-01", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            batches = list(
+                match_db.get_batches(
+                    "hmm_cost>=?",
+                    (0,),
+                    batch_size=batch_size,
+                    num_workers=num_workers,
+                )
+            )
+            strains = ["b2", "a1", "a3", "b1"]
+            many = match_db.get_many(
+                strains, batch_size=batch_size, num_workers=num_workers
+            )
+        assert [len(batch) for batch in batches[:-1]] == [batch_size] * (
+            len(batches) - 1
+        )
+        result = [sample for batch in batches for sample in batch]
+        assert len(result) == len(samples)
+        for s1, s2 in zip(samples, result):
+            assert_samples_equal(s1, s2)
+        assert [s.strain for s in many] == strains
+
+    def test_get_batches_v1(self, tmp_path):
+        samples = self.example_samples()
+        path = tmp_path / "v1.db"
+        with util.get_v1_match_db(path, samples, "2020-01-01", 3) as match_db:
+            match_db.create_mask_table(sc2ts.initial_ts())
+            batches = list(match_db.get_batches("1", batch_size=2, num_workers=2))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        result = [sample for batch in batches for sample in batch]
+        for s1, s2 in zip(samples, result):
+            assert_samples_equal(s1, s2)
+
+    def test_get_many_missing(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            with pytest.raises(KeyError, match="xxx"):
+                match_db.get_many(["xxx"])
+
+    def test_tables(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(self.example_samples(), "2020-01-01", 3)
+            rows = match_db.conn.execute(
+                "SELECT * FROM match_mutations WHERE strain=='b1' ORDER BY mut_index"
+            ).fetchall()
+            assert [row["site_id"] for row in rows] == [5, 7]
+            assert [row["is_immediate_reversion"] for row in rows] == [1, 0]
+            rows = match_db.conn.execute(
+                "SELECT * FROM path_segments WHERE strain=='b2' ORDER BY seg_index"
+            ).fetchall()
+            assert [(row["left"], row["right"], row["parent"]) for row in rows] == [
+                (0, 100, 2),
+                (100, 29904, 1),
+            ]
+
+    def test_group_key(self):
+        samples = self.example_samples()
+        keys = [sc2ts.match_group_key(s.hmm_match) for s in samples]
+        # Only the path and immediate reversions are in the key
+        assert keys[0] == keys[2]
+        assert keys[1] == keys[4]
+        assert len(set(keys)) == 3
+
+    def test_get_groups(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(self.example_samples(), "2020-01-01", 3)
+            samples = self.example_samples("2020-01-02")
+            for sample in samples[:2]:
+                sample.strain += "_2"
+            match_db.add(samples[:2], "2020-01-02", 3)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            groups = match_db.get_groups("hmm_cost>0")
+            assert [strains for _, _, strains in groups] == [
+                ["a1", "a2", "a1_2"],
+                ["b1", "a3", "b1_2"],
+                ["b2"],
+            ]
+            groups = match_db.get_groups("hmm_cost>=0", min_group_size=2)
+            assert len(groups) == 2
+            groups = match_db.get_groups("match_date==?", ("2020-01-01",))
+            assert [strains for _, _, strains in groups] == [
+                ["a1", "a2"],
+                ["b1", "a3"],
+                ["b2"],
+            ]
+            groups = match_db.get_groups(
+                "hmm_cost>0", min_group_size=1, min_different_dates=2
+            )
+            assert len(groups) == 2
+            groups = match_db.get_groups("hmm_cost>0", additional_keys=["country"])
+            assert [(values, strains) for _, values, strains in groups] == [
+                (["a"], ["a1", "a2", "a1_2"]),
+                (["b"], ["b1", "b1_2"]),
+                (["b"], ["b2"]),
+                (["a"], ["a3"]),
+            ]
+
+    def test_get_groups_used_samples(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(self.example_samples(), "2020-01-01", 3)
+            match_db.create_mask_table(mask_ts(["a1"]))
+            groups = match_db.get_groups("hmm_cost>0")
+            assert [strains for _, _, strains in groups] == [
+                ["b1", "a3"],
+                ["a2"],
+                ["b2"],
+            ]
+            assert match_db.count("hmm_cost>0") == 4
+
+    def test_hmm_cost_counts(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(self.example_samples(), "2020-01-01", 3)
+            assert match_db.hmm_cost_counts() == {1: 3, 2: 1, 3: 1}
+
+    def test_delete_newer(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(self.example_samples(), "2020-01-01", 3)
+            samples = self.example_samples("2020-01-02")
+            for sample in samples:
+                sample.strain += "_2"
+            match_db.add(samples, "2020-01-02", 3)
+            match_db.delete_newer("2020-01-02")
+            assert len(match_db) == 5
+            for table, n in [("path_segments", 6), ("match_mutations", 5)]:
+                row = match_db.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+                assert row["COUNT(*)"] == n
+
+    def test_migrate(self, tmp_path):
+        samples = self.example_samples()
+        v1_path = tmp_path / "v1.db"
+        with util.get_v1_match_db(v1_path, samples, "2020-01-01", 3) as match_db:
+            assert match_db.schema_version == 1
+            match_db.create_mask_table(sc2ts.initial_ts())
+            v1_samples = list(match_db.get("hmm_cost>=0"))
+            with pytest.raises(ValueError, match="migrate_match_db"):
+                match_db.add(samples, "2020-01-01", 3)
+            with pytest.raises(ValueError, match="migrate_match_db"):
+                match_db.get_groups("hmm_cost>=0")
+            v1_costs = match_db.as_dataframe()
+        with sc2ts.migrate_match_db(v1_path, tmp_path / "v2.db") as match_db:
+            assert match_db.schema_version == sc2ts.MATCH_DB_SCHEMA_VERSION
+            assert match_db.codec.name == "bz2"
+            pd.testing.assert_frame_equal(match_db.as_dataframe(), v1_costs)
+            match_db.create_mask_table(sc2ts.initial_ts())
+            v2_samples = list(match_db.get("hmm_cost>=0"))
+        assert len(v2_samples) == len(samples)
+        for s1, s2, s3 in zip(samples, v1_samples, v2_samples):
+            assert_samples_equal(s1, s2)
+            assert_samples_equal(s1, s3)
+
+    def test_v1_journal_mode_unchanged(self, tmp_path):
+        path = tmp_path / "v1.db"
+        samples = self.example_samples()
+        with util.get_v1_match_db(path, samples, "2020-01-01", 3) as match_db:
+            with pytest.raises(ValueError, match="migrate_match_db"):
+                match_db.add(samples, "2020-01-01", 3)
+        with sqlite3.connect(path) as conn:
+            row = conn.execute("PRAGMA journal_mode").fetchone()
+        conn.close()
+        assert row[0] == "delete"
+
+    def test_migrate_current(self, tmp_path):
+        sc2ts.MatchDb.initialise(tmp_path / "match.db")
+        with pytest.raises(ValueError, match="current schema"):
+            sc2ts.migrate_match_db(tmp_path / "match.db", tmp_path / "new.db")
+
+
+class TestMatchDbMask:
+    def used(self, match_db):
+        rows = match_db.conn.execute("SELECT strain FROM samples WHERE used==1")
+        return {row["strain"] for row in rows}
+
+    def test_incremental(self, tmp_path, caplog):
+        samples = example_match_db_samples(5)
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(samples, "2020-01-01", 3)
+            with caplog.at_level("INFO", logger="sc2ts.inference"):
+                match_db.create_mask_table(mask_ts(["x0"]))
+                assert "Marking 2 samples as used in DB (incremental)" in caplog.text
+                assert self.used(match_db) == {"x0"}
+                match_db.create_mask_table(mask_ts(["x0", "x3", "x4"]))
+                assert "Marking 2 samples as used in DB (incremental)" in caplog.text
+            assert self.used(match_db) == {"x0", "x3", "x4"}
+            assert [s.strain for s in match_db.get("1")] == ["x1", "x2"]
+            match_db.check_mask(mask_ts(["x0", "x3", "x4"]))
+
+    def test_rebuild_on_earlier_ts(self, tmp_path, caplog):
+        samples = example_match_db_samples(5)
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(samples, "2020-01-01", 3)
+            match_db.create_mask_table(mask_ts(["x0", "x1"]))
+            with caplog.at_level("INFO", logger="sc2ts.inference"):
+                match_db.create_mask_table(mask_ts(["x2"]))
+            assert "(rebuild)" in caplog.text
+            assert self.used(match_db) == {"x2"}
+            match_db.create_mask_table(mask_ts(["x3"]), rebuild=True)
+            assert self.used(match_db) == {"x3"}
+            match_db.check_mask(mask_ts(["x3"]))
+
+    def test_added_after_mask(self, tmp_path):
+        # Samples that are already in the ARG are flagged when added
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.create_mask_table(mask_ts(["x1"]))
+            match_db.add(example_match_db_samples(3), "2020-01-01", 3)
+            assert self.used(match_db) == {"x1"}
+            match_db.check_mask()
+
+    def test_check_mask(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            match_db.add(example_match_db_samples(3), "2020-01-01", 3)
+            match_db.create_mask_table(mask_ts(["x1"]))
+            match_db.check_mask()
+            with pytest.raises(ValueError, match="differ from ARG"):
+                match_db.check_mask(mask_ts(["x1", "x2"]))
+            match_db.conn.execute("UPDATE samples SET used=1 WHERE strain=='x0'")
+            with pytest.raises(ValueError, match="1 samples have incorrect"):
+                match_db.check_mask()
+
+    def test_uses_no_join(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            plan = match_db.explain("match_date==?", ("2020-01-01",))
+        assert not any("used_samples" in step for step in plan)
+
+
+class TestMatchDbConnection:
+    def pragma(self, match_db, name):
+        return list(match_db.conn.execute(f"PRAGMA {name}").fetchone().values())[0]
+
+    def test_defaults(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            assert self.pragma(match_db, "journal_mode") == "wal"
+            # NORMAL
+            assert self.pragma(match_db, "synchronous") == 1
+            assert self.pragma(match_db, "cache_size") == -64 * 1024
+            assert self.pragma(match_db, "mmap_size") == 256 * 1024**2
+
+    def test_pragmas(self, tmp_path):
+        pragmas = {"synchronous": "full", "cache_size": -1000, "mmap_size": 0}
+        with sc2ts.MatchDb.initialise(
+            tmp_path / "match.db", pragmas=pragmas
+        ) as match_db:
+            assert self.pragma(match_db, "synchronous") == 2
+            assert self.pragma(match_db, "cache_size") == -1000
+            assert self.pragma(match_db, "mmap_size") == 0
+
+    @pytest.mark.parametrize(
+        "pragmas",
+        [
+            {"journal_mode": "DELETE"},
+            {"synchronous": "NORMAL; DROP TABLE samples"},
+            {"cache_size": "x"},
+        ],
+    )
+    def test_bad_pragmas(self, tmp_path, pragmas):
+        sc2ts.MatchDb.initialise(tmp_path / "match.db")
+        with pytest.raises(ValueError):
+            sc2ts.MatchDb(tmp_path / "match.db", pragmas=pragmas)
+
+    def test_readonly(self, tmp_path):
+        path = tmp_path / "match.db"
+        with sc2ts.MatchDb.initialise(path) as match_db:
+            match_db.add(example_match_db_samples(2), "2020-01-01", 3)
+        with sc2ts.MatchDb(path, readonly=True) as match_db:
+            assert match_db.readonly
+            assert len(match_db) == 2
+            assert len(list(match_db.get("1"))) == 2
+            with pytest.raises(sqlite3.OperationalError, match="readonly"):
+                match_db.delete_newer("2020-01-01")
+
+    def test_concurrent_reader(self, tmp_path):
+        # A reader sees committed data while a writer is open
+        path = tmp_path / "match.db"
+        with sc2ts.MatchDb.initialise(path) as writer:
+            writer.add(example_match_db_samples(2), "2020-01-01", 3)
+            with sc2ts.MatchDb(path, readonly=True) as reader:
+                assert len(reader) == 2
+                samples = example_match_db_samples(3, "2020-01-02")
+                for sample in samples:
+                    sample.strain += "_2"
+                writer.add(samples, "2020-01-02", 3)
+                assert len(reader) == 5
+
+    def test_initialise_removes_wal(self, tmp_path):
+        path = tmp_path / "match.db"
+        with sc2ts.MatchDb.initialise(path) as match_db:
+            match_db.add(example_match_db_samples(2), "2020-01-01", 3)
+            with sc2ts.MatchDb.initialise(path) as new_db:
+                assert len(new_db) == 0
+
+
+class TestMatchDbArchive:
+    def populate(self, match_db):
+        for day in range(1, 4):
+            date = f"2020-01-0{day}"
+            samples = example_match_db_samples(3, date)
+            for sample in samples:
+                sample.strain += f"_{day}"
+            match_db.add(samples, date, 3)
+        match_db.create_mask_table(mask_ts(["x0_3"]))
+
+    def strains(self, match_db, table="samples"):
+        rows = match_db.conn.execute(f"SELECT DISTINCT strain FROM {table}")
+        return {row["strain"] for row in rows}
+
+    def test_archive_before(self, tmp_path):
+        archive_path = tmp_path / "archive.db"
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            self.populate(match_db)
+            n = match_db.archive(archive_path, before="2020-01-02", used=False)
+            assert n == 3
+            assert len(match_db) == 6
+            assert all(s.date >= "2020-01-02" for s in match_db.get("1"))
+            for table in ["samples", "path_segments"]:
+                assert self.strains(match_db, table) == {
+                    f"x{j}_{day}" for j in range(3) for day in [2, 3]
+                }
+        with sc2ts.MatchDb(archive_path) as archive_db:
+            assert len(archive_db) == 3
+            samples = archive_db.get_many(["x0_1", "x1_1", "x2_1"])
+            assert [s.date for s in samples] == ["2020-01-01"] * 3
+
+    def test_archive_used(self, tmp_path):
+        archive_path = tmp_path / "archive.db"
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            self.populate(match_db)
+            assert match_db.archive(archive_path, used=True) == 1
+            assert "x0_3" not in self.strains(match_db)
+            assert match_db.archive(archive_path, before="2020-01-02") == 3
+            assert len(match_db) == 5
+        with sc2ts.MatchDb(archive_path) as archive_db:
+            assert len(archive_db) == 4
+
+    def test_archive_rerun(self, tmp_path):
+        # Simulate an archive that was interrupted after the copy
+        archive_path = tmp_path / "archive.db"
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            self.populate(match_db)
+            with sc2ts.MatchDb.initialise(tmp_path / "copy.db") as copy_db:
+                match_db.conn.backup(copy_db.conn)
+                assert copy_db.archive(archive_path, before="2020-01-02") == 3
+            assert match_db.archive(archive_path, before="2020-01-02") == 3
+            assert len(match_db) == 6
+        with sc2ts.MatchDb(archive_path) as archive_db:
+            assert len(archive_db) == 3
+            num_segments = archive_db.conn.execute(
+                "SELECT COUNT(*) FROM path_segments"
+            ).fetchone()["COUNT(*)"]
+            assert num_segments == 3
+
+    def test_union_views(self, tmp_path):
+        archive_path = tmp_path / "archive.db"
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            self.populate(match_db)
+            all_strains = self.strains(match_db)
+            match_db.archive(archive_path, before="2020-01-03", used=True)
+            match_db.attach_archive(archive_path)
+            assert self.strains(match_db, "all_samples") == all_strains
+            assert self.strains(match_db, "all_path_segments") == all_strains
+            assert len(match_db) == 2
+
+    def test_codec_mismatch(self, tmp_path):
+        pytest.importorskip("lz4")
+        archive_path = tmp_path / "archive.db"
+        sc2ts.MatchDb.initialise(archive_path, codec="lz4").close()
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            self.populate(match_db)
+            with pytest.raises(ValueError, match="different codec"):
+                match_db.archive(archive_path, used=True)
+            assert len(match_db) == 9
+
+    def test_nothing_to_archive(self, tmp_path):
+        with sc2ts.MatchDb.initialise(tmp_path / "match.db") as match_db:
+            with pytest.raises(ValueError, match="by date or used"):
+                match_db.archive(tmp_path / "archive.db", used=False)
+
+
 class TestMatchTsinfer:
     def match_tsinfer(self, samples, ts, mirror_coordinates=False, **kwargs):
         sc2ts.inference.match_tsinfer(
@@ -186,6 +721,524 @@ class TestMatchTsinfer:
             assert mut.derived_state == sc2ts.core.ALLELES[allele]
 
 
+class TestTsbCache:
+    def small_ts(self):
+        ts = sc2ts.initial_ts()
+        tables = ts.dump_tables()
+        tables.sites.truncate(20)
+        return tables.tree_sequence()
+
+    def test_builds_once(self):
+        ts = self.small_ts()
+        with sc2ts.TsbCache() as cache:
+            tsb1, coord_map1 = cache.get(ts, 5)
+            tsb2, coord_map2 = cache.get(ts, 5)
+            assert tsb1 is tsb2
+            assert coord_map1 is coord_map2
+            assert cache.num_builds == 1
+            assert cache.num_hits == 1
+            assert len(cache) == 1
+
+    def test_distinct_keys(self):
+        ts = self.small_ts()
+        cache = sc2ts.TsbCache()
+        tsb1, _ = cache.get(ts, 5)
+        tsb2, _ = cache.get(ts, 4)
+        tsb3, _ = cache.get(ts, 5, mirror_coordinates=True)
+        tsb4, _ = cache.get(ts.dump_tables().tree_sequence(), 5)
+        assert len({id(tsb) for tsb in [tsb1, tsb2, tsb3, tsb4]}) == 4
+        assert cache.num_builds == 4
+        assert cache.num_hits == 0
+        cache.free()
+        assert len(cache) == 0
+
+    def test_coord_map_matches_make_tsb(self):
+        ts = self.small_ts()
+        with sc2ts.TsbCache() as cache:
+            for mirror in [False, True]:
+                _, coord_map1 = cache.get(ts, 5, mirror)
+                _, coord_map2 = sc2ts.inference.make_tsb(ts, 5, mirror)
+                nt.assert_array_equal(coord_map1, coord_map2)
+
+    @pytest.mark.parametrize("mirror", [False, True])
+    def test_match_tsinfer_shared(self, mirror):
+        ts = self.small_ts()
+        alignment = sc2ts.core.get_reference_sequence(as_array=True)
+        a = sc2ts.encode_alignment(alignment)
+        h = a[ts.sites_position.astype(int)]
+        h[5] = sc2ts.core.ALLELES.index("-")
+        with sc2ts.TsbCache() as cache:
+            for _ in range(3):
+                samples = [sc2ts.Sample("test", "2020-01-01", haplotype=h)]
+                sc2ts.inference.match_tsinfer(
+                    samples=samples,
+                    ts=ts,
+                    num_mismatches=3,
+                    mismatch_threshold=20,
+                    mirror_coordinates=mirror,
+                    tsb_cache=cache,
+                )
+                m = samples[0].hmm_match
+                assert m.breakpoints == [0, ts.sequence_length]
+                assert len(m.mutations) == 1
+                assert m.mutations[0].site_id == 5
+            assert cache.num_builds == 1
+            assert cache.num_hits == 2
+
+
+class TestIncrementalTsb:
+    dates = [
+        "2020-01-28",
+        "2020-01-29",
+        "2020-01-30",
+        "2020-01-31",
+        "2020-02-01",
+        "2020-02-02",
+        "2020-02-03",
+        "2020-02-04",
+    ]
+
+    def test_consecutive_days(self, fx_ts_map):
+        with sc2ts.TsbCache(incremental=True, verify=True) as cache:
+            for date in self.dates:
+                cache.get(fx_ts_map[date], 5)
+                assert len(cache) == 1
+            # 2020-02-02 and 2020-02-03 rewire existing nodes
+            assert cache.num_builds == 3
+            assert cache.num_updates == 5
+            assert cache.num_hits == 0
+
+    @pytest.mark.parametrize("date", dates[1:])
+    def test_update_tsb(self, fx_ts_map, date):
+        base_ts = fx_ts_map["2020-01-28"]
+        tsb, _ = sc2ts.inference.make_tsb(base_ts, 5)
+        ts = fx_ts_map[date]
+        # Edges deleted on later days were added after 2020-01-28
+        time_offset = sc2ts.inference.update_tsb(tsb, base_ts, ts)
+        assert time_offset == ts.nodes_time[0] - base_ts.nodes_time[0]
+        sc2ts.inference.verify_tsb(tsb, ts, 5, time_offset=time_offset)
+
+    def test_rewired(self, fx_ts_map):
+        base_ts = fx_ts_map["2020-02-01"]
+        tsb, _ = sc2ts.inference.make_tsb(base_ts, 5)
+        assert sc2ts.inference.update_tsb(tsb, base_ts, fx_ts_map["2020-02-02"]) is None
+        sc2ts.inference.verify_tsb(tsb, base_ts, 5)
+
+    def test_not_descendant(self, fx_ts_map):
+        base_ts = fx_ts_map["2020-02-01"]
+        tsb, _ = sc2ts.inference.make_tsb(base_ts, 5)
+        assert sc2ts.inference.update_tsb(tsb, base_ts, fx_ts_map["2020-01-31"]) is None
+
+    def test_verify_detects_difference(self, fx_ts_map):
+        tsb, _ = sc2ts.inference.make_tsb(fx_ts_map["2020-01-31"], 5)
+        with pytest.raises(ValueError, match="differ"):
+            sc2ts.inference.verify_tsb(tsb, fx_ts_map["2020-02-01"], 5)
+
+    def test_mirror_rebuilt(self, fx_ts_map):
+        with sc2ts.TsbCache(incremental=True) as cache:
+            for date in self.dates[:3]:
+                cache.get(fx_ts_map[date], 5, mirror_coordinates=True)
+            assert cache.num_builds == 3
+            assert cache.num_updates == 0
+
+    @pytest.mark.parametrize("mirror", [False, True])
+    def test_match_equal(self, fx_ts_map, mirror):
+        ts = fx_ts_map["2020-02-01"]
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        with sc2ts.TsbCache(incremental=True) as cache:
+            cache.get(fx_ts_map["2020-01-31"], 5, mirror)
+            matches = []
+            for tsb_cache in [cache, None]:
+                s = sc2ts.Sample("zerotype", "2020-02-02", haplotype=h)
+                sc2ts.inference.match_tsinfer(
+                    samples=[s],
+                    ts=ts,
+                    num_mismatches=3,
+                    mismatch_threshold=100,
+                    mirror_coordinates=mirror,
+                    tsb_cache=tsb_cache,
+                )
+                matches.append(s.hmm_match)
+            assert cache.num_updates == int(not mirror)
+        assert matches[0].path == matches[1].path
+        assert matches[0].mutation_summary() == matches[1].mutation_summary()
+
+
+def node_haplotypes(ts):
+    H = np.zeros((ts.num_nodes, ts.num_sites), dtype=np.int8)
+    nodes = np.arange(ts.num_nodes)
+    for var in ts.variants(samples=nodes, isolated_as_missing=False):
+        alleles = sc2ts.encode_alignment(np.array(var.alleles, dtype="U1"))
+        H[:, var.site.id] = alleles[var.genotypes]
+    return H
+
+
+class TestHaplotypeIndex:
+    def check_fingerprints(self, ts, index):
+        H = node_haplotypes(ts)
+        site = np.arange(ts.num_sites)
+        for u in range(ts.num_nodes):
+            fingerprint = np.bitwise_xor.reduce(index.allele_hash[site, H[u]])
+            assert index.fingerprint[u] == fingerprint
+            nt.assert_array_equal(index.node_alleles(u), H[u])
+
+    def check_lookup(self, ts, index):
+        H = node_haplotypes(ts)
+        samples = [
+            sc2ts.Sample(f"node_{u}", "2020-01-01", haplotype=H[u])
+            for u in range(ts.num_nodes)
+        ]
+        sc2ts.inference.match_tsinfer(
+            samples=samples, ts=ts, num_mismatches=3, mismatch_threshold=0
+        )
+        for u, sample in enumerate(samples):
+            assert len(sample.hmm_match.mutations) == 0
+            node = index.lookup(H[u])
+            if node != -1:
+                assert sample.hmm_match.path == [
+                    sc2ts.PathSegment(0, ts.sequence_length, node)
+                ]
+
+    @pytest.mark.parametrize("date", ["2020-01-01", "2020-02-01", "2020-02-13"])
+    def test_fingerprints(self, fx_ts_map, date):
+        ts = fx_ts_map[date]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        self.check_fingerprints(ts, index)
+        assert index.fingerprint[0] == 0
+        assert index.fingerprint[1] == 0
+
+    @pytest.mark.parametrize("date", ["2020-02-01", "2020-02-13"])
+    def test_lookup_agrees_with_hmm(self, fx_ts_map, date):
+        ts = fx_ts_map[date]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        self.check_lookup(ts, index)
+
+    def test_recombinant(self, fx_recombinant_example_1):
+        ts = fx_recombinant_example_1
+        recombinants = np.where(ts.nodes_flags & sc2ts.NODE_IS_RECOMBINANT)[0]
+        assert len(recombinants) > 0
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        assert np.all(index.parent[recombinants] == -1)
+        self.check_fingerprints(ts, index)
+        self.check_lookup(ts, index)
+
+    def test_incremental(self, fx_ts_map):
+        index = sc2ts.HaplotypeIndex()
+        for date in ["2020-01-30", "2020-01-31", "2020-02-01", "2020-02-02"]:
+            ts = fx_ts_map[date]
+            index.update(ts)
+            fresh = sc2ts.HaplotypeIndex()
+            fresh.update(ts)
+            nt.assert_array_equal(index.fingerprint, fresh.fingerprint)
+            nt.assert_array_equal(index.parent, fresh.parent)
+            nt.assert_array_equal(index.mutated_sites, fresh.mutated_sites)
+            nt.assert_array_equal(index.sorted_node, fresh.sorted_node)
+        self.check_fingerprints(ts, index)
+
+    def test_reference_matches_node_1(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        h = node_haplotypes(ts)[1]
+        assert index.lookup(h) == 1
+
+    def test_missing_data(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        u = ts.num_nodes - 1
+        h = node_haplotypes(ts)[u]
+        node = index.lookup(h)
+        assert node != -1
+        unmutated = np.where(~index.mutated_sites)[0]
+        h[unmutated[:100]] = -1
+        assert index.lookup(h) == node
+        h[ts.mutations_site[0]] = -1
+        assert index.lookup(h) == -1
+
+    def test_deletions_as_missing(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        h = node_haplotypes(ts)[1]
+        unmutated = np.where(~index.mutated_sites)[0]
+        h[unmutated[:10]] = sc2ts.core.ALLELES.index("-")
+        assert index.lookup(h) == -1
+        assert index.lookup(h, deletions_as_missing=True) == 1
+
+    def test_fingerprint_collision(self, fx_ts_map, caplog):
+        ts = fx_ts_map["2020-02-13"]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        u = ts.num_nodes - 1
+        h = node_haplotypes(ts)[u]
+        assert index.lookup(h) == u
+        # Force a collision with a haplotype that differs from u's at an
+        # unmutated site.
+        site = np.where(~index.mutated_sites)[0][0]
+        allele = (h[site] + 1) % 4
+        index.allele_hash[site, allele] = index.allele_hash[site, h[site]]
+        h[site] = allele
+        with caplog.at_level("WARNING", logger="sc2ts.inference"):
+            assert index.lookup(h) == -1
+        assert f"fingerprint collision at node {u}" in caplog.text
+
+    def test_no_match(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        index = sc2ts.HaplotypeIndex()
+        index.update(ts)
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        assert index.lookup(h) == -1
+
+    def test_match_samples_skips_hmm(self, fx_ts_map, caplog):
+        ts = fx_ts_map["2020-02-13"]
+        H = node_haplotypes(ts)
+        u = ts.num_nodes - 1
+        samples = [
+            sc2ts.Sample("exact", "2020-02-14", haplotype=H[u]),
+            sc2ts.Sample("zerotype", "2020-02-14", haplotype=np.zeros_like(H[u])),
+        ]
+        with caplog.at_level("INFO", logger="sc2ts.inference"):
+            sc2ts.match_samples(
+                "2020-02-14", samples, base_ts=ts, num_mismatches=3, num_threads=0
+            )
+        assert "1 exact matches found in haplotype index; 1 remain" in caplog.text
+        assert samples[0].hmm_match.path == [
+            sc2ts.PathSegment(0, ts.sequence_length, u)
+        ]
+        assert samples[0].hmm_match.likelihood == 1
+        assert len(samples[0].hmm_match.mutations) == 0
+        assert len(samples[1].hmm_match.mutations) > 0
+
+
+class TestMatchSamplesDedup:
+    def test_haplotype_digest(self):
+        h = np.array([0, 1, 4, -1], dtype=np.int8)
+        assert sc2ts.haplotype_digest(h) == sc2ts.haplotype_digest(h.copy())
+        g = np.array([0, 1, -1, -1], dtype=np.int8)
+        assert sc2ts.haplotype_digest(h) != sc2ts.haplotype_digest(g)
+        assert sc2ts.haplotype_digest(h, True) == sc2ts.haplotype_digest(g, True)
+        # The input isn't modified
+        assert h[2] == 4
+
+    @pytest.mark.parametrize("deletions_as_missing", [False, True])
+    def test_identical_samples(self, fx_ts_map, caplog, deletions_as_missing):
+        ts = fx_ts_map["2020-02-13"]
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        deleted = h.copy()
+        deleted[-5:] = sc2ts.core.ALLELES.index("-")
+        missing = h.copy()
+        missing[-5:] = -1
+        samples = [
+            sc2ts.Sample("a1", "2020-02-14", haplotype=h.copy()),
+            sc2ts.Sample("b1", "2020-02-14", haplotype=deleted),
+            sc2ts.Sample("a2", "2020-02-14", haplotype=h.copy()),
+            sc2ts.Sample("b2", "2020-02-14", haplotype=missing),
+            sc2ts.Sample("a3", "2020-02-14", haplotype=h.copy()),
+        ]
+        with caplog.at_level("INFO", logger="sc2ts.inference"):
+            sc2ts.match_samples(
+                "2020-02-14",
+                samples,
+                base_ts=ts,
+                num_mismatches=3,
+                num_threads=0,
+                deletions_as_missing=deletions_as_missing,
+            )
+        num_unique = 2 if deletions_as_missing else 3
+        assert f"Matching {num_unique} unique haplotypes for 5 samples" in caplog.text
+        a1, b1, a2, b2, a3 = samples
+        for sample in [a2, a3]:
+            assert sample.hmm_match is not a1.hmm_match
+            assert sample.hmm_match.path == a1.hmm_match.path
+            assert sample.hmm_match.mutations == a1.hmm_match.mutations
+            assert sample.hmm_match.likelihood == a1.hmm_match.likelihood
+            for m1, m2 in zip(sample.hmm_match.mutations, a1.hmm_match.mutations):
+                assert m1 is not m2
+        if deletions_as_missing:
+            assert b1.hmm_match.mutations == b2.hmm_match.mutations
+            assert b1.hmm_match is not b2.hmm_match
+        else:
+            assert b1.hmm_match.mutations != a1.hmm_match.mutations
+            assert b1.hmm_match.mutations != b2.hmm_match.mutations
+
+    def test_same_as_without_dedup(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        single = sc2ts.Sample("single", "2020-02-14", haplotype=h.copy())
+        sc2ts.match_samples(
+            "2020-02-14", [single], base_ts=ts, num_mismatches=3, num_threads=0
+        )
+        samples = [
+            sc2ts.Sample(f"x{j}", "2020-02-14", haplotype=h.copy()) for j in range(3)
+        ]
+        sc2ts.match_samples(
+            "2020-02-14", samples, base_ts=ts, num_mismatches=3, num_threads=0
+        )
+        for sample in samples:
+            assert sample.hmm_match.summary() == single.hmm_match.summary()
+
+
+class TestHmmCache:
+    def match_tsinfer(self, samples, ts, hmm_cache, **kwargs):
+        sc2ts.match_tsinfer(
+            samples=samples,
+            ts=ts,
+            num_mismatches=3,
+            mismatch_threshold=20,
+            hmm_cache=hmm_cache,
+            **kwargs,
+        )
+
+    def zerotype(self, ts, strain="zerotype"):
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        return sc2ts.Sample(strain, "2020-02-14", haplotype=h)
+
+    def test_ts_digest(self, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        assert sc2ts.ts_digest(ts) == sc2ts.ts_digest(ts.dump_tables().tree_sequence())
+        assert sc2ts.ts_digest(ts) != sc2ts.ts_digest(fx_ts_map["2020-02-11"])
+        # Metadata doesn't affect matching
+        tables = ts.dump_tables()
+        tables.metadata = {}
+        assert sc2ts.ts_digest(ts) == sc2ts.ts_digest(tables.tree_sequence())
+
+    def test_key(self, tmp_path, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        h = np.zeros(ts.num_sites, dtype=np.int8)
+        params = dict(
+            num_mismatches=3,
+            mismatch_threshold=1,
+            likelihood_threshold=0.5,
+            mirror_coordinates=False,
+            deletions_as_missing=False,
+        )
+        with sc2ts.HmmCache(tmp_path / "cache.db") as cache:
+            key = cache.key(h, ts, **params)
+            assert key == cache.key(h.copy(), ts, **params)
+            keys = {key}
+            for name, value in [
+                ("num_mismatches", 4),
+                ("mismatch_threshold", None),
+                ("likelihood_threshold", 0.25),
+                ("mirror_coordinates", True),
+                ("deletions_as_missing", True),
+            ]:
+                keys.add(cache.key(h, ts, **{**params, name: value}))
+            keys.add(cache.key(h + 1, ts, **params))
+            keys.add(cache.key(h, fx_ts_map["2020-02-11"], **params))
+            assert len(keys) == 8
+
+    @pytest.mark.parametrize("mirror", [False, True])
+    def test_hit(self, tmp_path, fx_ts_map, mirror):
+        ts = fx_ts_map["2020-02-13"]
+        path = tmp_path / "cache.db"
+        s1 = self.zerotype(ts)
+        with sc2ts.HmmCache(path) as cache:
+            self.match_tsinfer([s1], ts, cache, mirror_coordinates=mirror)
+            assert cache.num_misses == 1
+            assert cache.num_hits == 0
+            assert len(cache) == 1
+        s2 = self.zerotype(ts)
+        # A fresh connection sees the persisted match
+        with sc2ts.HmmCache(path) as cache, sc2ts.TsbCache() as tsb_cache:
+            self.match_tsinfer(
+                [s2], ts, cache, mirror_coordinates=mirror, tsb_cache=tsb_cache
+            )
+            # No builder is needed when all matches are cached
+            assert tsb_cache.num_builds == 0
+            assert cache.num_hits == 1
+            assert cache.num_misses == 0
+        assert s2.hmm_match == s1.hmm_match
+
+    def test_miss_on_different_params(self, tmp_path, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        with sc2ts.HmmCache(tmp_path / "cache.db") as cache:
+            self.match_tsinfer([self.zerotype(ts)], ts, cache)
+            self.match_tsinfer([self.zerotype(ts)], ts, cache, mirror_coordinates=True)
+            self.match_tsinfer([self.zerotype(ts)], fx_ts_map["2020-02-11"], cache)
+            assert cache.num_misses == 3
+            assert cache.num_hits == 0
+            assert len(cache) == 3
+
+    def test_lru_eviction(self, tmp_path, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        with sc2ts.HmmCache(tmp_path / "cache.db") as cache:
+            items = []
+            for j in range(4):
+                h = np.zeros(ts.num_sites, dtype=np.int8)
+                h[j] = 1
+                key = cache.key(
+                    h,
+                    ts,
+                    num_mismatches=3,
+                    mismatch_threshold=20,
+                    likelihood_threshold=0.5,
+                )
+                match = sc2ts.HmmMatch([sc2ts.PathSegment(0, 1, j)], [], 1.0)
+                items.append((key, match))
+            cache.put(items[:3])
+            assert len(cache) == 3
+            entry_size = cache.size // 3
+            # Touch the first entry so that the second is least recently used
+            assert cache.get(items[0][0]) == items[0][1]
+            cache.max_size = 3 * entry_size
+            cache.put(items[3:])
+            assert len(cache) == 3
+            assert cache.get(items[1][0]) is None
+            for key, match in [items[0], items[2], items[3]]:
+                assert cache.get(key) == match
+            assert cache.num_hits == 4
+            assert cache.num_misses == 1
+
+    def test_get_many(self, tmp_path):
+        with sc2ts.HmmCache(tmp_path / "cache.db") as cache:
+            items = [
+                (f"k{j}", sc2ts.HmmMatch([sc2ts.PathSegment(0, 1, j)], [], 1.0))
+                for j in range(3)
+            ]
+            cache.put(items)
+            keys = ["k0", "missing", "k2", "k0", "k1"]
+            result = cache.get_many(keys, batch_size=2)
+            matches = dict(items)
+            assert result == [matches.get(key) for key in keys]
+            assert cache.num_hits == 4
+            assert cache.num_misses == 1
+            assert cache.get_many([]) == []
+
+    def test_match_samples(self, tmp_path, fx_ts_map):
+        ts = fx_ts_map["2020-02-13"]
+        path = tmp_path / "cache.db"
+        s1 = self.zerotype(ts)
+        with sc2ts.HmmCache(path) as cache:
+            sc2ts.match_samples(
+                "2020-02-14",
+                [s1],
+                base_ts=ts,
+                num_mismatches=3,
+                num_threads=0,
+                hmm_cache=cache,
+            )
+            num_stored = len(cache)
+            assert num_stored == cache.num_misses
+        s2 = self.zerotype(ts)
+        with sc2ts.HmmCache(path) as cache:
+            sc2ts.match_samples(
+                "2020-02-14",
+                [s2],
+                base_ts=ts,
+                num_mismatches=3,
+                num_threads=0,
+                hmm_cache=cache,
+            )
+            assert cache.num_hits == num_stored
+            assert cache.num_misses == 0
+        assert s2.hmm_match == s1.hmm_match
+
+
 class TestMirrorTsCoords:
     def test_dense_sites_example(self):
         tree = tskit.Tree.generate_balanced(2, span=10)
@@ -367,6 +1420,43 @@ class TestRealData:
 
         ts.tables.assert_equals(fx_ts_map["2020-02-02"].tables, ignore_provenance=True)
 
+    def test_consecutive_days_tsb_cache(
+        self, tmp_path, fx_ts_map, fx_alignment_store, fx_metadata_db
+    ):
+        ts = fx_ts_map["2020-01-28"]
+        match_db = sc2ts.MatchDb.initialise(tmp_path / "match.db")
+        with sc2ts.TsbCache(incremental=True, verify=True) as cache:
+            for date in ["2020-01-29", "2020-01-30", "2020-01-31"]:
+                ts = sc2ts.extend(
+                    alignment_store=fx_alignment_store,
+                    metadata_db=fx_metadata_db,
+                    base_ts=ts,
+                    date=date,
+                    match_db=match_db,
+                    tsb_cache=cache,
+                )
+                ts.tables.assert_equals(fx_ts_map[date].tables, ignore_provenance=True)
+            assert cache.num_builds == 1
+            assert cache.num_updates == 2
+
+    def test_extend_days(self, tmp_path, fx_ts_map, fx_alignment_store, fx_metadata_db):
+        dates = ["2020-01-29", "2020-01-30", "2020-01-31"]
+        match_db = sc2ts.MatchDb.initialise(tmp_path / "match.db")
+        with sc2ts.TsbCache(incremental=True, verify=True) as cache:
+            results = sc2ts.extend_days(
+                alignment_store=fx_alignment_store,
+                metadata_db=fx_metadata_db,
+                base_ts=fx_ts_map["2020-01-28"],
+                dates=dates,
+                match_db=match_db,
+                tsb_cache=cache,
+            )
+            for date, (result_date, ts) in zip(dates, results, strict=True):
+                assert result_date == date
+                ts.tables.assert_equals(fx_ts_map[date].tables, ignore_provenance=True)
+            assert cache.num_builds == 1
+            assert cache.num_updates == 2
+
     @pytest.mark.parametrize("max_samples", range(1, 6))
     def test_2020_02_02_max_samples(
         self, tmp_path, fx_ts_map, fx_alignment_store, fx_metadata_db, max_samples
@@ -404,6 +1494,25 @@ class TestRealData:
                 ts.node(u).metadata["sc2ts"]["num_missing_sites"] <= max_missing_sites
             )
 
+    @pytest.mark.parametrize("max_missing_sites", [0, 123, 500, 10_000])
+    def test_prefilter_missing_sites(
+        self, fx_ts_map, fx_alignment_store, max_missing_sites
+    ):
+        keep_sites = fx_ts_map["2020-02-01"].sites_position.astype(int)
+        strains = list(fx_alignment_store.keys()) + ["not_in_store"]
+        kept = sc2ts.prefilter_missing_sites(
+            fx_alignment_store, strains, len(keep_sites), max_missing_sites
+        )
+        assert "not_in_store" in kept
+        H, _ = fx_alignment_store.get_many(strains[:-1], keep_sites)
+        num_missing = np.sum(H == -1, axis=1)
+        for strain, n in zip(strains, num_missing):
+            # Everything that would pass the filter must be kept
+            if n <= max_missing_sites:
+                assert strain in kept
+        if max_missing_sites == 0:
+            assert len(kept) < len(strains)
+
     @pytest.mark.parametrize(
         ["strain", "start", "length"],
         [("SRR11597164", 1547, 1), ("SRR11597190", 3951, 3)],
@@ -696,6 +1805,26 @@ class TestRealData:
             assert len(retro_groups) == 0
             assert "Skipping size=" in caplog.text
 
+    def test_add_matching_results_num_workers(self, fx_ts_map, fx_match_db):
+        ts = sc2ts.increment_time("2020-02-14", fx_ts_map["2020-02-13"])
+        results = []
+        for num_workers in [0, 2]:
+            results.append(
+                sc2ts.add_matching_results(
+                    "hmm_cost>0",
+                    fx_match_db,
+                    ts,
+                    "2020-02-14",
+                    min_group_size=1,
+                    additional_node_flags=sc2ts.NODE_IN_SAMPLE_GROUP,
+                    num_workers=num_workers,
+                )
+            )
+        (ts1, groups1), (ts2, groups2) = results
+        assert len(groups1) > 0
+        assert [g.strains for g in groups1] == [g.strains for g in groups2]
+        ts1.tables.assert_equals(ts2.tables, ignore_provenance=True)
+
     @pytest.mark.parametrize("date", dates)
     def test_date_metadata(self, fx_ts_map, date):
         ts = fx_ts_map[date]
@@ -710,6 +1839,11 @@ class TestRealData:
         ts = fx_ts_map[date]
         sc2ts.validate(ts, fx_alignment_store)
 
+    def test_validate_alignment_matrix(self, tmp_path, fx_ts_map, fx_alignment_store):
+        ts = fx_ts_map[self.dates[-1]]
+        matrix = fx_alignment_store.export_zarr(tmp_path / "alignments.zarr")
+        sc2ts.validate(ts, matrix)
+
     def test_mutation_type_metadata(self, fx_ts_map):
         ts = fx_ts_map[self.dates[-1]]
         for mutation in ts.mutations():
@@ -1012,6 +2146,80 @@ class TestSyntheticAlignments:
         assert ts.num_nodes == base_ts.num_nodes
 
 
+class TestPreprocess:
+    @pytest.mark.parametrize("num_workers", [0, 1, 3])
+    def test_matches_get_many(self, fx_alignment_store, num_workers):
+        strains = list(fx_alignment_store)[::-1] + ["not_in_store"]
+        keep_sites = np.arange(1, 29904, 7)
+        samples = sc2ts.preprocess(
+            strains,
+            fx_alignment_store.path,
+            keep_sites=keep_sites,
+            num_workers=num_workers,
+        )
+        H, missing, compositions = fx_alignment_store.get_many(
+            strains, keep_sites, composition=True
+        )
+        assert [s.strain for s in samples] == strains
+        assert samples[-1].haplotype is None
+        for j, sample in enumerate(samples[:-1]):
+            np.testing.assert_array_equal(sample.haplotype, H[j])
+            assert sample.alignment_composition == compositions[j]
+
+    def test_empty(self, fx_alignment_store):
+        assert sc2ts.preprocess([], fx_alignment_store.path, keep_sites=[1]) == []
+
+    def test_pool_reused(self, fx_alignment_store):
+        pool = sc2ts.get_preprocess_pool(2)
+        assert sc2ts.get_preprocess_pool(2) is pool
+        other = sc2ts.get_preprocess_pool(1)
+        assert other is not pool
+        sc2ts.shutdown_preprocess_pool()
+        assert sc2ts.get_preprocess_pool(1) is not other
+        sc2ts.shutdown_preprocess_pool()
+
+    def test_replaced_store_reopened(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "alignments.db"
+        strain = "SRR11772659"
+        other = "ERR4206593"
+        keep_sites = [100, 200, 300]
+        with sc2ts.PreprocessPool(1) as pool:
+            for s in [strain, other]:
+                with sc2ts.AlignmentStore.initialise(path) as store:
+                    store.append({strain: fx_alignment_store[s]})
+                samples = pool.preprocess([strain], path, keep_sites=keep_sites)
+                H, _ = fx_alignment_store.get_many([s], keep_sites)
+                np.testing.assert_array_equal(samples[0].haplotype, H[0])
+
+    def test_sharded_store(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "sharded"
+        with sc2ts.ShardedAlignmentStore.initialise(path, 3) as store:
+            store.import_fasta("tests/data/alignments.fasta.gz")
+        strains = list(fx_alignment_store)
+        samples = sc2ts.preprocess(strains, path, keep_sites=[1, 2, 29000])
+        H, _ = fx_alignment_store.get_many(strains, [1, 2, 29000])
+        for sample, h in zip(samples, H):
+            np.testing.assert_array_equal(sample.haplotype, h)
+
+    def test_updated_shard_reopened(self, tmp_path, fx_alignment_store):
+        path = tmp_path / "sharded"
+        strain = "SRR11772659"
+        keep_sites = [100, 200, 300]
+        with sc2ts.ShardedAlignmentStore.initialise(path, 2) as store:
+            store.append({"ERR4206593": fx_alignment_store["ERR4206593"]})
+        with sc2ts.PreprocessPool(1) as pool:
+            samples = pool.preprocess([strain], path, keep_sites=keep_sites)
+            assert samples[0].haplotype is None
+            key = sc2ts.inference._alignment_store_key(path)
+            # Appending to a shard leaves the store directory unchanged.
+            with sc2ts.ShardedAlignmentStore(path, "a") as store:
+                store.append({strain: fx_alignment_store[strain]})
+            assert sc2ts.inference._alignment_store_key(path) != key
+            samples = pool.preprocess([strain], path, keep_sites=keep_sites)
+            H, _ = fx_alignment_store.get_many([strain], keep_sites)
+            np.testing.assert_array_equal(samples[0].haplotype, H[0])
+
+
 class TestMatchingDetails:
     @pytest.mark.parametrize(
         ("strain", "parent"), [("SRR11597207", 34), ("ERR4205570", 47)]
@@ -1194,3 +2402,28 @@ class TestMatchRecombinants:
         for hmm_match in s.hmm_reruns.values():
             assert len(hmm_match.path) == 1
             assert len(hmm_match.mutations) == 20943
+
+    def test_shared_tsb_cache(self, fx_ts_map):
+        ts, s1 = recombinant_example_1(fx_ts_map)
+        _, s2 = recombinant_example_1(fx_ts_map)
+        sc2ts.match_recombinants(
+            samples=[s1], base_ts=ts, num_mismatches=2, num_threads=0
+        )
+        with sc2ts.TsbCache() as cache:
+            sc2ts.match_recombinants(
+                samples=[s2],
+                base_ts=ts,
+                num_mismatches=2,
+                num_threads=0,
+                tsb_cache=cache,
+            )
+            # The forward and no_recombination passes share a builder
+            assert cache.num_builds == 2
+            assert cache.num_hits == 1
+            assert len(cache) == 2
+        assert len(cache) == 0
+        for hmm_pass in ["forward", "reverse", "no_recombination"]:
+            m1 = s1.hmm_reruns[hmm_pass]
+            m2 = s2.hmm_reruns[hmm_pass]
+            assert m1.path == m2.path
+            assert m1.mutation_summary() == m2.mutation_summary()
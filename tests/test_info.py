@@ -36,6 +36,13 @@ class TestTallyLineages:
         assert list(df["db_count"]) == [26, 15, 4, 4, 1, 3, 1, 1, 1]
         assert list(df["arg_count"]) == [23, 15, 4, 3, 1, 1, 0, 0, 0]
 
+    def test_snapshot(self, tmp_path, fx_ts_map, fx_metadata_db):
+        ts = fx_ts_map["2020-02-13"]
+        snapshot = fx_metadata_db.create_snapshot(tmp_path / "snapshot")
+        df1 = info.tally_lineages(ts, fx_metadata_db)
+        df2 = info.tally_lineages(ts, snapshot)
+        pd.testing.assert_frame_equal(df1, df2)
+
 
 class TestCountMutations:
     def test_1tree_0mut(self):
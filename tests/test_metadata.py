@@ -1,6 +1,12 @@
+import json
+import sqlite3
+
 import pytest
+import numpy as np
 import pandas as pd
 
+import sc2ts
+
 
 class TestMetadataDb:
     def test_known(self, fx_metadata_db):
@@ -39,3 +45,506 @@ class TestMetadataDb:
         assert len(results) == 2
         for result in results:
             assert result["date"] == "2020-02-11"
+
+
+class TestImportCsv:
+    tsv_path = "tests/data/metadata.tsv"
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+    def test_chunk_size(self, tmp_path, fx_metadata_db, chunk_size):
+        db_path = tmp_path / "metadata.db"
+        n = sc2ts.MetadataDb.import_csv(self.tsv_path, db_path, chunk_size=chunk_size)
+        df = pd.read_csv(self.tsv_path, sep="\t")
+        assert n == len(df)
+        with sc2ts.MetadataDb(db_path) as db:
+            assert len(db) == len(df)
+            for strain in df["strain"]:
+                assert db[strain] == fx_metadata_db[strain]
+
+    def test_column_types(self, tmp_path):
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(self.tsv_path, db_path)
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("PRAGMA table_info(samples)")
+            types = {row[1]: row[2] for row in rows}
+        conn.close()
+        assert types["strain"] == "TEXT"
+        assert types["date"] == "TEXT"
+        assert types["Viridian_N"] == "INTEGER"
+        assert types["Viridian_cons_len"] == "INTEGER"
+        # Types of columns not in the schema are inferred from the data
+        assert types["Genbank_N"] == "TEXT"
+        with sc2ts.MetadataDb(db_path) as db:
+            record = db["SRR11772659"]
+        assert record["Viridian_N"] == 0
+        assert record["Viridian_cons_len"] == 29836
+        assert record["Genbank_N"] == "."
+
+    def test_schema(self, tmp_path):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c"],
+                "date": ["2020-01-01", "2020-01-02", "2020-01-02"],
+                "count": [1, None, 3],
+                "score": [0.5, 1, None],
+                "code": ["001", "002", "003"],
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        schema = {"count": "INTEGER", "score": "REAL", "code": "TEXT"}
+        sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",", schema=schema)
+        with sc2ts.MetadataDb(db_path) as db:
+            assert db["a"] == {
+                "strain": "a",
+                "date": "2020-01-01",
+                "count": 1,
+                "score": 0.5,
+                "code": "001",
+            }
+            assert db["b"]["count"] is None
+            assert db["b"]["score"] == 1.0
+            assert db["c"]["score"] is None
+            assert db.get_days() == ["2020-01-01", "2020-01-02"]
+
+    def test_inferred_types(self, tmp_path):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c"],
+                "date": ["2020-01-01", "2020-01-02", "2020-01-02"],
+                "count": [1, 2, 3],
+                "score": [0.5, 1, None],
+                "code": ["001", "x", "003"],
+                "empty": [None, None, None],
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",")
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("PRAGMA table_info(samples)")
+            types = {row[1]: row[2] for row in rows}
+        conn.close()
+        assert types == {
+            "strain": "TEXT",
+            "date": "TEXT",
+            "count": "INTEGER",
+            "score": "REAL",
+            "code": "TEXT",
+            "empty": "TEXT",
+        }
+        with sc2ts.MetadataDb(db_path) as db:
+            assert db["a"]["count"] == 1
+            assert db["a"]["code"] == "001"
+            assert db["c"]["score"] is None
+
+    def test_normalise_dates(self, tmp_path):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c", "d"],
+                "date": ["2020-01-05", "2020-1-5", "2020-01-06T10:00:00", None],
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",")
+        with sc2ts.MetadataDb(db_path) as db:
+            assert [db[s]["date"] for s in "abcd"] == [
+                "2020-01-05",
+                "2020-01-05",
+                "2020-01-06",
+                None,
+            ]
+
+    @pytest.mark.parametrize("date", ["2020-01", "2021-02-29", "05/01/2020"])
+    def test_partial_date(self, tmp_path, caplog, date):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame({"strain": ["a", "b"], "date": ["2020-1-5", date]}).to_csv(
+            csv_path, index=False
+        )
+        db_path = tmp_path / "metadata.db"
+        with caplog.at_level("WARNING", logger="sc2ts.metadata"):
+            sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",")
+        assert "not in YYYY-MM-DD format" in caplog.text
+        with sc2ts.MetadataDb(db_path) as db:
+            assert db["a"]["date"] == "2020-01-05"
+            assert db["b"]["date"] == date
+            assert db.date_sample_counts()["2020-01-05"] == 1
+
+    def test_widened_types(self, tmp_path, caplog):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c", "d"],
+                "date": ["2020-01-01"] * 4,
+                "to_text": ["1", "2", ".", "4"],
+                "to_real": ["1", None, "2.5", "3"],
+                "integer": ["1", "2", None, "4"],
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        with caplog.at_level("WARNING", logger="sc2ts.metadata"):
+            sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",", chunk_size=2)
+        assert "Widening column to_text from INTEGER to TEXT" in caplog.text
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("PRAGMA table_info(samples)")
+            types = {row[1]: row[2] for row in rows}
+        conn.close()
+        assert types["to_text"] == "TEXT"
+        assert types["to_real"] == "REAL"
+        assert types["integer"] == "INTEGER"
+        with sc2ts.MetadataDb(db_path) as db:
+            assert [db[s]["to_text"] for s in "abcd"] == ["1", "2", ".", "4"]
+            assert [db[s]["to_real"] for s in "abcd"] == [1.0, None, 2.5, 3.0]
+            assert [db[s]["integer"] for s in "abcd"] == [1, 2, None, 4]
+            snapshot = db.create_snapshot(tmp_path / "snapshot")
+            for strain in db:
+                assert snapshot[strain] == db[strain]
+
+    def test_bad_type(self, tmp_path):
+        with pytest.raises(ValueError, match="Unsupported type"):
+            sc2ts.MetadataDb.import_csv(
+                self.tsv_path, tmp_path / "x.db", schema={"date": "DATE"}
+            )
+
+    def test_replaces_existing(self, tmp_path):
+        db_path = tmp_path / "metadata.db"
+        db_path.write_text("not a database")
+        sc2ts.MetadataDb.import_csv(self.tsv_path, db_path)
+        with sc2ts.MetadataDb(db_path) as db:
+            assert "SRR11772659" in db
+
+
+class TestLineageCounts:
+    tsv_path = "tests/data/metadata.tsv"
+
+    @pytest.fixture
+    def fx_unaggregated_db(self, tmp_path):
+        db_path = tmp_path / "unaggregated.db"
+        sc2ts.MetadataDb.import_csv(self.tsv_path, db_path, lineage_column=None)
+        with sc2ts.MetadataDb(db_path) as db:
+            yield db
+
+    def test_lineage_column(self, fx_metadata_db, fx_unaggregated_db):
+        assert fx_metadata_db.lineage_column == "Viridian_pangolin"
+        assert fx_unaggregated_db.lineage_column is None
+
+    @pytest.mark.parametrize(
+        "date", [None, "2019-01-01", "2020-01-01", "2020-02-01", "2020-02-13"]
+    )
+    def test_aggregate_matches_scan(self, fx_metadata_db, fx_unaggregated_db, date):
+        counts = fx_metadata_db.lineage_counts(date)
+        assert counts == fx_unaggregated_db.lineage_counts(date)
+        assert list(counts) == list(fx_unaggregated_db.lineage_counts(date))
+        sql = "SELECT * FROM samples"
+        args = ()
+        if date is not None:
+            sql += " WHERE date <= ?"
+            args = (date,)
+        df = pd.DataFrame(fx_metadata_db.query(sql, args))
+        if len(df) > 0:
+            expected = df["Viridian_pangolin"].value_counts().to_dict()
+            assert dict(counts) == expected
+        else:
+            assert len(counts) == 0
+
+    def test_uses_aggregate(self, fx_metadata_db):
+        sql = "SELECT pango, SUM(count) FROM lineage_counts WHERE date <= ?"
+        plan = " ".join(fx_metadata_db.explain(sql, ("2020-02-01",)))
+        assert "lineage_counts" in plan
+        assert "samples" not in plan
+
+    def test_date_sample_counts(self, fx_metadata_db, fx_unaggregated_db):
+        assert (
+            fx_metadata_db.date_sample_counts()
+            == fx_unaggregated_db.date_sample_counts()
+        )
+
+    def test_other_column(self, fx_metadata_db):
+        counts = fx_metadata_db.lineage_counts("2020-02-13", "Genbank_pangolin")
+        assert sum(counts.values()) == sum(
+            fx_metadata_db.lineage_counts("2020-02-13").values()
+        )
+
+    def test_unknown_column(self, fx_metadata_db):
+        with pytest.raises(ValueError, match="Unknown columns"):
+            fx_metadata_db.lineage_counts(column="NOT_A_COLUMN")
+
+    @pytest.mark.parametrize("date", [None, "2020-01-01", "2020-02-13", "2021-01-01"])
+    def test_snapshot(self, tmp_path, fx_metadata_db, date):
+        snapshot = fx_metadata_db.create_snapshot(tmp_path / "snapshot")
+        counts = snapshot.lineage_counts(date)
+        assert counts == fx_metadata_db.lineage_counts(date)
+        assert list(counts) == list(fx_metadata_db.lineage_counts(date))
+
+
+class TestImportIndexes:
+    tsv_path = "tests/data/metadata.tsv"
+
+    def index_names(self, db_path):
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' "
+                "AND tbl_name='samples'"
+            ).fetchall()
+        conn.close()
+        return {row[0] for row in rows}
+
+    def test_default(self, tmp_path):
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(self.tsv_path, db_path)
+        assert self.index_names(db_path) == {"ix_samples_strain", "ix_samples_date"}
+
+    def test_covering_index(self, tmp_path):
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(
+            self.tsv_path,
+            db_path,
+            indexes=["Country", ("Viridian_pangolin", "date")],
+            lineage_column=None,
+        )
+        assert self.index_names(db_path) == {
+            "ix_samples_strain",
+            "ix_samples_date",
+            "ix_samples_Country",
+            "ix_samples_Viridian_pangolin_date",
+        }
+        with sc2ts.MetadataDb(db_path) as db:
+            sql = (
+                "SELECT Viridian_pangolin, COUNT(*) FROM samples "
+                "WHERE date <= ? GROUP BY Viridian_pangolin"
+            )
+            plan = " ".join(db.explain(sql, ("2020-02-01",)))
+            assert "COVERING INDEX ix_samples_Viridian_pangolin_date" in plan
+
+    @pytest.mark.parametrize("indexes", [["NOT_A_COLUMN"], [("date", "xxx")], [[]]])
+    def test_unknown_column(self, tmp_path, indexes):
+        with pytest.raises(ValueError, match="Cannot index"):
+            sc2ts.MetadataDb.import_csv(
+                self.tsv_path, tmp_path / "metadata.db", indexes=indexes
+            )
+
+
+class TestGetRange:
+    def test_single_day(self, fx_metadata_db):
+        df = fx_metadata_db.get_range("2020-02-11", "2020-02-11")
+        rows = list(fx_metadata_db.get("2020-02-11"))
+        assert list(df.columns) == fx_metadata_db.columns
+        assert df.to_dict("records") == rows
+
+    def test_range(self, fx_metadata_db):
+        df = fx_metadata_db.get_range("2020-01-24", "2020-02-01")
+        counts = fx_metadata_db.date_sample_counts()
+        expected = sum(
+            count
+            for date, count in counts.items()
+            if "2020-01-24" <= date <= "2020-02-01"
+        )
+        assert len(df) == expected
+        assert list(df["date"]) == sorted(df["date"])
+
+    def test_columns(self, fx_metadata_db):
+        df = fx_metadata_db.get_range(
+            "2020-01-01", "2020-12-31", columns=["strain", "Viridian_N"]
+        )
+        assert list(df.columns) == ["strain", "Viridian_N"]
+        assert len(df) == len(fx_metadata_db)
+        row = df[df["strain"] == "SRR11772659"].iloc[0]
+        assert row["Viridian_N"] == fx_metadata_db["SRR11772659"]["Viridian_N"]
+
+    def test_arrays(self, fx_metadata_db):
+        d = fx_metadata_db.get_range(
+            "2020-02-13", "2020-02-13", columns=["strain", "date"], as_frame=False
+        )
+        assert set(d.keys()) == {"strain", "date"}
+        assert isinstance(d["strain"], np.ndarray)
+        assert list(d["date"]) == ["2020-02-13"] * 4
+
+    def test_empty(self, fx_metadata_db):
+        df = fx_metadata_db.get_range("2030-01-01", "2030-01-02", columns=["strain"])
+        assert len(df) == 0
+        assert list(df.columns) == ["strain"]
+        d = fx_metadata_db.get_range("2030-01-01", "2030-01-02", as_frame=False)
+        assert all(len(v) == 0 for v in d.values())
+
+    def test_unknown_column(self, fx_metadata_db):
+        with pytest.raises(ValueError, match="Unknown columns"):
+            fx_metadata_db.get_range("2020-01-01", "2020-01-02", columns=["x"])
+
+
+class TestGetMany:
+    @pytest.mark.parametrize("batch_size", [1, 3, 500])
+    def test_all(self, fx_metadata_db, batch_size):
+        strains = list(fx_metadata_db)[::-1]
+        rows = fx_metadata_db.get_many(strains, batch_size=batch_size)
+        assert rows == [fx_metadata_db[strain] for strain in strains]
+
+    def test_columns(self, fx_metadata_db):
+        strains = ["SRR11772659", "SRR14631544", "SRR11772659"]
+        rows = fx_metadata_db.get_many(strains, columns=["date"])
+        assert rows == [
+            {"date": "2020-01-19"},
+            {"date": "2020-01-01"},
+            {"date": "2020-01-19"},
+        ]
+
+    def test_missing(self, fx_metadata_db):
+        with pytest.raises(KeyError, match="NOT_IN_DB"):
+            fx_metadata_db.get_many(["SRR11772659", "NOT_IN_DB"])
+
+
+class TestQuery:
+    def test_bound_args(self, fx_metadata_db):
+        rows = list(
+            fx_metadata_db.query(
+                "SELECT strain FROM samples WHERE date==?", ("2020-02-13",)
+            )
+        )
+        assert len(rows) == 4
+        rows = list(
+            fx_metadata_db.query("SELECT strain FROM samples WHERE date==?", ("x",))
+        )
+        assert rows == []
+
+    def test_no_args(self, fx_metadata_db):
+        rows = list(fx_metadata_db.query("SELECT COUNT(*) AS n FROM samples"))
+        assert rows == [{"n": len(fx_metadata_db)}]
+
+    def test_explain(self, fx_metadata_db):
+        plan = fx_metadata_db.explain(
+            "SELECT * FROM samples WHERE date==?", ("2020-02-13",)
+        )
+        assert any("ix_samples_date" in step for step in plan)
+
+
+@pytest.fixture
+def fx_metadata_snapshot(tmp_path, fx_metadata_db):
+    return fx_metadata_db.create_snapshot(tmp_path / "snapshot")
+
+
+class TestMetadataSnapshot:
+    def test_mapping(self, fx_metadata_db, fx_metadata_snapshot):
+        assert len(fx_metadata_snapshot) == len(fx_metadata_db)
+        assert set(fx_metadata_snapshot) == set(fx_metadata_db)
+        assert fx_metadata_snapshot.columns == fx_metadata_db.columns
+        for strain in fx_metadata_db:
+            assert fx_metadata_snapshot[strain] == fx_metadata_db[strain]
+        assert "SRR11772659" in fx_metadata_snapshot
+        assert "DEFO_NOT_IN_DB" not in fx_metadata_snapshot
+        with pytest.raises(KeyError):
+            fx_metadata_snapshot["DEFO_NOT_IN_DB"]
+
+    def test_get(self, fx_metadata_db, fx_metadata_snapshot):
+        for date in fx_metadata_db.get_days(None) + ["2030-01-01"]:
+            assert list(fx_metadata_snapshot.get(date)) == list(
+                fx_metadata_db.get(date)
+            )
+
+    @pytest.mark.parametrize("date", [None, "2020-01-01", "2020-02-01", "2022-01-01"])
+    def test_get_days(self, fx_metadata_db, fx_metadata_snapshot, date):
+        assert fx_metadata_snapshot.get_days(date) == fx_metadata_db.get_days(date)
+
+    def test_date_sample_counts(self, fx_metadata_db, fx_metadata_snapshot):
+        assert (
+            fx_metadata_snapshot.date_sample_counts()
+            == fx_metadata_db.date_sample_counts()
+        )
+
+    @pytest.mark.parametrize("columns", [None, ["strain"], ["Viridian_N", "date"]])
+    def test_get_range(self, fx_metadata_db, fx_metadata_snapshot, columns):
+        for start, end in [("2020-01-24", "2020-02-01"), ("2030-01-01", "2030-01-01")]:
+            df1 = fx_metadata_snapshot.get_range(start, end, columns=columns)
+            df2 = fx_metadata_db.get_range(start, end, columns=columns)
+            pd.testing.assert_frame_equal(df1, df2, check_dtype=False)
+
+    def test_get_many(self, fx_metadata_db, fx_metadata_snapshot):
+        strains = list(fx_metadata_db)[::-3]
+        assert fx_metadata_snapshot.get_many(strains) == fx_metadata_db.get_many(
+            strains
+        )
+        assert fx_metadata_snapshot.get_many(
+            strains, columns=["date"]
+        ) == fx_metadata_db.get_many(strains, columns=["date"])
+        with pytest.raises(KeyError, match="NOT_IN_DB"):
+            fx_metadata_snapshot.get_many(["NOT_IN_DB"])
+
+    def test_columns_subset(self, tmp_path, fx_metadata_db):
+        snapshot = fx_metadata_db.create_snapshot(
+            tmp_path / "snapshot", columns=["Viridian_pangolin"]
+        )
+        assert snapshot.columns == ["strain", "date", "Viridian_pangolin"]
+        record = snapshot["SRR11772659"]
+        assert record == {
+            "strain": "SRR11772659",
+            "date": "2020-01-19",
+            "Viridian_pangolin": "A",
+        }
+
+    def test_nulls(self, tmp_path):
+        csv_path = tmp_path / "metadata.csv"
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c", "d"],
+                "date": ["2020-01-02", None, "2020-01-01", "2020-01-02"],
+                "count": [1, None, 3, 4],
+                "name": ["x", "y", None, "z"],
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(
+            csv_path, db_path, sep=",", schema={"count": "INTEGER"}
+        )
+        with sc2ts.MetadataDb(db_path) as db:
+            snapshot = db.create_snapshot(tmp_path / "snapshot")
+            for strain in db:
+                assert snapshot[strain] == db[strain]
+            assert snapshot.get_days() == db.get_days()
+            assert list(snapshot.get("2020-01-02")) == list(db.get("2020-01-02"))
+        assert snapshot["b"] == {"strain": "b", "date": None, "count": None, "name": "y"}
+
+    def test_text_columns(self, tmp_path):
+        csv_path = tmp_path / "metadata.csv"
+        names = ["x" * 1000, "Zürich", "x" * 1000, "北京"]
+        pd.DataFrame(
+            {
+                "strain": ["a", "b", "c", "d"],
+                "date": ["2020-01-02", "2020-01-01", "2020-01-02", "2020-01-01"],
+                "name": names,
+            }
+        ).to_csv(csv_path, index=False)
+        db_path = tmp_path / "metadata.db"
+        sc2ts.MetadataDb.import_csv(csv_path, db_path, sep=",")
+        with sc2ts.MetadataDb(db_path) as db:
+            snapshot = db.create_snapshot(tmp_path / "snapshot")
+            for strain in db:
+                assert snapshot[strain] == db[strain]
+            assert snapshot.lineage_counts(column="name") == db.lineage_counts(
+                column="name"
+            )
+        # Values are stored as codes into the distinct strings
+        assert snapshot.data["name"].dtype == np.int32
+        assert len(snapshot.categories["name"]) == 3
+        df = snapshot.get_range("2020-01-01", "2020-01-02")
+        assert list(df["name"]) == [names[1], names[3], names[0], names[2]]
+
+    def test_old_format_version(self, tmp_path, fx_metadata_db):
+        path = tmp_path / "snapshot"
+        fx_metadata_db.create_snapshot(path)
+        with open(path / "snapshot.json") as f:
+            info = json.load(f)
+        info["format_version"] = 1
+        with open(path / "snapshot.json", "w") as f:
+            json.dump(info, f)
+        with pytest.raises(ValueError, match="format version 1"):
+            sc2ts.MetadataSnapshot(path)
+
+    def test_open_metadata_db(self, fx_metadata_db, fx_metadata_snapshot):
+        db = sc2ts.open_metadata_db(fx_metadata_snapshot.path)
+        assert isinstance(db, sc2ts.MetadataSnapshot)
+        db = sc2ts.open_metadata_db(fx_metadata_db.path)
+        assert isinstance(db, sc2ts.MetadataDb)
+
+    def test_not_snapshot_directory(self, tmp_path, fx_metadata_db):
+        (tmp_path / "other").write_text("x")
+        with pytest.raises(ValueError, match="not a metadata snapshot"):
+            fx_metadata_db.create_snapshot(tmp_path)
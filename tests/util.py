@@ -1,3 +1,7 @@
+import bz2
+import pickle
+import sqlite3
+
 import numpy as np
 import tskit
 
@@ -12,6 +16,31 @@ def get_match_db(ts, db_path, samples, date, num_mismatches):
     return match_db
 
 
+def get_v1_match_db(db_path, samples, date, num_mismatches):
+    """
+    Write the specified samples to a MatchDb using the original schema, in
+    which each Sample is stored as a single bz2 compressed pickle.
+    """
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE samples (strain TEXT, match_date TEXT, hmm_cost REAL, "
+            "pickle BLOB, PRIMARY KEY (strain))"
+        )
+        conn.execute("CREATE INDEX [ix_samples_match_date] on 'samples' ([match_date])")
+        for sample in samples:
+            conn.execute(
+                "INSERT INTO samples VALUES (?, ?, ?, ?)",
+                (
+                    sample.strain,
+                    date,
+                    sample.hmm_match.get_hmm_cost(num_mismatches),
+                    bz2.compress(pickle.dumps(sample)),
+                ),
+            )
+    conn.close()
+    return sc2ts.MatchDb(db_path)
+
+
 def example_binary(n, date="2020-01-01"):
     base = sc2ts.initial_ts()
     tables = base.dump_tables()